@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import time
+import atexit
+import threading
+from collections import OrderedDict
+
+
+
+# Saves markers in a background thread: changes of the same image within
+# the debounce delay are coalesced into a single write of the latest state
+class AutoSaver:
+
+	def __init__(self, delay=1.0, maxQueued=64, errorCallback=None):
+		self.delay = delay
+		self.maxQueued = maxQueued
+		self.errorCallback = errorCallback
+		# (id of store, image filename) -> (deadline, store, filename, markers)
+		self.queue = OrderedDict()
+		self.writing = 0
+		self.running = True
+		self.condition = threading.Condition()
+		self.thread = threading.Thread(target=self.run, name='AutoSaver', daemon=True)
+		self.thread.start()
+		atexit.register(self.Stop)
+
+	# Schedule saving a snapshot of markerList to store; returns immediately
+	# unless more than maxQueued different images are waiting to be written
+	def Schedule(self, store, imageFilename, markerList, delay=None):
+		if delay is None:
+			delay = self.delay
+		snapshot = markerList.Copy()
+		key = (id(store), imageFilename)
+		with self.condition:
+			if not self.running:
+				raise RuntimeError('AutoSaver has been stopped')
+			if key not in self.queue:
+				while len(self.queue) >= self.maxQueued:
+					self.expedite()
+					self.condition.wait()
+				deadline = time.monotonic() + delay
+			else:
+				# Keep the deadline of the first change, so continuous editing
+				# does not postpone the write forever
+				deadline = min(self.queue[key][0], time.monotonic() + delay)
+			self.queue[key] = (deadline, store, imageFilename, snapshot)
+			self.condition.notify_all()
+
+	# Make all queued writes due immediately
+	def expedite(self):
+		for key, (deadline, store, imageFilename, snapshot) in self.queue.items():
+			self.queue[key] = (0.0, store, imageFilename, snapshot)
+		self.condition.notify_all()
+
+	# Write all queued changes now and wait until they are written
+	def Flush(self, timeout=None):
+		with self.condition:
+			self.expedite()
+			return self.condition.wait_for(lambda: len(self.queue) == 0 and self.writing == 0,
+				timeout)
+
+	# Flush and stop the writer thread; registered to run at exit
+	def Stop(self):
+		if not self.running:
+			return
+		self.Flush()
+		with self.condition:
+			self.running = False
+			self.condition.notify_all()
+		self.thread.join()
+
+	def run(self):
+		while True:
+			with self.condition:
+				while True:
+					if not self.running and len(self.queue) == 0:
+						return
+					now = time.monotonic()
+					due = [ key for key, entry in self.queue.items() if entry[0] <= now ]
+					if len(due) > 0:
+						break
+					timeout = min([ entry[0] for entry in self.queue.values() ] + [ now + 3600.0 ])
+					self.condition.wait(timeout - now)
+				entries = [ self.queue.pop(key) for key in due ]
+				self.writing += len(entries)
+				self.condition.notify_all()
+			for (deadline, store, imageFilename, snapshot) in entries:
+				try:
+					store.SaveMarkers(imageFilename, snapshot)
+				except Exception as e:
+					if self.errorCallback is not None:
+						self.errorCallback(imageFilename, e)
+				with self.condition:
+					self.writing -= 1
+					self.condition.notify_all()
+
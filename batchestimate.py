@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Headless batch position estimation for all tagged images in a directory tree:
+#
+#   batchestimate.py [--catalog CATALOG] [--output results.csv] [--jobs N] [--joint] DIR...
+#
+# Images are JPEGs with a .json marker sidecar; results are written as CSV or
+# JSON lines (depending on the extension of the output file) as they finish.
+# With --joint, all images of the same camera and focal length are solved
+# together, including the effective focal length and principal point.
+# Does not need PyQt5 or matplotlib.
+
+
+
+import sys, os
+import argparse
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from place import Place
+from placecatalog import DefaultCatalogFilename
+from marker import MarkerList
+from estimation import PositionEstimation, JointEstimation
+from exif import ReadExifInfo
+
+
+
+# Catalog of places, loaded once per worker process
+workerPlaces = None
+
+def InitWorker(catalogFilename):
+	global workerPlaces
+	workerPlaces = Place.LoadListFromFile(catalogFilename)
+
+# Returns all (image, sidecar) filename pairs below the directory root
+def FindTaggedImages(root):
+	for (dirpath, dirnames, filenames) in os.walk(root):
+		dirnames.sort()
+		for filename in sorted(filenames):
+			if os.path.splitext(filename)[1].lower() not in ('.jpg', '.jpeg'):
+				continue
+			imageFilename = os.path.join(dirpath, filename)
+			jsonFilename = os.path.splitext(imageFilename)[0] + '.json'
+			if os.path.exists(jsonFilename):
+				yield (imageFilename, jsonFilename)
+
+# Result record of an image without results
+def NewRecord(imageFilename):
+	return { 'image': imageFilename, 'markers': 0, 'y': None, 'x': None,
+		'lat': None, 'lon': None, 'stddev_y': None, 'stddev_x': None,
+		'gps_error': None, 'rms_residual': None, 'residuals': None, 'error': None }
+
+# Convert numpy scalars for the writers
+def ConvertRecord(record):
+	for key, value in record.items():
+		if isinstance(value, np.generic):
+			record[key] = value.item()
+	return record
+
+# Estimate position of a single image, returns a result record (dict)
+def EstimateImage(imageFilename, jsonFilename, engine):
+	record = NewRecord(imageFilename)
+	try:
+		markerList = MarkerList()
+		markerList.Load(jsonFilename)
+		record['markers'] = len(markerList)
+		estimation = PositionEstimation.Run(imageFilename, markerList, workerPlaces, engine)
+		position = estimation.position.CH1903()
+		stddev = estimation.result.StdDev()
+		residuals = estimation.Residuals()
+		(lat, lon) = estimation.position.WGS84()
+		record.update({ 'y': position[0], 'x': position[1], 'lat': lat, 'lon': lon,
+			'stddev_y': stddev[0], 'stddev_x': stddev[1],
+			'gps_error': estimation.GpsError(),
+			'rms_residual': np.sqrt(np.mean(np.square(residuals))),
+			'residuals': [ float(r) for r in residuals ] })
+	except Exception as e:
+		record['error'] = '{0}: {1}'.format(type(e).__name__, e)
+	return ConvertRecord(record)
+
+# Images taken with the same camera and focal length and of the same size
+# share their intrinsics
+def CameraGroup(imageFilename):
+	try:
+		exifInfo = ReadExifInfo(imageFilename)
+		return (exifInfo.get('Model'), exifInfo.get('FocalLength'),
+			exifInfo.get('ImageWidth'), exifInfo.get('ImageHeight'))
+	except Exception:
+		return (None, None, None, None)
+
+# Estimate positions of a group of images jointly, returns result records;
+# residuals are in pixels (distances in the image) instead of degrees
+def EstimateGroup(pairs):
+	records = [ NewRecord(imageFilename) for (imageFilename, jsonFilename) in pairs ]
+	try:
+		markerLists = []
+		for (record, (imageFilename, jsonFilename)) in zip(records, pairs):
+			markerList = MarkerList()
+			markerList.Load(jsonFilename)
+			record['markers'] = len(markerList)
+			markerLists.append(markerList)
+		estimation = JointEstimation.Run([ pair[0] for pair in pairs ], markerLists, workerPlaces)
+	except Exception as e:
+		for record in records:
+			record['error'] = '{0}: {1}'.format(type(e).__name__, e)
+		return [ ConvertRecord(record) for record in records ]
+	result = estimation.result
+	for (i, record) in enumerate(records):
+		record.update({ 'focal_length': estimation.EstimatedFocalLength(),
+			'cx': result.principalPoint[0], 'cy': result.principalPoint[1] })
+		position = estimation.Position(i)
+		if position is None:
+			record['error'] = estimation.errors[i] or 'Fewer than 3 markers'
+			continue
+		(lat, lon) = position.WGS84()
+		distances = np.hypot(result.residuals[i][:,0], result.residuals[i][:,1])
+		record.update({ 'y': result.poses[i, 0], 'x': result.poses[i, 1], 'lat': lat, 'lon': lon,
+			'height': result.poses[i, 2], 'heading': np.degrees(result.poses[i, 3]),
+			'pitch': np.degrees(result.poses[i, 4]), 'gps_error': estimation.GpsError(i),
+			'rms_residual': np.sqrt(np.mean(np.square(distances))),
+			'residuals': [ float(d) for d in distances ] })
+	return [ ConvertRecord(record) for record in records ]
+
+
+
+class CsvResultWriter:
+
+	fields = [ 'image', 'markers', 'y', 'x', 'lat', 'lon', 'stddev_y', 'stddev_x',
+		'gps_error', 'rms_residual', 'residuals', 'error' ]
+	# Additional fields of joint estimation
+	jointFields = [ 'height', 'heading', 'pitch', 'focal_length', 'cx', 'cy' ]
+
+	def __init__(self, f, joint=False):
+		self.f = f
+		fields = CsvResultWriter.fields + (CsvResultWriter.jointFields if joint else [])
+		self.writer = csv.DictWriter(f, fieldnames=fields)
+		self.writer.writeheader()
+
+	def Write(self, record):
+		row = dict(record)
+		if row['residuals'] is not None:
+			row['residuals'] = ' '.join('{0:.6f}'.format(r) for r in row['residuals'])
+		self.writer.writerow(row)
+		self.f.flush()
+
+class JsonLinesResultWriter:
+
+	def __init__(self, f):
+		self.f = f
+
+	def Write(self, record):
+		self.f.write(json.dumps(record, sort_keys=True) + '\n')
+		self.f.flush()
+
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Estimate camera positions of all ' \
+		'tagged images (JPEGs with .json marker sidecar) in directory trees')
+	parser.add_argument('directories', nargs='+', help='directories to scan')
+	parser.add_argument('--catalog', default=DefaultCatalogFilename(), help='catalog of places ' \
+		'(default: $IMAGETAGGER_CATALOG or mountains.json next to this program)')
+	parser.add_argument('--output', default='-', help='output file (.csv or .jsonl), ' \
+		'default is CSV on stdout')
+	parser.add_argument('--format', choices=['csv', 'jsonl'], default=None,
+		help='output format, default is derived from output file extension')
+	parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+		help='number of worker processes')
+	parser.add_argument('--engine', default='lm', help='resection engine')
+	parser.add_argument('--joint', action='store_true', help='estimate all images of ' \
+		'the same camera and focal length jointly, including the intrinsics')
+	args = parser.parse_args(argv)
+
+	outputFormat = args.format
+	if outputFormat is None:
+		outputFormat = 'jsonl' if os.path.splitext(args.output)[1].lower() \
+			in ('.jsonl', '.json') else 'csv'
+	f = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+	writer = JsonLinesResultWriter(f) if outputFormat == 'jsonl' else CsvResultWriter(f, args.joint)
+
+	numImages = 0
+	numFailed = 0
+	try:
+		with ProcessPoolExecutor(max_workers=args.jobs, initializer=InitWorker,
+			initargs=(args.catalog,)) as executor:
+			pairs = [ pair for directory in args.directories for pair in FindTaggedImages(directory) ]
+			if args.joint:
+				groups = {}
+				for pair in pairs:
+					groups.setdefault(CameraGroup(pair[0]), []).append(pair)
+				futures = [ executor.submit(EstimateGroup, group) for group in groups.values() ]
+			else:
+				futures = [ executor.submit(EstimateImage, imageFilename, jsonFilename, args.engine) \
+					for (imageFilename, jsonFilename) in pairs ]
+			for future in as_completed(futures):
+				records = future.result()
+				for record in (records if args.joint else [ records ]):
+					writer.Write(record)
+					numImages += 1
+					if record['error'] is not None:
+						numFailed += 1
+	finally:
+		if f is not sys.stdout:
+			f.close()
+	print('Processed {0} images, {1} failed'.format(numImages, numFailed), file=sys.stderr)
+	return 0 if numFailed == 0 else 1
+
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Headless pre-tagging of all untagged images in a directory tree from their
+# skylines:
+#
+#   batchtag.py [--catalog CATALOG] [--dem DEM] [--write] [--output results.jsonl] DIR...
+#
+# Images are JPEGs with a GPS tag and without a .json marker sidecar; the
+# proposed markers are reported as JSON lines and with --write saved as
+# sidecars. Existing sidecars are never overwritten. Does not need PyQt5.
+
+
+
+import sys, os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from placecatalog import PlaceCatalog, DefaultCatalogFilename
+from horizon import ElevationModel, HorizonEngine
+from skyline import SkylineProposal
+from batchestimate import JsonLinesResultWriter
+
+
+
+# Catalog of places and horizon engine, loaded once per worker process
+workerPlaces = None
+workerHorizonEngine = None
+
+def InitWorker(catalogFilename, demFilename):
+	global workerPlaces, workerHorizonEngine
+	workerPlaces = PlaceCatalog.LoadFromFile(catalogFilename)
+	if demFilename:
+		workerHorizonEngine = HorizonEngine(ElevationModel.Load(demFilename), workerPlaces)
+
+# Returns all (image, sidecar) filename pairs below the directory root of
+# images without sidecar
+def FindUntaggedImages(root):
+	for (dirpath, dirnames, filenames) in os.walk(root):
+		dirnames.sort()
+		for filename in sorted(filenames):
+			if os.path.splitext(filename)[1].lower() not in ('.jpg', '.jpeg'):
+				continue
+			imageFilename = os.path.join(dirpath, filename)
+			jsonFilename = os.path.splitext(imageFilename)[0] + '.json'
+			if not os.path.exists(jsonFilename):
+				yield (imageFilename, jsonFilename)
+
+# Propose markers for a single image, returns a result record (dict)
+def TagImage(imageFilename, jsonFilename, write):
+	record = { 'image': imageFilename, 'peaks': 0, 'markers': [], 'heading': None,
+		'written': False, 'error': None }
+	try:
+		proposal = SkylineProposal.Run(imageFilename, workerPlaces,
+			horizonEngine=workerHorizonEngine)
+		record['peaks'] = len(proposal.peakX)
+		record['heading'] = float(np.degrees(proposal.heading)) \
+			if proposal.heading is not None else None
+		record['markers'] = [ { 'Key': marker.key, 'X': marker.x, 'Y': marker.y } \
+			for marker in proposal.markerList ]
+		if write and len(proposal.markerList) > 0 and not os.path.exists(jsonFilename):
+			proposal.markerList.Save(jsonFilename)
+			record['written'] = True
+	except Exception as e:
+		record['error'] = '{0}: {1}'.format(type(e).__name__, e)
+	return record
+
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Propose markers for all untagged ' \
+		'images (JPEGs with GPS tag and without .json marker sidecar) in directory trees')
+	parser.add_argument('directories', nargs='+', help='directories to scan')
+	parser.add_argument('--catalog', default=DefaultCatalogFilename(), help='catalog of places ' \
+		'(default: $IMAGETAGGER_CATALOG or mountains.json next to this program)')
+	parser.add_argument('--dem', default=os.environ.get('IMAGETAGGER_DEM'),
+		help='elevation model to restrict the candidates to visible places')
+	parser.add_argument('--write', action='store_true', help='save proposed markers as sidecars')
+	parser.add_argument('--output', default='-', help='output file (.jsonl), default is stdout')
+	parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+		help='number of worker processes')
+	args = parser.parse_args(argv)
+
+	f = sys.stdout if args.output == '-' else open(args.output, 'w')
+	writer = JsonLinesResultWriter(f)
+
+	numImages = 0
+	numTagged = 0
+	numFailed = 0
+	try:
+		with ProcessPoolExecutor(max_workers=args.jobs, initializer=InitWorker,
+			initargs=(args.catalog, args.dem)) as executor:
+			futures = [ executor.submit(TagImage, imageFilename, jsonFilename, args.write) \
+				for directory in args.directories \
+				for (imageFilename, jsonFilename) in FindUntaggedImages(directory) ]
+			for future in as_completed(futures):
+				record = future.result()
+				writer.Write(record)
+				numImages += 1
+				if record['error'] is not None:
+					numFailed += 1
+				elif len(record['markers']) > 0:
+					numTagged += 1
+	finally:
+		if f is not sys.stdout:
+			f.close()
+	print('Processed {0} images, {1} with proposed markers, {2} failed'.format(numImages,
+		numTagged, numFailed), file=sys.stderr)
+	return 0 if numFailed == 0 else 1
+
+
+
+if __name__ == '__main__':
+	sys.exit(main())
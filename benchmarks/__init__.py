@@ -0,0 +1,4 @@
+# Benchmarks of the position estimation and its building blocks; run
+# headless from the top directory of the repository with
+#
+#   python -m benchmarks.run [--quick] [--output results.json] [--compare old.json]
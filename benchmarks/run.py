@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Runs all benchmarks and writes the results as JSON; with --compare the
+# results are compared to those of an earlier run (e.g. of another commit):
+#
+#   python -m benchmarks.run --output new.json --compare old.json
+
+
+
+import sys, os
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+import numpy as np
+from wgs84_ch1903 import ApproxSwissProj
+from place import Place
+from placecatalog import PlaceCatalog, MappedPlaceCatalog
+from marker import MarkerList
+from markergrid import MarkerGrid
+from resection import Resection
+from horizon import HorizonEngine
+from skyline import DecodeReduced, ExtractSkyline, SkylinePeaks, MatchPeaks
+from jointresection import JointResection, MarkerPoints
+import ransac # Registers the robust engine
+from benchmarks.synthetic import SyntheticCatalog, SaveCatalog, SyntheticPose, \
+	SyntheticMarkers, MarkerAngles, SyntheticElevationModel, SyntheticSession, swissCenter, \
+	focalLengthMillimeters, sensorWidthMillimeters, sensorWidthPixels, sensorHeightPixels
+
+
+
+# Problem sizes of the full and of the quick run
+fullScales = { 'points': [ 1000, 100000, 1000000 ], 'places': [ 10, 1000, 10000, 100000 ],
+	'markers': [ 5, 20, 100, 500 ], 'dem': [ 1000, 2000, 4000 ],
+	'images': [ 20, 200, 500 ], 'repeat': 5 }
+quickScales = { 'points': [ 1000, 100000 ], 'places': [ 10, 1000, 10000 ],
+	'markers': [ 5, 20, 100 ], 'dem': [ 1000, 2000 ],
+	'images': [ 20, 200 ], 'repeat': 3 }
+
+# Benchmarks by name; each is a generator yielding (parameters, function to
+# time, dict of additional results)
+benchmarks = []
+
+def Benchmark(name):
+	def decorator(function):
+		benchmarks.append((name, function))
+		return function
+	return decorator
+
+
+
+# Time function: it is called number times per repeat, with number chosen
+# so that a repeat takes at least minTime; returns (seconds per call of
+# each repeat, number)
+def Measure(function, repeat=5, minTime=0.05):
+	number = 1
+	while True:
+		start = time.perf_counter()
+		for i in range(number):
+			function()
+		elapsed = time.perf_counter() - start
+		if elapsed >= minTime or number >= (1 << 20):
+			break
+		number = min(1 << 20, number * max(2, int(1.2 * minTime / max(elapsed, 1e-6))))
+	times = [ elapsed / number ]
+	for r in range(repeat - 1):
+		start = time.perf_counter()
+		for i in range(number):
+			function()
+		times.append((time.perf_counter() - start) / number)
+	return (times, number)
+
+
+
+class Context:
+
+	def __init__(self, scales, seed, directory):
+		self.scales = scales
+		self.seed = seed
+		self.directory = directory
+		self.catalogs = {}
+
+	def Rng(self, *keys):
+		return np.random.default_rng([ self.seed ] + list(keys))
+
+	# Synthetic catalogs are created once per size
+	def Catalog(self, numPlaces):
+		if numPlaces not in self.catalogs:
+			self.catalogs[numPlaces] = SyntheticCatalog(numPlaces, self.Rng(numPlaces))
+		return self.catalogs[numPlaces]
+
+	# Largest catalog, used for all marker benchmarks
+	def MarkerCatalog(self):
+		return self.Catalog(max(self.scales['places']))
+
+	def Markers(self, numMarkers, noisePixels=2.0):
+		catalog = self.MarkerCatalog()
+		rng = self.Rng(numMarkers, 1)
+		(position, heading) = SyntheticPose(catalog, numMarkers, rng)
+		(markerList, indices) = SyntheticMarkers(catalog, position, heading, numMarkers, \
+			rng, noisePixels)
+		return (position, markerList)
+
+
+
+@Benchmark('projection.batch')
+def BenchProjectionBatch(context):
+	for n in context.scales['points']:
+		rng = context.Rng(n)
+		wgs = np.column_stack((rng.uniform(45.8, 47.8, n), rng.uniform(5.9, 10.5, n)))
+		yield ({ 'points': n }, lambda: ApproxSwissProj.WGStoCH(wgs), {})
+
+@Benchmark('projection.scalar')
+def BenchProjectionScalar(context):
+	n = 1000
+	rng = context.Rng(n)
+	wgs = np.column_stack((rng.uniform(45.8, 47.8, n), rng.uniform(5.9, 10.5, n)))
+	def Function():
+		for (lat, lon) in wgs:
+			ApproxSwissProj.WGS84toLV03(lat, lon, 0.0)
+	yield ({ 'points': n }, Function, {})
+
+@Benchmark('catalog.load')
+def BenchCatalogLoad(context):
+	for n in context.scales['places']:
+		filename = os.path.join(context.directory, 'places{0}.json'.format(n))
+		SaveCatalog(context.Catalog(n), filename)
+		yield ({ 'places': n }, lambda: Place.LoadListFromFile(filename), {})
+
+# Opening a binary catalog and looking up 100 keys
+@Benchmark('catalog.load_mapped')
+def BenchCatalogLoadMapped(context):
+	for n in context.scales['places']:
+		catalog = context.Catalog(n)
+		filename = os.path.join(context.directory, 'places{0}.places'.format(n))
+		MappedPlaceCatalog.Save(catalog, filename)
+		keys = [ catalog.Key(i) for i in context.Rng(n, 4).integers(0, n, 100) ]
+		def Function(filename=filename, keys=keys):
+			PlaceCatalog.LoadFromFile(filename).Indices(keys)
+		yield ({ 'places': n }, Function, {})
+
+@Benchmark('markers.get_positions')
+def BenchGetPositions(context):
+	catalog = context.MarkerCatalog()
+	for m in context.scales['markers']:
+		(position, markerList) = context.Markers(m)
+		yield ({ 'places': len(catalog), 'markers': m }, \
+			lambda: markerList.GetPositions(catalog), {})
+
+# As above, but with the cached positions invalidated before each call
+@Benchmark('markers.get_positions_uncached')
+def BenchGetPositionsUncached(context):
+	catalog = context.MarkerCatalog()
+	for m in context.scales['markers']:
+		(position, markerList) = context.Markers(m)
+		def Function(markerList=markerList):
+			markerList.Invalidate()
+			markerList.GetPositions(catalog)
+		yield ({ 'places': len(catalog), 'markers': m }, Function, {})
+
+@Benchmark('markers.load')
+def BenchMarkersLoad(context):
+	for m in context.scales['markers']:
+		(position, markerList) = context.Markers(m)
+		filename = os.path.join(context.directory, 'markers{0}.json'.format(m))
+		markerList.Save(filename)
+		loaded = MarkerList()
+		yield ({ 'markers': m }, lambda: loaded.Load(filename), {})
+
+@Benchmark('markers.save')
+def BenchMarkersSave(context):
+	for m in context.scales['markers']:
+		(position, markerList) = context.Markers(m)
+		filename = os.path.join(context.directory, 'saved{0}.json'.format(m))
+		yield ({ 'markers': m }, lambda: markerList.Save(filename), {})
+
+# Hit test of mouse positions as done by MyLabel.getIndexOfMarker, 1000
+# queries per call
+@Benchmark('markers.hit_test')
+def BenchHitTest(context):
+	for m in context.scales['markers']:
+		(position, markerList) = context.Markers(m)
+		grid = MarkerGrid()
+		grid.Build(markerList)
+		rng = context.Rng(m, 2)
+		queries = [ (float(x), float(y)) for (x, y) in zip(rng.uniform(0, 7360, 1000),
+			rng.uniform(0, 4912, 1000)) ]
+		def Function():
+			for (x, y) in queries:
+				grid.Nearest(x, y, 10.0)
+		yield ({ 'markers': m, 'queries': len(queries) }, Function, {})
+
+# All registered resection engines on noisy markers; also reports the
+# distance of the estimate to the true position
+@Benchmark('solver')
+def BenchSolver(context):
+	for m in context.scales['markers']:
+		(position, markerList) = context.Markers(m)
+		(Pn, angles) = MarkerAngles(markerList, context.MarkerCatalog())
+		for engine in sorted(Resection.engines.keys()):
+			solver = Resection.Create(engine)
+			result = solver.Solve(Pn, angles)
+			extra = { 'error': float(np.linalg.norm(result.position - position)),
+				'iterations': int(result.iterations), 'evaluations': int(result.evaluations) }
+			yield ({ 'engine': engine, 'markers': m }, \
+				lambda solver=solver, Pn=Pn, angles=angles: solver.Solve(Pn, angles), extra)
+
+
+# Full 360 degree horizon and visibility of places in DEMs of size x size
+# cells of 25m; the cache is cleared before each call
+@Benchmark('horizon')
+def BenchHorizon(context):
+	catalog = context.Catalog(1000)
+	for n in context.scales['dem']:
+		engine = HorizonEngine(SyntheticElevationModel(catalog, size=n), catalog)
+		position = catalog.ch1903[catalog.Nearest(swissCenter)[1][0]] + np.array([ 3000.0, 0.0 ])
+		def Horizon(engine=engine):
+			engine.horizons.clear()
+			engine.Horizon(position)
+		def Visible(engine=engine):
+			engine.visible.clear()
+			engine.VisiblePlaces(position)
+		yield ({ 'dem': n, 'what': 'horizon' }, Horizon, {})
+		yield ({ 'dem': n, 'what': 'visible' }, Visible,
+			{ 'visible': len(engine.VisiblePlaces(position)['indices']) })
+
+# Skyline of a synthetic 36MP JPEG: reduced decode, extraction with peak
+# detection and matching the peaks to 60 candidate places
+@Benchmark('skyline')
+def BenchSkyline(context):
+	from PIL import Image
+	(width, height) = (7360, 4912)
+	rng = context.Rng(width)
+	columns = np.arange(width)
+	skyline = height * (0.4 + 0.05 * np.sin(columns / 300.0) + 0.03 * np.sin(columns / 71.0))
+	rows = np.arange(height)[:, np.newaxis]
+	pixels = np.where(rows < skyline, 220 - 40 * rows // height, 90).astype(np.uint8)
+	filename = os.path.join(context.directory, 'skyline.jpg')
+	Image.fromarray(pixels).save(filename, quality=90)
+	(gray, scale) = DecodeReduced(filename)
+	def Extract():
+		(rows, strength) = ExtractSkyline(gray)
+		return SkylinePeaks(rows, strength)
+	peaks = Extract()
+	angles = np.radians(0.01 * peaks * scale[0])
+	azimuths = rng.uniform(0.0, 2.0 * np.pi, 60)
+	yield ({ 'what': 'decode', 'width': width }, lambda: DecodeReduced(filename), {})
+	yield ({ 'what': 'extract', 'width': gray.shape[1] }, Extract, { 'peaks': int(peaks.size) })
+	yield ({ 'what': 'match', 'places': azimuths.size }, lambda: MatchPeaks(angles, azimuths), {})
+
+# Joint resection of sessions with 15 markers per image; the true focal
+# length is 3% longer than the initial one; also reports the error of the
+# estimated focal length and the median position error
+@Benchmark('joint')
+def BenchJoint(context):
+	catalog = context.MarkerCatalog()
+	focalLengthPixels = focalLengthMillimeters * sensorWidthPixels / sensorWidthMillimeters
+	intrinsics = (1.03 * focalLengthPixels, sensorWidthPixels / 2.0 + 40.0, sensorHeightPixels / 2.0)
+	for n in context.scales['images']:
+		(markerLists, poses) = SyntheticSession(catalog, n, 15, context.Rng(n, 3), intrinsics)
+		data = [ MarkerPoints(markerList, catalog) for markerList in markerLists ]
+		def Solve(data=data):
+			return JointResection().Solve(data, focalLengthPixels, sensorWidthPixels / 2.0,
+				sensorHeightPixels / 2.0, sensorWidthPixels)
+		result = Solve()
+		errors = np.hypot(result.poses[:,0] - poses[:,0], result.poses[:,1] - poses[:,1])
+		yield ({ 'images': n, 'markers': 15 * n }, Solve,
+			{ 'focal_length_error': float(result.focalLengthPixels - intrinsics[0]),
+			'error': float(np.median(errors)), 'evaluations': int(result.evaluations) })
+
+
+
+def Metadata(quick):
+	try:
+		commit = subprocess.run([ 'git', 'rev-parse', 'HEAD' ], capture_output=True, \
+			text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+	except OSError:
+		commit = ''
+	return { 'commit': commit, 'created': time.time(), 'python': platform.python_version(),
+		'numpy': np.__version__, 'platform': platform.platform(),
+		'processor': platform.processor(), 'quick': quick }
+
+def RunBenchmarks(scales, seed, filters=None, log=sys.stderr):
+	results = []
+	with tempfile.TemporaryDirectory() as directory:
+		context = Context(scales, seed, directory)
+		for (name, function) in benchmarks:
+			if filters and not any(f in name for f in filters):
+				continue
+			for (params, timed, extra) in function(context):
+				(times, number) = Measure(timed, scales['repeat'])
+				record = { 'name': name, 'params': params, 'median': float(np.median(times)),
+					'min': float(np.min(times)), 'repeat': len(times), 'number': number }
+				record.update(extra)
+				results.append(record)
+				print('{0:<32} {1:<40} {2:>12}'.format(name, FormatParams(params),
+					FormatTime(record['median'])), file=log)
+	return results
+
+def FormatParams(params):
+	return ' '.join('{0}={1}'.format(key, params[key]) for key in sorted(params))
+
+def FormatTime(seconds):
+	for (unit, factor) in (('s', 1.0), ('ms', 1e-3), ('us', 1e-6)):
+		if seconds >= factor:
+			return '{0:.3f}{1}'.format(seconds / factor, unit)
+	return '{0:.1f}ns'.format(seconds / 1e-9)
+
+# Print ratio new/old of the median times of benchmarks found in both runs
+def Compare(old, new, threshold=1.1, out=sys.stdout):
+	oldResults = { (r['name'], FormatParams(r['params'])): r for r in old['results'] }
+	print('{0:<32} {1:<40} {2:>12} {3:>12} {4:>7}'.format('benchmark', 'parameters',
+		'old', 'new', 'ratio'), file=out)
+	for r in new['results']:
+		key = (r['name'], FormatParams(r['params']))
+		if key not in oldResults:
+			continue
+		ratio = r['median'] / oldResults[key]['median']
+		flag = ' slower' if ratio > threshold else (' faster' if ratio < 1.0 / threshold else '')
+		print('{0:<32} {1:<40} {2:>12} {3:>12} {4:>7.2f}{5}'.format(key[0], key[1],
+			FormatTime(oldResults[key]['median']), FormatTime(r['median']), ratio, flag), file=out)
+
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Run benchmarks of ImageTagger')
+	parser.add_argument('--quick', action='store_true', help='smaller problem sizes')
+	parser.add_argument('--filter', action='append',
+		help='only run benchmarks whose name contains this (may be repeated)')
+	parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic data')
+	parser.add_argument('--output', help='JSON file for the results (default: stdout)')
+	parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+	args = parser.parse_args(argv)
+
+	scales = quickScales if args.quick else fullScales
+	output = { 'metadata': Metadata(args.quick),
+		'results': RunBenchmarks(scales, args.seed, args.filter) }
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(output, f, indent=1)
+	elif not args.compare:
+		json.dump(output, sys.stdout, indent=1)
+	if args.compare:
+		with open(args.compare) as f:
+			Compare(json.load(f), output)
+	return 0
+
+
+
+if __name__ == '__main__':
+	sys.exit(main())
+
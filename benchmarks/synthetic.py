@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Synthetic data: catalogs of peaks, camera poses and marker sets which are
+# consistent with the geometry of the position estimation
+
+
+
+import json
+import numpy as np
+from placecatalog import PlaceCatalog
+from marker import Marker, MarkerList
+from resection import Resection
+from horizon import ElevationModel
+from jointresection import JointResection
+
+
+
+# Camera of all synthetic images: 24mm lens on a full frame sensor
+focalLengthMillimeters = 24.0
+sensorWidthMillimeters = 35.9
+sensorWidthPixels = 7360
+sensorHeightPixels = 4912
+
+# Roughly the center of Switzerland in CH1903
+swissCenter = np.array([ 660000.0, 185000.0 ])
+
+
+
+# Catalog of numPlaces peaks uniformly distributed in a disk
+def SyntheticCatalog(numPlaces, rng, center=swissCenter, radius=100000.0):
+	r = radius * np.sqrt(rng.uniform(0.0, 1.0, numPlaces))
+	phi = rng.uniform(0.0, 2.0 * np.pi, numPlaces)
+	ch1903 = np.asarray(center) + np.column_stack((r * np.cos(phi), r * np.sin(phi)))
+	heights = np.round(rng.uniform(500.0, 4500.0, numPlaces), 1)
+	names = [ 'Peak {0}'.format(i) for i in range(numPlaces) ]
+	return PlaceCatalog(names, heights, ch1903)
+
+# Write catalog in the format of mountains.json
+def SaveCatalog(catalog, filename):
+	nodes = [ { 'Name': name, 'Height': float(height), 'CH1903': [ float(p[0]), float(p[1]) ] } \
+		for (name, height, p) in zip(catalog.names, catalog.heights, catalog.ch1903) ]
+	with open(filename, 'w') as f:
+		json.dump(nodes, f, indent='\t')
+
+# Horizontal field of view of the synthetic camera in radians
+def FieldOfView():
+	return Resection.ImageAngles(sensorWidthPixels, focalLengthMillimeters, \
+		sensorWidthMillimeters, sensorWidthPixels)
+
+# Image column of an angle from the left border
+def ImageColumns(angles):
+	return Resection.ImageColumns(angles, focalLengthMillimeters, \
+		sensorWidthMillimeters, sensorWidthPixels)
+
+# Camera pose (position, heading) looking at at least numMarkers places of
+# the catalog; heading is the direction of the image center, counter-clockwise
+# from the CH1903 y axis like Resection directions
+def SyntheticPose(catalog, numMarkers, rng, maxDistance=30000.0, maxTries=1000):
+	for i in range(maxTries):
+		index = rng.integers(0, len(catalog))
+		position = catalog.ch1903[index] + rng.normal(0.0, 200.0, 2)
+		heading = rng.uniform(0.0, 2.0 * np.pi)
+		if len(VisiblePlaces(catalog, position, heading, maxDistance)) >= numMarkers:
+			return (position, heading)
+		# Widen the search for sparse catalogs
+		maxDistance *= 1.01
+	raise ValueError('No pose with {0} visible places found'.format(numMarkers))
+
+# Indices of places within the field of view and maxDistance of a pose,
+# from left to right
+def VisiblePlaces(catalog, position, heading, maxDistance):
+	fov = FieldOfView()
+	indices = catalog.WithinRadius(position, maxDistance)
+	indices = indices[catalog.Distances(position, indices) > 100.0]
+	delta = catalog.ch1903[indices] - position
+	# Angle from the left border of the image, increasing clockwise
+	angles = np.mod(heading + fov / 2.0 - np.arctan2(delta[:,1], delta[:,0]), 2.0 * np.pi)
+	# Keep a margin, so the noisy markers are still inside the image
+	visible = (angles > 0.01 * fov) & (angles < 0.99 * fov)
+	order = np.argsort(angles[visible])
+	return indices[visible][order]
+
+# Markers of numMarkers places seen from position; the exact image columns
+# are derived from the angles of Resection.ForwardTransform and disturbed by
+# Gaussian noise of noisePixels; returns (markerList, indices of places)
+def SyntheticMarkers(catalog, position, heading, numMarkers, rng, noisePixels=2.0, \
+	maxDistance=30000.0):
+	visible = VisiblePlaces(catalog, position, heading, maxDistance)
+	if len(visible) < numMarkers:
+		raise ValueError('Only {0} places visible'.format(len(visible)))
+	indices = np.sort(rng.choice(len(visible), numMarkers, replace=False))
+	indices = visible[indices]
+	Pn = catalog.ch1903[indices]
+	# Angles of all points relative to the leftmost point
+	angles = Resection.ForwardTransform(position, Pn)
+	delta = Pn[0] - position
+	leftAngle = np.mod(heading + FieldOfView() / 2.0 - np.arctan2(delta[1], delta[0]), \
+		2.0 * np.pi)
+	x = ImageColumns(leftAngle + angles)
+	x += rng.normal(0.0, noisePixels, numMarkers)
+	y = rng.uniform(0.2, 0.5, numMarkers) * sensorHeightPixels
+	markerList = MarkerList()
+	for i in range(numMarkers):
+		markerList.append(Marker(float(x[i]), float(y[i]), catalog.Key(indices[i])))
+	return (markerList, indices)
+
+# Positions and image angles of a marker list like PositionEstimation.Run
+def MarkerAngles(markerList, places):
+	(pixelX, Pn) = markerList.GetPositions(places)
+	angles = Resection.ImageAngles(pixelX, focalLengthMillimeters, \
+		sensorWidthMillimeters, sensorWidthPixels)
+	return (Pn, np.abs(angles - angles[0]))
+
+
+# Elevation model of size x size cells around center: a plain at baseHeight
+# with a Gaussian hill of width sigma (in m) at every place of the catalog
+def SyntheticElevationModel(catalog, center=swissCenter, size=2000, cellSize=25.0, \
+	baseHeight=500.0, sigma=1500.0):
+	origin = np.asarray(center) + np.array([ -0.5, 0.5 ]) * size * cellSize
+	ys = origin[0] + cellSize * np.arange(size)
+	xs = origin[1] - cellSize * np.arange(size)
+	heights = np.full((size, size), baseHeight, dtype=np.float32)
+	radius = int(np.ceil(3.0 * sigma / cellSize))
+	for i in catalog.WithinBox((ys[0], xs[-1]), (ys[-1], xs[0])):
+		(y, x) = catalog.ch1903[i]
+		column = int(round((y - origin[0]) / cellSize))
+		row = int(round((origin[1] - x) / cellSize))
+		rows = slice(max(0, row - radius), row + radius + 1)
+		columns = slice(max(0, column - radius), column + radius + 1)
+		d2 = np.square(xs[rows, np.newaxis] - x) + np.square(ys[np.newaxis, columns] - y)
+		hill = baseHeight + (catalog.heights[i] - baseHeight) * np.exp(-d2 / (2.0 * sigma * sigma))
+		np.maximum(heights[rows, columns], hill, out=heights[rows, columns])
+	return ElevationModel(heights, origin, cellSize)
+
+# Session of numImages images of one camera with true intrinsics
+# (focalLengthPixels, cx, cy) and markersPerImage markers each, with both
+# image coordinates disturbed by noisePixels; returns (list of marker
+# lists, true poses as in JointResection)
+def SyntheticSession(catalog, numImages, markersPerImage, rng, intrinsics, \
+	noisePixels=1.0, maxDistance=30000.0, maxTries=1000):
+	(width, height) = (sensorWidthPixels, sensorHeightPixels)
+	markerLists = []
+	poses = []
+	for i in range(maxTries):
+		if len(markerLists) == numImages:
+			break
+		index = rng.integers(0, len(catalog))
+		position = catalog.ch1903[index] + rng.normal(0.0, 200.0, 2)
+		pose = np.array([ position[0], position[1], catalog.heights[index] - rng.uniform(50.0, 800.0),
+			rng.uniform(0.0, 2.0 * np.pi), rng.normal(0.0, np.radians(2.0)) ])
+		indices = catalog.WithinRadius(position, maxDistance)
+		indices = indices[catalog.Distances(position, indices) > 500.0]
+		points = np.column_stack((catalog.ch1903[indices], catalog.heights[indices]))
+		(x, y) = JointResection.Project(*intrinsics, np.tile(pose, (indices.size, 1)), points)
+		# Only places in front of the camera project into the image
+		dx = points[:,0:2] - position
+		front = np.cos(pose[3] - np.arctan2(dx[:,1], dx[:,0])) > 0.2
+		visible = np.nonzero(front & (x > 0) & (x < width) & (y > 0) & (y < height))[0]
+		if visible.size < markersPerImage:
+			continue
+		visible = np.sort(rng.choice(visible, markersPerImage, replace=False))
+		x = x[visible] + rng.normal(0.0, noisePixels, visible.size)
+		y = y[visible] + rng.normal(0.0, noisePixels, visible.size)
+		markerLists.append(MarkerList(Marker(float(x[j]), float(y[j]), catalog.Key(indices[visible[j]])) \
+			for j in range(visible.size)))
+		poses.append(pose)
+	if len(markerLists) < numImages:
+		raise ValueError('Only {0} images with {1} visible places found'.format(len(markerLists),
+			markersPerImage))
+	return (markerLists, np.array(poses))
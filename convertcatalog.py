@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Converts a catalog of places in the format of mountains.json into a binary
+# catalog, which is memory mapped when loaded instead of parsed:
+#
+#   convertcatalog.py mountains.json [mountains.places]
+#
+# Binary catalogs are recognized by their content, they can be used
+# everywhere a catalog file is expected (--catalog, IMAGETAGGER_CATALOG);
+# mountains.places next to the program is used by default if it is not
+# older than mountains.json.
+
+
+
+import sys, os
+import argparse
+import time
+from placecatalog import PlaceCatalog, MappedPlaceCatalog
+
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Convert a catalog of places (.json) ' \
+		'into a memory mapped binary catalog')
+	parser.add_argument('input', help='catalog of places in the format of mountains.json')
+	parser.add_argument('output', nargs='?', default=None,
+		help='binary catalog (default: input with extension .places)')
+	args = parser.parse_args(argv)
+	output = args.output if args.output is not None else \
+		os.path.splitext(args.input)[0] + '.places'
+	if os.path.abspath(output) == os.path.abspath(args.input):
+		parser.error('Output would overwrite the input')
+
+	start = time.perf_counter()
+	catalog = PlaceCatalog.LoadFromFile(args.input)
+	loaded = time.perf_counter()
+	MappedPlaceCatalog.Save(catalog, output)
+	saved = time.perf_counter()
+	mapped = MappedPlaceCatalog(output)
+	opened = time.perf_counter()
+	print('Converted {0} places ({1} duplicates dropped) to {2}: loading took {3:.3f}s, ' \
+		'writing {4:.3f}s, opening the binary catalog {5:.3f}s'.format(len(mapped),
+		catalog.heights.size - len(mapped), output, loaded - start, saved - loaded,
+		opened - saved), file=sys.stderr)
+	return 0
+
+
+
+if __name__ == '__main__':
+	sys.exit(main())
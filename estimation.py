@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import numpy as np
+from place import Place
+from resection import Resection
+from jointresection import JointResection, MarkerPoints
+import ransac # Registers the robust engine
+from exif import ReadExifInfo, GetFocalLength, GetGpsPlace, GetCameraDatabase
+from instrumentation import Span, Count
+
+
+
+# Estimation of the camera position of an image from its markers;
+# needs no GUI and is used by the image viewer as well as by batch runs
+class PositionEstimation:
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.exifInfo = None
+		self.focalLengthMillimeters = None
+		self.sensorWidthMillimeters = None
+		self.sensorWidthPixels = None
+		self.gpsPlace = None
+		self.position = None
+		self.result = None
+		self.Pn = None
+		self.angles = None
+		self.pixelX = None
+		self.keys = None
+
+	# Run estimation for image filename with markers markerList referring
+	# to the places in places (dict or PlaceCatalog); callback receives the
+	# intermediate iterates of the solver (see Resection.callback)
+	@staticmethod
+	def Run(filename, markerList, places, engine='lm', callback=None):
+		estimation = PositionEstimation(filename)
+		# Decode EXIF data
+		exifInfo = ReadExifInfo(filename)
+		estimation.exifInfo = exifInfo
+		estimation.focalLengthMillimeters = GetFocalLength(exifInfo)
+		(estimation.sensorWidthMillimeters, estimation.sensorWidthPixels) = \
+			GetCameraDatabase().GetSensorGeometry(exifInfo)
+		estimation.gpsPlace = GetGpsPlace(exifInfo)
+
+		(pixelDiffs, Pn) = markerList.GetPositions(places)
+		if len(Pn) < 3:
+			raise ValueError('Position estimation needs at least three markers')
+		# Keys in the same order as the positions: sorted from left to right
+		estimation.keys = markerList.SortedKeys()
+		angles =Resection.ImageAngles(pixelDiffs, estimation.focalLengthMillimeters, \
+			estimation.sensorWidthMillimeters, estimation.sensorWidthPixels)
+		angles = np.abs(angles - angles[0]) # All angles relative to azimut to leftmost point
+		estimation.Pn = Pn
+		estimation.angles = angles
+		estimation.pixelX = pixelDiffs
+
+		solver = Resection.Create(engine)
+		solver.callback = callback
+		with Span('resection.solve', engine=engine, markers=len(angles)):
+			estimation.result = solver.Solve(Pn, angles)
+		Count('resection.iterations', estimation.result.iterations)
+		Count('resection.evaluations', estimation.result.evaluations)
+		estimation.position = Place(ch1903=estimation.result.position)
+		return estimation
+
+	# Distance between estimated position and GPS tag of image in m or None
+	def GpsError(self):
+		if self.gpsPlace is None:
+			return None
+		return self.gpsPlace.Distance(self.position)
+
+	# Keys of markers not consistent with the estimated position (only
+	# detected by robust engines)
+	def Outliers(self):
+		if self.result.inliers is None:
+			return []
+		return [ key for (key, inlier) in zip(self.keys, self.result.inliers) if not inlier ]
+
+	# Objective function on a size x size grid of positions around the
+	# estimate (+-halfWidth in m, by default derived from the standard
+	# deviation); only inliers are used if the engine detected outliers;
+	# returns (y coordinates, x coordinates, cost) in CH1903
+	def ObjectiveSurface(self, size=1000, halfWidth=None):
+		if halfWidth is None:
+			stddev = np.max(self.result.StdDev())
+			halfWidth = 2000.0 if not np.isfinite(stddev) else \
+				np.clip(10.0 * stddev, 200.0, 20000.0)
+		center = self.result.position
+		ys = np.linspace(center[0] - halfWidth, center[0] + halfWidth, size)
+		xs = np.linspace(center[1] - halfWidth, center[1] + halfWidth, size)
+		(Pn, angles) = (self.Pn, self.angles)
+		if self.result.inliers is not None:
+			(Pn, angles) = (Pn[self.result.inliers], angles[self.result.inliers])
+			angles = angles - angles[0]
+		cost = Resection.ObjFuncGrid(ys[np.newaxis,:], xs[:,np.newaxis], Pn, angles)
+		return (ys, xs, cost)
+
+	# Residuals of all angles in degrees
+	def Residuals(self):
+		return np.degrees(self.result.residuals)
+
+
+
+# Joint estimation of the camera positions of a session of images taken
+# with the same camera and lens setting, together with the effective focal
+# length and principal point; the EXIF data of the first image gives the
+# initial intrinsics, all images must have the size of the first one
+class JointEstimation:
+
+	def __init__(self, filenames):
+		self.filenames = filenames
+		self.focalLengthMillimeters = None
+		self.sensorWidthMillimeters = None
+		self.sensorWidthPixels = None
+		self.imageSize = None
+		self.gpsPlaces = None
+		self.result = None
+		self.errors = None
+
+	# Run estimation for images filenames with markers markerLists (one per
+	# image) referring to the places in places (dict or PlaceCatalog); images
+	# with unknown places are skipped, their error is kept in errors
+	@staticmethod
+	def Run(filenames, markerLists, places, solver=None):
+		estimation = JointEstimation(list(filenames))
+		exifInfos = [ ReadExifInfo(filename) for filename in estimation.filenames ]
+		exifInfo = exifInfos[0]
+		estimation.focalLengthMillimeters = GetFocalLength(exifInfo)
+		# Size of the JPEG itself, marker coordinates are in its pixels
+		(width, height) = (exifInfo.get('ImageWidth'), exifInfo.get('ImageHeight'))
+		if not width or not height:
+			raise ValueError('Cannot read the image size of {0}'.format(estimation.filenames[0]))
+		(estimation.sensorWidthMillimeters, estimation.sensorWidthPixels) = \
+			GetCameraDatabase().GetSensorGeometry(exifInfo, width)
+		estimation.imageSize = (width, height)
+		estimation.gpsPlaces = [ GetGpsPlace(info) for info in exifInfos ]
+
+		data = []
+		estimation.errors = [ None ] * len(estimation.filenames)
+		for (i, markerList) in enumerate(markerLists):
+			try:
+				if (exifInfos[i].get('ImageWidth'), exifInfos[i].get('ImageHeight')) != (width, height):
+					raise ValueError('Image size differs from {0}x{1}'.format(width, height))
+				data.append(MarkerPoints(markerList, places))
+				continue
+			except KeyError as e:
+				estimation.errors[i] = 'Unknown place {0}'.format(e)
+			except ValueError as e:
+				estimation.errors[i] = str(e)
+			data.append((np.zeros(0), np.zeros(0), np.zeros((0, 3))))
+		focalLengthPixels = estimation.focalLengthMillimeters * \
+			estimation.sensorWidthPixels / estimation.sensorWidthMillimeters
+		if solver is None:
+			solver = JointResection()
+		estimation.result = solver.Solve(data, focalLengthPixels, width / 2.0, height / 2.0, width)
+		return estimation
+
+	# Effective focal length in mm
+	def EstimatedFocalLength(self):
+		return self.result.focalLengthPixels * self.sensorWidthMillimeters / self.sensorWidthPixels
+
+	# Estimated position of image index or None if it was not solved
+	def Position(self, index):
+		if not self.result.Solved()[index]:
+			return None
+		return Place(ch1903=self.result.Position(index))
+
+	# Distance between estimated position and GPS tag of image index in m or None
+	def GpsError(self, index):
+		position = self.Position(index)
+		if position is None or self.gpsPlaces[index] is None:
+			return None
+		return self.gpsPlaces[index].Distance(position)
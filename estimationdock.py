@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import os
+from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtGui import QColor
+from PyQt5.QtWidgets import (QDockWidget, QWidget, QVBoxLayout, QHBoxLayout, QLabel,
+	QProgressBar, QPushButton, QTableWidget, QTableWidgetItem, QHeaderView)
+
+
+
+# Dock showing the progress of a running position estimation and the
+# estimated position with the residuals of all markers
+class EstimationDock(QDockWidget):
+
+	cancelRequested = pyqtSignal()
+
+	def __init__(self, parent=None):
+		super(EstimationDock, self).__init__('Position Estimation', parent)
+		self.setObjectName('EstimationDock')
+		self.estimation = None
+		widget = QWidget(self)
+		layout = QVBoxLayout(widget)
+
+		self.summary = QLabel('No estimation yet')
+		self.summary.setTextInteractionFlags(Qt.TextSelectableByMouse)
+		self.summary.setWordWrap(True)
+		layout.addWidget(self.summary)
+
+		progressLayout = QHBoxLayout()
+		self.progressBar = QProgressBar()
+		self.progressBar.setRange(0, 1)
+		self.progressBar.setTextVisible(False)
+		progressLayout.addWidget(self.progressBar)
+		self.cancelButton = QPushButton('Cancel')
+		self.cancelButton.setEnabled(False)
+		self.cancelButton.clicked.connect(self.cancelRequested)
+		progressLayout.addWidget(self.cancelButton)
+		layout.addLayout(progressLayout)
+		self.progressLabel = QLabel('')
+		layout.addWidget(self.progressLabel)
+
+		self.residualTable = QTableWidget(0, 2)
+		self.residualTable.setHorizontalHeaderLabels([ 'Marker', 'Residual (deg)' ])
+		self.residualTable.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+		self.residualTable.verticalHeader().setVisible(False)
+		self.residualTable.setEditTriggers(QTableWidget.NoEditTriggers)
+		layout.addWidget(self.residualTable)
+
+		self.surfaceButton = QPushButton('Show Objective Surface')
+		self.surfaceButton.setEnabled(False)
+		self.surfaceButton.clicked.connect(self.showSurface)
+		layout.addWidget(self.surfaceButton)
+		self.setWidget(widget)
+
+	def started(self, filename, engine):
+		self.summary.setText('Estimating position of {0} ({1}) ...'.format( \
+			os.path.basename(filename), engine))
+		self.progressBar.setRange(0, 0) # Busy indicator
+		self.progressLabel.setText('Reading EXIF data')
+		self.cancelButton.setEnabled(True)
+
+	def showProgress(self, iteration, position, cost):
+		text = 'Iteration {0}, cost {1:.3g}'.format(iteration, cost)
+		if position is not None:
+			text += ', at {0:.0f}, {1:.0f}'.format(position[0], position[1])
+		self.progressLabel.setText(text)
+
+	def stopped(self, message, completed=False):
+		self.progressBar.setRange(0, 1)
+		self.progressBar.setValue(1 if completed else 0)
+		self.cancelButton.setEnabled(False)
+		self.progressLabel.setText(message)
+		if not completed:
+			self.estimation = None
+			self.summary.setText('No result')
+			self.residualTable.setRowCount(0)
+			self.surfaceButton.setEnabled(False)
+
+	def showResult(self, estimation, engine):
+		self.estimation = estimation
+		result = estimation.result
+		ch1903 = estimation.position.CH1903()
+		wgs84 = estimation.position.WGS84()
+		stddev = result.StdDev()
+		lines = [
+			'<b>{0}</b> ({1})'.format(os.path.basename(estimation.filename), engine),
+			'CH1903: {0:.0f}, {1:.0f}'.format(ch1903[0], ch1903[1]),
+			'WGS84: {0:.5f}, {1:.5f}'.format(wgs84[0], wgs84[1]),
+			'Standard deviation: {0:.1f}m, {1:.1f}m'.format(stddev[0], stddev[1]),
+			'Focal length {0}mm, sensor {1}mm / {2} pixels'.format( \
+				estimation.focalLengthMillimeters, estimation.sensorWidthMillimeters, \
+				estimation.sensorWidthPixels),
+		]
+		if estimation.gpsPlace is not None:
+			lines.append('Distance to GPS tag: {0:.0f}m'.format(estimation.GpsError()))
+		outliers = estimation.Outliers()
+		if len(outliers) > 0:
+			lines.append('Probably wrong: {0}'.format(', '.join(outliers)))
+		self.summary.setText('<br>'.join(lines))
+		self.stopped('Finished after {0} iterations, {1} evaluations'.format( \
+			result.iterations, result.evaluations), True)
+		residuals = estimation.Residuals()
+		self.residualTable.setRowCount(len(residuals))
+		for (row, (key, residual)) in enumerate(zip(estimation.keys, residuals)):
+			keyItem = QTableWidgetItem(key)
+			residualItem = QTableWidgetItem('{0:.3f}'.format(residual))
+			residualItem.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+			if result.inliers is not None and not result.inliers[row]:
+				keyItem.setForeground(QColor(255, 128, 0))
+				residualItem.setForeground(QColor(255, 128, 0))
+			self.residualTable.setItem(row, 0, keyItem)
+			self.residualTable.setItem(row, 1, residualItem)
+		self.surfaceButton.setEnabled(True)
+
+	def showSurface(self):
+		if self.estimation is not None:
+			# Imported on first use, matplotlib takes long to load
+			from surfaceview import ObjectiveSurfaceView
+			ObjectiveSurfaceView(self.estimation, parent=self.window()).show()
+
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PyQt5.QtCore import QObject, pyqtSignal
+from resection import ResectionCancelled
+from estimation import PositionEstimation
+
+
+
+# Runs position estimations as cancellable jobs in a worker thread; progress
+# and results are reported by signals in the thread the runner lives in
+# (the GUI thread)
+class EstimationRunner(QObject):
+
+	# Job id, iteration, intermediate position (or None) and cost
+	progress = pyqtSignal(int, int, object, float)
+	finished = pyqtSignal(int, object)
+	failed = pyqtSignal(int, str)
+	cancelled = pyqtSignal(int)
+	# Internal: delivers results of the worker to the GUI thread
+	done = pyqtSignal(int, object, str)
+
+	def __init__(self, numThreads=1, progressInterval=0.05, parent=None):
+		super(EstimationRunner, self).__init__(parent)
+		self.executor = ThreadPoolExecutor(max_workers=numThreads)
+		self.progressInterval = progressInterval # in s
+		self.jobs = {} # job id -> cancel event
+		self.nextJobId = 1
+		self.done.connect(self.onDone)
+
+	# Start estimation for a snapshot of markerList; returns the job id.
+	# places may also be a function returning the catalog, it is called in
+	# the worker thread (e.g. GetPlaces, which waits for the catalog loader)
+	def submit(self, filename, markerList, places, engine='lm'):
+		jobId = self.nextJobId
+		self.nextJobId += 1
+		cancelEvent = threading.Event()
+		self.jobs[jobId] = cancelEvent
+		self.executor.submit(self.run, jobId, filename, markerList.Copy(), places, engine,
+			cancelEvent)
+		return jobId
+
+	# Cancel a job or all running jobs
+	def cancel(self, jobId=None):
+		for (id, cancelEvent) in self.jobs.items():
+			if jobId is None or id == jobId:
+				cancelEvent.set()
+
+	def isRunning(self):
+		return len(self.jobs) > 0
+
+	# Called in the worker thread
+	def run(self, jobId, filename, markerList, places, engine, cancelEvent):
+		lastReport = [ 0.0 ]
+		def Callback(iteration, P0, cost):
+			if cancelEvent.is_set():
+				raise ResectionCancelled()
+			now = time.monotonic()
+			if now - lastReport[0] >= self.progressInterval:
+				lastReport[0] = now
+				position = None if P0 is None else np.array(P0, dtype=float)
+				self.progress.emit(jobId, iteration, position, float(cost))
+		try:
+			if callable(places):
+				places = places()
+			if cancelEvent.is_set():
+				raise ResectionCancelled()
+			estimation = PositionEstimation.Run(filename, markerList, places, engine, Callback)
+			self.done.emit(jobId, estimation, '')
+		except ResectionCancelled:
+			self.done.emit(jobId, None, '')
+		except Exception as e:
+			self.done.emit(jobId, None, str(e) or e.__class__.__name__)
+
+	def onDone(self, jobId, estimation, error):
+		cancelEvent = self.jobs.pop(jobId, None)
+		if cancelEvent is None or cancelEvent.is_set():
+			self.cancelled.emit(jobId)
+		elif estimation is None:
+			self.failed.emit(jobId, error)
+		else:
+			self.finished.emit(jobId, estimation)
+
+	def shutdown(self):
+		self.cancel()
+		self.executor.shutdown(wait=False, cancel_futures=True)
+
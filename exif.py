@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import os
+import json
+import sqlite3
+import struct
+import threading
+import numpy as np
+from place import Place
+from instrumentation import Span, Count
+
+
+
+# EXIF tags we are interested in, by IFD
+ifd0Tags = { 0x010F: 'Make', 0x0110: 'Model' }
+exifIfdTags = { 0x920A: 'FocalLength', 0xA405: 'FocalLengthIn35mmFilm',
+	0xA002: 'PixelXDimension', 0xA003: 'PixelYDimension',
+	0xA20E: 'FocalPlaneXResolution', 0xA210: 'FocalPlaneResolutionUnit' }
+gpsIfdTags = { 0x0001: 'GPSLatitudeRef', 0x0002: 'GPSLatitude',
+	0x0003: 'GPSLongitudeRef', 0x0004: 'GPSLongitude' }
+exifIfdPointer = 0x8769
+gpsIfdPointer = 0x8825
+
+# Sizes of the TIFF field types in bytes
+typeSizes = { 1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8 }
+
+
+
+# Reads the EXIF (APP1) segment of a JPEG file without decoding the image,
+# returns the TIFF structure following the 'Exif\0\0' header or None
+def ReadExifSegment(filename):
+	with open(filename, 'rb') as f:
+		if f.read(2) != b'\xff\xd8':
+			return None
+		while True:
+			header = f.read(4)
+			if len(header) < 4 or header[0] != 0xFF:
+				return None
+			(marker, length) = struct.unpack('>BH', header[1:])
+			# Start of scan or end of image: no more metadata
+			if marker in (0xDA, 0xD9):
+				return None
+			if marker == 0xE1:
+				data = f.read(length - 2)
+				if data[0:6] == b'Exif\x00\x00':
+					return data[6:]
+			else:
+				f.seek(length - 2, os.SEEK_CUR)
+
+# Reads the size of a JPEG image from its start of frame header without
+# decoding the image, returns (width, height) or None
+def ReadJpegSize(filename):
+	with open(filename, 'rb') as f:
+		if f.read(2) != b'\xff\xd8':
+			return None
+		while True:
+			header = f.read(4)
+			if len(header) < 4 or header[0] != 0xFF:
+				return None
+			(marker, length) = struct.unpack('>BH', header[1:])
+			if marker in (0xDA, 0xD9):
+				return None
+			# Start of frame markers, except DHT, JPG and DAC in between
+			if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+				data = f.read(5)
+				if len(data) < 5:
+					return None
+				(height, width) = struct.unpack('>HH', data[1:5])
+				return (width, height)
+			f.seek(length - 2, os.SEEK_CUR)
+
+# Parses the TIFF structure of an EXIF segment, returns a dictionary with the
+# tags listed above; rationals are converted to float. Raises ValueError if
+# the segment is truncated or malformed
+def ParseExifSegment(data):
+	if len(data) < 8:
+		raise ValueError('Invalid EXIF segment')
+	if data[0:2] == b'II':
+		endian = '<'
+	elif data[0:2] == b'MM':
+		endian = '>'
+	else:
+		raise ValueError('Invalid TIFF header in EXIF segment')
+
+	def ReadValue(fieldType, count, offset):
+		if fieldType == 2:
+			return data[offset:offset+count].split(b'\x00', 1)[0].decode('latin-1').strip()
+		if fieldType in (5, 10):
+			fmt = endian + ('I' if fieldType == 5 else 'i') * (2 * count)
+			raw = struct.unpack_from(fmt, data, offset)
+			values = [ (1.0 * raw[2*i]) / raw[2*i+1] if raw[2*i+1] != 0 else 0.0 \
+				for i in range(count) ]
+		else:
+			fmt = endian + { 1: 'B', 3: 'H', 4: 'I', 7: 'B', 9: 'i' }[fieldType] * count
+			values = list(struct.unpack_from(fmt, data, offset))
+		return values[0] if count == 1 else values
+
+	def ReadIfd(offset, tags, exifInfo):
+		if not isinstance(offset, int) or offset < 8 or offset + 2 > len(data):
+			raise ValueError('Invalid EXIF segment')
+		pointers = {}
+		(numEntries,) = struct.unpack_from(endian + 'H', data, offset)
+		if offset + 2 + 12 * numEntries > len(data):
+			raise ValueError('Invalid EXIF segment')
+		for i in range(numEntries):
+			(tag, fieldType, count, valueOffset) = \
+				struct.unpack_from(endian + 'HHII', data, offset + 2 + 12 * i)
+			if tag not in tags and tag not in (exifIfdPointer, gpsIfdPointer):
+				continue
+			if fieldType not in typeSizes:
+				continue
+			# Values of up to 4 bytes are stored in the entry itself
+			if typeSizes[fieldType] * count <= 4:
+				valueOffset = offset + 2 + 12 * i + 8
+			if valueOffset + typeSizes[fieldType] * count > len(data):
+				continue
+			value = ReadValue(fieldType, count, valueOffset)
+			if tag in tags:
+				exifInfo[tags[tag]] = value
+			else:
+				pointers[tag] = value
+		return pointers
+
+	exifInfo = {}
+	(ifd0Offset,) = struct.unpack_from(endian + 'I', data, 4)
+	pointers = ReadIfd(ifd0Offset, ifd0Tags, exifInfo)
+	if exifIfdPointer in pointers:
+		ReadIfd(pointers[exifIfdPointer], exifIfdTags, exifInfo)
+	if gpsIfdPointer in pointers:
+		ReadIfd(pointers[gpsIfdPointer], gpsIfdTags, exifInfo)
+	return exifInfo
+
+
+
+# Persistent cache of parsed EXIF data; entries are keyed by path and
+# invalidated if size or modification time of the file change
+class ExifCache:
+
+	def __init__(self, filename):
+		self.filename = filename
+		directory = os.path.dirname(filename)
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory, exist_ok=True)
+		self.connection = sqlite3.connect(filename, timeout=30.0)
+		self.connection.execute('PRAGMA journal_mode=WAL')
+		self.connection.execute('CREATE TABLE IF NOT EXISTS exif (path TEXT PRIMARY KEY, ' \
+			'size INTEGER, mtime INTEGER, data TEXT)')
+		self.connection.commit()
+
+	@staticmethod
+	def DefaultFilename():
+		directory = os.environ.get('IMAGETAGGER_CACHE_DIR',
+			os.path.join(os.path.expanduser('~'), '.cache', 'imagetagger'))
+		return os.path.join(directory, 'exif.sqlite')
+
+	def Get(self, path, stat):
+		row = self.connection.execute('SELECT data FROM exif WHERE path=? AND size=? AND mtime=?',
+			(path, stat.st_size, stat.st_mtime_ns)).fetchone()
+		return None if row is None else json.loads(row[0])
+
+	def Put(self, path, stat, exifInfo):
+		self.connection.execute('INSERT OR REPLACE INTO exif VALUES (?, ?, ?, ?)',
+			(path, stat.st_size, stat.st_mtime_ns, json.dumps(exifInfo)))
+		self.connection.commit()
+
+	def Close(self):
+		self.connection.close()
+
+# Cache used by ReadExifInfo, opened on first use (once per process and
+# thread, as SQLite connections cannot be shared between threads)
+defaultCaches = threading.local()
+
+def GetDefaultCache():
+	if getattr(defaultCaches, 'pid', None) != os.getpid():
+		try:
+			defaultCaches.cache = ExifCache(ExifCache.DefaultFilename())
+		except (OSError, sqlite3.Error):
+			defaultCaches.cache = None
+		defaultCaches.pid = os.getpid()
+	return defaultCaches.cache
+
+
+
+# Decode EXIF tags of an image into a dictionary indexed by tag name,
+# using the persistent cache unless useCache is False; ImageWidth and
+# ImageHeight are the size of the JPEG itself (None if unknown), which
+# differs from the EXIF dimensions of resized or cropped exports
+def ReadExifInfo(filename, useCache=True):
+	path = os.path.abspath(filename)
+	stat = os.stat(path)
+	cache = GetDefaultCache() if useCache else None
+	if cache is not None:
+		try:
+			exifInfo = cache.Get(path, stat)
+			# Entries cached without the image size are read again
+			if exifInfo is not None and 'ImageWidth' in exifInfo:
+				Count('exif.cache_hits')
+				return exifInfo
+		except sqlite3.Error:
+			cache = None
+	Count('exif.cache_misses')
+	with Span('exif.decode'):
+		data = ReadExifSegment(path)
+		exifInfo = {} if data is None else ParseExifSegment(data)
+		(exifInfo['ImageWidth'], exifInfo['ImageHeight']) = ReadJpegSize(path) or (None, None)
+	if cache is not None:
+		try:
+			cache.Put(path, stat, exifInfo)
+		except sqlite3.Error:
+			pass
+	return exifInfo
+
+# Get focal length in mm from decoded EXIF data
+def GetFocalLength(exifInfo):
+	return float(exifInfo['FocalLength'])
+
+# Get place of GPS tag from decoded EXIF data or None if not available
+def GetGpsPlace(exifInfo):
+	if 'GPSLatitude' not in exifInfo or 'GPSLongitude' not in exifInfo:
+		return None
+	p = exifInfo['GPSLatitude']
+	lat = p[0] + (p[1] / 60.0) + (p[2] / 3600.0)
+	if exifInfo.get('GPSLatitudeRef') == 'S':
+		lat = -lat
+	p = exifInfo['GPSLongitude']
+	lon = p[0] + (p[1] / 60.0) + (p[2] / 3600.0)
+	if exifInfo.get('GPSLongitudeRef') == 'W':
+		lon = -lon
+	return Place(wgs84=np.array([lat, lon]))
+
+
+
+# Table of camera models with their sensor geometry
+class CameraDatabase:
+
+	# Used if the camera is unknown and EXIF data does not help either
+	defaultSensorWidth = 35.9
+	defaultSensorWidthPixels = 7360
+
+	def __init__(self, filename=None):
+		if filename is None:
+			filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cameras.json')
+		self.cameras = {}
+		if os.path.exists(filename):
+			with open(filename) as f:
+				for node in json.load(f):
+					self.cameras[CameraDatabase.MakeKey(node['Model'])] = \
+						(float(node['SensorWidth']), int(node['SensorWidthPixels']))
+
+	@staticmethod
+	def MakeKey(model):
+		return ' '.join(model.lower().split())
+
+	# Returns (sensor width in mm, image width in pixels) for the camera the
+	# image was taken with; the width is imageWidth if given, else the width
+	# of the JPEG (ImageWidth of ReadExifInfo). An image narrower than the
+	# native sensor is taken as downsized export: the full sensor width is
+	# mapped to the pixels of the image
+	def GetSensorGeometry(self, exifInfo, imageWidth=None):
+		if imageWidth is None:
+			imageWidth = exifInfo.get('ImageWidth') or exifInfo.get('PixelXDimension')
+		model = exifInfo.get('Model')
+		if model is not None and CameraDatabase.MakeKey(model) in self.cameras:
+			(sensorWidth, nativeWidth) = self.cameras[CameraDatabase.MakeKey(model)]
+			return (sensorWidth, int(imageWidth) if imageWidth else nativeWidth)
+		# Unknown camera: derive sensor width from focal plane resolution,
+		# which refers to the EXIF dimensions
+		width = exifInfo.get('PixelXDimension')
+		resolution = exifInfo.get('FocalPlaneXResolution')
+		unit = exifInfo.get('FocalPlaneResolutionUnit')
+		unitMillimeters = { 2: 25.4, 3: 10.0, 4: 1.0 }
+		if width and resolution and unit in unitMillimeters:
+			return (unitMillimeters[unit] * width / resolution, int(imageWidth or width))
+		return (CameraDatabase.defaultSensorWidth,
+			int(imageWidth) if imageWidth else CameraDatabase.defaultSensorWidthPixels)
+
+cameraDatabase = None
+
+def GetCameraDatabase():
+	global cameraDatabase
+	if cameraDatabase is None:
+		cameraDatabase = CameraDatabase()
+	return cameraDatabase
+
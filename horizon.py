@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Horizon prediction from a digital elevation model (DEM): the visible
+# horizon around a camera position by ray marching through the DEM, the
+# places of a catalog visible from there and their image positions, which
+# are suggested as markers. All positions are CH1903 (y east, x north),
+# azimuths are counter-clockwise from the y axis like Resection directions
+
+
+
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+from marker import Marker, MarkerList
+from resection import Resection
+from instrumentation import Span, Count
+
+
+
+# Earth radius and refraction coefficient for the curvature correction
+earthRadius = 6371000.0
+refraction = 0.13
+
+
+
+# Heights on a regular north-up grid: heights[row, column] is the height of
+# the cell center at (origin[0] + column * cellSize, origin[1] - row * cellSize)
+class ElevationModel:
+
+	def __init__(self, heights, origin, cellSize, noData=None):
+		heights = np.array(heights, dtype=np.float32)
+		if noData is not None:
+			heights[heights == noData] = np.nan
+		self.heights = heights
+		self.origin = np.asarray(origin, dtype=float)
+		self.cellSize = float(cellSize)
+
+	# Loads a DEM from a .npy file with a JSON sidecar of the same name
+	# ({ "Origin": [y, x], "CellSize": 25.0, "NoData": -9999 }) or from a
+	# single band GeoTIFF in CH1903 (LV03 or LV95)
+	@staticmethod
+	def Load(filename):
+		extension = os.path.splitext(filename)[1].lower()
+		if extension == '.npy':
+			return ElevationModel.LoadNumpy(filename)
+		if extension in ('.tif', '.tiff'):
+			return ElevationModel.LoadGeoTiff(filename)
+		raise ValueError('Unknown elevation model format "{0}"'.format(extension))
+
+	@staticmethod
+	def LoadNumpy(filename):
+		with open(os.path.splitext(filename)[0] + '.json') as f:
+			meta = json.load(f)
+		return ElevationModel(np.load(filename), meta['Origin'], meta['CellSize'],
+			meta.get('NoData'))
+
+	@staticmethod
+	def LoadGeoTiff(filename):
+		# Pillow is only needed for GeoTIFF files
+		from PIL import Image
+		with Image.open(filename) as image:
+			heights = np.asarray(image, dtype=np.float32)
+			scale = image.tag_v2.get(33550) # ModelPixelScaleTag
+			tiepoint = image.tag_v2.get(33922) # ModelTiepointTag
+			noData = image.tag_v2.get(42113) # GDAL_NODATA
+		if scale is None or tiepoint is None:
+			raise ValueError('{0} has no GeoTIFF georeference'.format(filename))
+		if abs(scale[0] - scale[1]) > 1e-6 * scale[0]:
+			raise ValueError('{0} has non-square cells'.format(filename))
+		# The tiepoint maps raster position (i, j) to the corner of a cell
+		origin = np.array([ tiepoint[3] + (0.5 - tiepoint[0]) * scale[0],
+			tiepoint[4] - (0.5 - tiepoint[1]) * scale[1] ])
+		# LV95 coordinates are LV03 coordinates plus 2000000/1000000
+		if origin[0] > 2000000.0:
+			origin -= np.array([ 2000000.0, 1000000.0 ])
+		if noData is not None:
+			noData = float(str(noData).strip('\x00 '))
+		return ElevationModel(heights, origin, scale[0], noData)
+
+	def Save(self, filename):
+		np.save(filename, self.heights)
+		meta = { 'Origin': [ float(self.origin[0]), float(self.origin[1]) ],
+			'CellSize': self.cellSize }
+		with open(os.path.splitext(filename)[0] + '.json', 'w') as f:
+			json.dump(meta, f, indent='\t')
+
+	# Corners (minimum y, minimum x, maximum y, maximum x) of the cell centers
+	def Bounds(self):
+		(rows, columns) = self.heights.shape
+		return (self.origin[0], self.origin[1] - (rows - 1) * self.cellSize,
+			self.origin[0] + (columns - 1) * self.cellSize, self.origin[1])
+
+	def Contains(self, position):
+		(minY, minX, maxY, maxX) = self.Bounds()
+		return minY <= position[0] <= maxY and minX <= position[1] <= maxX
+
+	# Bilinearly interpolated heights at positions (arrays of any equal
+	# shape), NaN outside the grid
+	def Heights(self, y, x):
+		(rows, columns) = self.heights.shape
+		column = (np.asarray(y, dtype=float) - self.origin[0]) / self.cellSize
+		row = (self.origin[1] - np.asarray(x, dtype=float)) / self.cellSize
+		c0 = np.floor(column)
+		r0 = np.floor(row)
+		inside = (c0 >= 0) & (c0 < columns - 1) & (r0 >= 0) & (r0 < rows - 1)
+		fc = (column - c0).astype(np.float32)
+		fr = (row - r0).astype(np.float32)
+		c0 = np.clip(c0, 0, columns - 2).astype(np.intp)
+		r0 = np.clip(r0, 0, rows - 2).astype(np.intp)
+		flat = self.heights.reshape(-1)
+		index = r0 * columns + c0
+		top = flat[index]
+		top += fc * (flat[index + 1] - top)
+		index += columns
+		bottom = flat[index]
+		bottom += fc * (flat[index + 1] - bottom)
+		top += fr * (bottom - top)
+		return np.where(inside, top, np.float32(np.nan))
+
+
+
+# Pose of a camera for the projection of places into its image: position,
+# azimuth of the left image border (heading) and elevation angle of the
+# horizontal image center line (pitch), both in radians
+class CameraPose:
+
+	def __init__(self, position, heading, focalLengthMillimeters, sensorWidthMillimeters, \
+		sensorWidthPixels, imageHeightPixels, pitch=0.0):
+		self.position = np.asarray(position, dtype=float)
+		self.heading = heading
+		self.focalLengthMillimeters = focalLengthMillimeters
+		self.sensorWidthMillimeters = sensorWidthMillimeters
+		self.sensorWidthPixels = sensorWidthPixels
+		self.imageHeightPixels = imageHeightPixels
+		self.pitch = pitch
+
+	# Pose of an image from its PositionEstimation: the leftmost marker is
+	# seen in direction result.direction
+	@staticmethod
+	def FromEstimation(estimation, imageHeightPixels):
+		leftAngle = Resection.ImageAngles(estimation.pixelX[0], estimation.focalLengthMillimeters, \
+			estimation.sensorWidthMillimeters, estimation.sensorWidthPixels)
+		return CameraPose(estimation.result.position, estimation.result.direction + leftAngle,
+			estimation.focalLengthMillimeters, estimation.sensorWidthMillimeters,
+			estimation.sensorWidthPixels, imageHeightPixels)
+
+	# Focal length in pixels
+	def FocalLengthPixels(self):
+		return self.focalLengthMillimeters * self.sensorWidthPixels / self.sensorWidthMillimeters
+
+	def FieldOfView(self):
+		return Resection.ImageAngles(self.sensorWidthPixels, self.focalLengthMillimeters, \
+			self.sensorWidthMillimeters, self.sensorWidthPixels)
+
+	# Image columns of azimuths; NaN outside the field of view
+	def Columns(self, azimuths):
+		angles = np.mod(self.heading - np.asarray(azimuths, dtype=float), 2.0 * np.pi)
+		columns = Resection.ImageColumns(np.where(angles <= self.FieldOfView(), angles, np.nan),
+			self.focalLengthMillimeters, self.sensorWidthMillimeters, self.sensorWidthPixels)
+		return columns
+
+	# Image rows of elevation angles
+	def Rows(self, elevations):
+		return self.imageHeightPixels / 2.0 - \
+			self.FocalLengthPixels() * np.tan(np.asarray(elevations, dtype=float) - self.pitch)
+
+	# Set the pitch from image rows of points with known elevation angles
+	# (e.g. of existing markers); the mean of the single estimates is used
+	def FitPitch(self, rows, elevations):
+		rows = np.asarray(rows, dtype=float)
+		if rows.size == 0:
+			return
+		self.pitch = float(np.mean(np.asarray(elevations, dtype=float) - \
+			np.arctan((self.imageHeightPixels / 2.0 - rows) / self.FocalLengthPixels())))
+
+
+
+# Horizon around a position: for every azimuth the elevation angle of the
+# horizon and the distance of the terrain point forming it
+class HorizonProfile:
+
+	def __init__(self, position, height, azimuths, elevations, distances):
+		self.position = position
+		self.height = height
+		self.azimuths = azimuths
+		self.elevations = elevations
+		self.distances = distances
+
+	# Horizon elevation at arbitrary azimuths (nearest sample)
+	def Elevation(self, azimuths):
+		step = self.azimuths[1] - self.azimuths[0]
+		index = np.rint(np.mod(np.asarray(azimuths, dtype=float), 2.0 * np.pi) / step)
+		return self.elevations[index.astype(int) % self.azimuths.size]
+
+
+
+# Visibility of places from positions in an elevation model; results are
+# computed at the center of square pose cells of cellSize and cached for the
+# maxCached most recently used cells
+class HorizonEngine:
+
+	def __init__(self, dem, places, cellSize=100.0, eyeHeight=2.0, resolution=np.radians(0.05), \
+		stepFactor=0.01, tolerance=np.radians(0.05), maxCached=32):
+		self.dem = dem
+		self.places = places
+		self.cellSize = cellSize
+		self.eyeHeight = eyeHeight
+		self.resolution = resolution
+		self.stepFactor = stepFactor
+		self.tolerance = tolerance
+		self.maxCached = maxCached
+		self.horizons = OrderedDict()
+		self.visible = OrderedDict()
+
+	# Sample distances of the rays: steps of one DEM cell up to 1/stepFactor
+	# cells, then growing geometrically by stepFactor up to maxDistance
+	def SampleDistances(self, maxDistance):
+		near = self.dem.cellSize / self.stepFactor
+		distances = np.arange(self.dem.cellSize, min(near, maxDistance), self.dem.cellSize)
+		if maxDistance > near:
+			count = int(np.ceil(np.log(maxDistance / near) / np.log1p(self.stepFactor)))
+			distances = np.concatenate((distances, near * (1.0 + self.stepFactor) ** np.arange(count + 1)))
+		return distances
+
+	# Distance from position to the farthest corner of the DEM
+	def MaxDistance(self, position):
+		(minY, minX, maxY, maxX) = self.dem.Bounds()
+		corners = np.array([ [ minY, minX ], [ minY, maxX ], [ maxY, minX ], [ maxY, maxX ] ])
+		return float(np.max(np.hypot(corners[:,0] - position[0], corners[:,1] - position[1])))
+
+	# Height of the camera: terrain plus eye height
+	def CameraHeight(self, position):
+		height = float(self.dem.Heights(position[0], position[1]))
+		if not np.isfinite(height):
+			raise ValueError('Position {0:.0f}/{1:.0f} is outside of the elevation model'.format(
+				position[0], position[1]))
+		return height + self.eyeHeight
+
+	# Tangent of the elevation angles of terrain points at heights relative
+	# to the camera, corrected for earth curvature and refraction
+	@staticmethod
+	def Slopes(heights, distances):
+		return (heights - (1.0 - refraction) * np.square(distances) / (2.0 * earthRadius)) / distances
+
+	def CellCenter(self, position):
+		cell = (int(np.floor(position[0] / self.cellSize)), int(np.floor(position[1] / self.cellSize)))
+		return (cell, (np.array(cell, dtype=float) + 0.5) * self.cellSize)
+
+	def Cached(self, cache, cell, function, center):
+		if cell in cache:
+			cache.move_to_end(cell)
+			Count('horizon.cache_hits')
+			return cache[cell]
+		Count('horizon.cache_misses')
+		result = cache[cell] = function(center)
+		while len(cache) > self.maxCached:
+			cache.popitem(last=False)
+		return result
+
+	# 360 degree HorizonProfile of the pose cell of position
+	def Horizon(self, position):
+		(cell, center) = self.CellCenter(position)
+		return self.Cached(self.horizons, cell, self.ComputeHorizon, center)
+
+	# Rays of all azimuths in blocks of about blockSize samples
+	def ComputeHorizon(self, position, blockSize=1<<20):
+		with Span('horizon.compute'):
+			height = self.CameraHeight(position)
+			azimuths = np.arange(0.0, 2.0 * np.pi, self.resolution)
+			distances = self.SampleDistances(self.MaxDistance(position))
+			curvature = (1.0 - refraction) * np.square(distances) / (2.0 * earthRadius)
+			elevations = np.empty(azimuths.size)
+			horizonDistances = np.empty(azimuths.size)
+			step = max(1, blockSize // distances.size)
+			for start in range(0, azimuths.size, step):
+				a = azimuths[start:start+step, np.newaxis]
+				heights = self.dem.Heights(position[0] + np.cos(a) * distances,
+					position[1] + np.sin(a) * distances)
+				heights -= height + curvature
+				heights /= distances
+				heights[np.isnan(heights)] = -np.inf
+				index = np.argmax(heights, axis=1)
+				elevations[start:start+step] = np.arctan(heights[np.arange(index.size), index])
+				horizonDistances[start:start+step] = distances[index]
+			return HorizonProfile(position, height, azimuths, elevations, horizonDistances)
+
+	# Places visible from the pose cell of position as a dict of arrays:
+	# 'indices' into the catalog, 'azimuths' and 'elevations' in radians and
+	# 'distances' in m, sorted by azimuth
+	def VisiblePlaces(self, position):
+		(cell, center) = self.CellCenter(position)
+		return self.Cached(self.visible, cell, self.ComputeVisiblePlaces, center)
+
+	# A place is visible if no terrain on the ray to it (excluding the
+	# surroundings of the place itself) is higher than the place
+	def ComputeVisiblePlaces(self, position):
+		with Span('horizon.visibility'):
+			height = self.CameraHeight(position)
+			maxDistance = self.MaxDistance(position)
+			indices = self.places.WithinRadius(position, maxDistance)
+			distances = self.places.Distances(position, indices)
+			near = distances > 2.0 * self.dem.cellSize
+			(indices, distances) = (indices[near], distances[near])
+			elevations = np.arctan(self.Slopes(self.places.heights[indices] - height, distances))
+			azimuths = self.Azimuths(position, indices)
+			samples = self.SampleDistances(maxDistance)
+			visible = np.ones(indices.size, dtype=bool)
+			step = max(1, (1 << 20) // samples.size)
+			for start in range(0, indices.size, step):
+				d = distances[start:start+step, np.newaxis]
+				a = azimuths[start:start+step, np.newaxis]
+				slopes = self.Slopes(self.dem.Heights(position[0] + np.cos(a) * samples,
+					position[1] + np.sin(a) * samples) - height, samples)
+				# Terrain around the place itself does not hide it
+				slopes[samples >= d * (1.0 - self.stepFactor) - 2.0 * self.dem.cellSize] = -np.inf
+				slopes[np.isnan(slopes)] = -np.inf
+				visible[start:start+step] = np.arctan(np.max(slopes, axis=1)) <= \
+					elevations[start:start+step] + self.tolerance
+			order = np.argsort(azimuths[visible])
+			return { 'indices': indices[visible][order], 'azimuths': azimuths[visible][order],
+				'elevations': elevations[visible][order], 'distances': distances[visible][order] }
+
+	def Azimuths(self, position, indices):
+		delta = self.places.ch1903[indices] - np.asarray(position, dtype=float)
+		return np.arctan2(delta[:,1], delta[:,0])
+
+	# Elevation angles of places (catalog indices) seen from position
+	def Elevations(self, position, indices):
+		(cell, center) = self.CellCenter(position)
+		height = self.CameraHeight(center)
+		distances = self.places.Distances(center, indices)
+		return np.arctan(self.Slopes(self.places.heights[indices] - height, distances))
+
+	# Markers for the places visible in the image of pose which are not yet
+	# in markerList, from left to right; the pitch of pose is fitted to the
+	# existing markers of catalog places first
+	def SuggestMarkers(self, pose, imageWidth, markerList=None):
+		with Span('horizon.suggest'):
+			if markerList is not None and len(markerList) > 0:
+				known = [ i for (i, key) in enumerate(markerList.Keys()) if key in self.places ]
+				if len(known) > 0:
+					indices = self.places.Indices([ markerList.Keys()[i] for i in known ])
+					pose.FitPitch(markerList.Y()[known], self.Elevations(pose.position, indices))
+			visible = self.VisiblePlaces(pose.position)
+			columns = pose.Columns(visible['azimuths'])
+			rows = pose.Rows(visible['elevations'])
+			existing = set(markerList.Keys()) if markerList is not None else set()
+			suggestions = MarkerList()
+			for i in np.argsort(columns):
+				key = self.places.Key(visible['indices'][i])
+				if np.isfinite(columns[i]) and 0.0 <= columns[i] < imageWidth and \
+					0.0 <= rows[i] < pose.imageHeightPixels and key not in existing:
+					suggestions.append(Marker(float(columns[i]), float(rows[i]), key))
+			return suggestions
+
+	# Image points (column, row) of the horizon within the image of pose
+	def HorizonLine(self, pose):
+		profile = self.Horizon(pose.position)
+		columns = pose.Columns(profile.azimuths)
+		inside = np.isfinite(columns) & np.isfinite(profile.elevations)
+		order = np.argsort(columns[inside])
+		return (columns[inside][order], pose.Rows(profile.elevations[inside][order]))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import os
+import math
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtCore import QObject, QSize, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader
+from marker import MarkerList
+from projectstore import SidecarStore
+from exif import ReadExifInfo, GetGpsPlace
+from tilepyramid import TilePyramid
+from instrumentation import Span, Timed
+
+
+
+# Image with everything needed to show it: the tile pyramid, the markers
+# from the marker store (sidecar or project database) and the GPS tag
+class LoadedImage:
+
+	def __init__(self, filename, store=None):
+		self.filename = filename
+		self.jsonFilename = os.path.splitext(filename)[0] + '.json'
+		self.store = SidecarStore() if store is None else store
+		self.pyramid = None
+		self.markerList = MarkerList()
+		self.markerVersion = None
+		self.gpsPlace = None
+
+	# Load image, markers and GPS tag; may be called from a worker thread.
+	# If viewportSize is given, the image is only decoded at the reduced
+	# resolution needed to fit it into the viewport (a preview pyramid)
+	@staticmethod
+	@Timed('image.load')
+	def Load(filename, store=None, viewportSize=None):
+		item = LoadedImage(filename, store)
+		if viewportSize is not None:
+			item.pyramid = LoadedImage.DecodePreview(filename, viewportSize)
+		else:
+			item.pyramid = LoadedImage.DecodePyramid(filename)
+		item.LoadMarkers()
+		try:
+			item.gpsPlace = GetGpsPlace(ReadExifInfo(filename))
+		except Exception:
+			item.gpsPlace = None
+		return item
+
+	# Full resolution pyramid of an image; may be called from a worker thread
+	@staticmethod
+	def DecodePyramid(filename):
+		with Span('image.decode'):
+			image = QImage(filename)
+		if image.isNull():
+			raise IOError('Cannot load {0}.'.format(filename))
+		pyramid = TilePyramid(image)
+		with Span('pyramid.build'):
+			pyramid.buildLevels()
+		return pyramid
+
+	# Largest JPEG DCT scale denominator (1, 2, 4 or 8) at which an image of
+	# imageSize still covers viewportSize when fitted into it
+	@staticmethod
+	def PreviewReduction(imageSize, viewportSize, maxReduction=8):
+		scale = min(viewportSize.width() / float(max(imageSize.width(), 1)),
+			viewportSize.height() / float(max(imageSize.height(), 1)))
+		reduction = 1
+		while reduction < maxReduction and 2 * reduction * scale <= 1.0:
+			reduction *= 2
+		return reduction
+
+	# Pyramid decoded at the reduced resolution for viewportSize; the JPEG
+	# decoder scales in the DCT domain, so this is much faster than decoding
+	# the full resolution
+	@staticmethod
+	def DecodePreview(filename, viewportSize):
+		reader = QImageReader(filename)
+		fullSize = reader.size()
+		reduction = LoadedImage.PreviewReduction(fullSize, viewportSize) \
+			if fullSize.isValid() else 1
+		if reduction == 1:
+			return LoadedImage.DecodePyramid(filename)
+		with Span('image.decode_preview', reduction=reduction):
+			reader.setScaledSize(QSize(int(math.ceil(fullSize.width() / reduction)),
+				int(math.ceil(fullSize.height() / reduction))))
+			image = reader.read()
+		if image.isNull():
+			raise IOError('Cannot load {0}.'.format(filename))
+		pyramid = TilePyramid(image, fullSize=fullSize)
+		pyramid.buildLevels()
+		return pyramid
+
+	def LoadMarkers(self):
+		self.markerVersion = self.store.GetMarkerVersion(self.filename)
+		self.markerList = MarkerList()
+		self.store.LoadMarkers(self.filename, self.markerList)
+
+	# Reload markers if they have been changed since they were loaded
+	def RefreshMarkers(self):
+		if self.store.GetMarkerVersion(self.filename) != self.markerVersion:
+			self.LoadMarkers()
+
+	def ByteCount(self):
+		return 0 if self.pyramid is None else self.pyramid.byteCount()
+
+
+
+# Least recently used cache of loaded images, bounded by the bytes of
+# image data of all entries
+class ImageCache:
+
+	def __init__(self, maxBytes):
+		self.maxBytes = maxBytes
+		self.numBytes = 0
+		self.items = OrderedDict()
+
+	def __contains__(self, filename):
+		return filename in self.items
+
+	def Get(self, filename):
+		entry = self.items.get(filename)
+		if entry is None:
+			return None
+		self.items.move_to_end(filename)
+		return entry[0]
+
+	def Put(self, filename, item):
+		self.Remove(filename)
+		numBytes = item.ByteCount()
+		self.items[filename] = (item, numBytes)
+		self.numBytes += numBytes
+		# Evict least recently used entries, but always keep the newest one
+		while self.numBytes > self.maxBytes and len(self.items) > 1:
+			(key, (oldItem, oldBytes)) = self.items.popitem(last=False)
+			self.numBytes -= oldBytes
+
+	def Remove(self, filename):
+		entry = self.items.pop(filename, None)
+		if entry is not None:
+			self.numBytes -= entry[1]
+
+
+
+# Loads images in a pool of worker threads; results are cached and reported
+# by signals in the thread the loader lives in (the GUI thread). Images
+# loaded as preview are decoded at full resolution in the background
+# afterwards, refined reports the full resolution pyramid
+class ImageLoader(QObject):
+
+	loaded = pyqtSignal(str, object)
+	failed = pyqtSignal(str, str)
+	refined = pyqtSignal(str, object)
+	# Internal: delivers results of the workers to the GUI thread
+	finished = pyqtSignal(str, object, str)
+	pyramidFinished = pyqtSignal(str, object)
+
+	def __init__(self, maxBytes=1024*1024*1024, numThreads=2, parent=None):
+		super(ImageLoader, self).__init__(parent)
+		self.cache = ImageCache(maxBytes)
+		self.store = SidecarStore()
+		self.executor = ThreadPoolExecutor(max_workers=numThreads)
+		self.pending = {}
+		self.wanted = set()
+		self.refining = {}
+		self.finished.connect(self.onFinished)
+		self.pyramidFinished.connect(self.onPyramidFinished)
+
+	# Request an image: emits loaded (or failed) when it is available,
+	# immediately if it is in the cache; with viewportSize a preview is
+	# loaded first if the image is not yet being loaded
+	def request(self, filename, viewportSize=None):
+		item = self.cache.Get(filename)
+		if item is not None:
+			item.RefreshMarkers()
+			self.loaded.emit(filename, item)
+			if item.pyramid.isPreview():
+				self.refine(filename)
+			return
+		self.wanted.add(filename)
+		self.submit(filename, viewportSize)
+
+	# Load an image into the cache without reporting it
+	def prefetch(self, filename):
+		if filename not in self.cache:
+			self.submit(filename)
+
+	# Change the store markers are loaded from; cached images are dropped
+	def setStore(self, store):
+		self.store = store
+		self.cache = ImageCache(self.cache.maxBytes)
+
+	# Forget about requested images that have not been loaded yet and drop
+	# full resolution decodes which have not been started
+	def cancelRequests(self):
+		self.wanted.clear()
+		for filename in [ filename for (filename, future) in self.refining.items() \
+			if future.cancel() ]:
+			del self.refining[filename]
+
+	def submit(self, filename, viewportSize=None):
+		if filename in self.pending:
+			return
+		future = self.executor.submit(LoadedImage.Load, filename, self.store, viewportSize)
+		self.pending[filename] = future
+		future.add_done_callback(lambda f: self.onDone(filename, f))
+
+	# Called in the worker thread
+	def onDone(self, filename, future):
+		try:
+			self.finished.emit(filename, future.result(), '')
+		except Exception as e:
+			self.finished.emit(filename, None, str(e))
+
+	def onFinished(self, filename, item, error):
+		self.pending.pop(filename, None)
+		if item is not None and item.store is not self.store:
+			# Store changed while loading
+			item.store = self.store
+			item.LoadMarkers()
+		if item is not None:
+			self.cache.Put(filename, item)
+		if filename in self.wanted:
+			self.wanted.discard(filename)
+			if item is None:
+				self.failed.emit(filename, error)
+			else:
+				item.RefreshMarkers()
+				self.loaded.emit(filename, item)
+		if item is not None and item.pyramid.isPreview():
+			self.refine(filename)
+
+	# Decode the full resolution of an image loaded as preview
+	def refine(self, filename):
+		if filename in self.refining:
+			return
+		future = self.executor.submit(LoadedImage.DecodePyramid, filename)
+		self.refining[filename] = future
+		future.add_done_callback(lambda f: self.onPyramidDone(filename, f))
+
+	# Called in the worker thread
+	def onPyramidDone(self, filename, future):
+		if future.cancelled():
+			return
+		try:
+			pyramid = future.result()
+		except Exception:
+			pyramid = None
+		self.pyramidFinished.emit(filename, pyramid)
+
+	# The cached item gets the full resolution pyramid, its markers are kept
+	def onPyramidFinished(self, filename, pyramid):
+		self.refining.pop(filename, None)
+		if pyramid is None:
+			return
+		item = self.cache.Get(filename)
+		if item is not None and item.pyramid.isPreview():
+			item.pyramid = pyramid
+			self.cache.Put(filename, item)
+		self.refined.emit(filename, pyramid)
+
+	def shutdown(self):
+		self.executor.shutdown(wait=False, cancel_futures=True)
+
@@ -3,89 +3,59 @@
 
 
 
+import time
+startTime = time.perf_counter() # For measuring the startup time
 import sys, os
+import argparse
 # Mathematical
 import numpy as np
-from scipy.optimize import minimize
-import matplotlib.pyplot as plt
-# JSON reader
-import json
-# Exif reader
-from PIL import Image
+from marker import Marker, MarkerList
+from placecatalog import BackgroundCatalog, DefaultCatalogFilename
+from horizon import ElevationModel, HorizonEngine, CameraPose
+from skyline import SkylineProposal
+from imageloader import ImageLoader
+from markergrid import MarkerGrid
+from projectstore import SidecarStore, ProjectStore
+from autosave import AutoSaver
+from estimationrunner import EstimationRunner
+from estimationdock import EstimationDock
+from thumbnaildock import ThumbnailDock
+from profilepanel import ProfileDock
+import instrumentation
+from instrumentation import Timed, Count
 # Qt
-from PIL.ExifTags import TAGS
-from place import Place
-from PyQt5.QtCore import QDir, QSize, QPoint, QRect, Qt, QTime
-from PyQt5.QtGui import QColor, QPen, QImage, QPainter, QPalette, QPixmap, QFont
+from PyQt5.QtCore import QDir, QSize, QPoint, QPointF, QRect, Qt, QTime, QTimer, pyqtSignal
+from PyQt5.QtGui import QColor, QPen, QImage, QPainter, QPalette, QPixmap, QFont, QPolygonF
 from PyQt5.QtWidgets import (QAction, QApplication, QFileDialog, QLabel, QLineEdit,
 	QMainWindow, QMenu, QMessageBox, QScrollArea, QSizePolicy, QDialog,
 	QGroupBox, QLayout, QVBoxLayout, QHBoxLayout, QComboBox, QPushButton)
 
 
 
-mountains = {}
-if os.path.exists('mountains.json'):
-	mountains = Place.LoadListFromFile('mountains.json')
+# Catalog of places, loaded in the background after the viewer is shown
+placeCatalog = None
 
+def LoadPlaces(filename=None):
+	global placeCatalog
+	placeCatalog = BackgroundCatalog(DefaultCatalogFilename() if filename is None else filename)
 
+# Returns the catalog, waits if it is still loading
+def GetPlaces():
+	if placeCatalog is None:
+		LoadPlaces()
+	return placeCatalog.Get()
 
-class Marker:
-	def __init__(self, x=None, y=None, key=''):
-		self.key = key
-		self.x = x
-		self.y = y
+# Elevation model for the horizon prediction: --dem or IMAGETAGGER_DEM;
+# loaded when markers are suggested for the first time
+elevationModelFilename = os.environ.get('IMAGETAGGER_DEM')
+horizonEngine = None
 
-	def SetPos(self, pos):
-		self.x = pos.x()
-		self.y = pos.y()
-
-	def Load(self, node):
-		self.key = node['Key']
-		self.x = float(node['X'])
-		self.y = float(node['Y'])
-
-class MarkerEncoder(json.JSONEncoder):
-	def default(self, obj):
-		if isinstance(obj, Marker):
-			return { 'Key': obj.key, 'X': obj.x, 'Y': obj.y }
-		# Let the base class default method raise the TypeError
-		return json.JSONEncoder.default(self, obj)
-
-class MarkerList(list):
-	def __init__(self):
-		super(MarkerList, self).__init__()
-
-	def Load(self, filename):
-		del self[:]
-		if (os.path.exists(filename)):
-			with open(filename, 'r') as f:
-				for node in json.load(f):
-					m = Marker()
-					m.Load(node)
-					self.append(m)
-
-	def Save(self, filename):
-		if len(self) > 0:
-			with open(filename, 'w') as f:
-				f.write(json.dumps(self, cls=MarkerEncoder, \
-					indent=4, separators=(',', ': '), sort_keys=True))
-		else:
-			if os.path.exists(filename):
-				os.remove(filename)
-
-	def GetPositions(self):
-		result = np.zeros((len(self), 3))
-		for i in range(len(self)):
-			# 1st row: Image X coordinates
-			result[i, 0] = self[i].x
-			# 2nd row: Place Y coordinate
-			result[i, 1] = mountains[self[i].key].CH1903()[0]
-			# 3rd row: Place X coordinate
-			result[i, 2] = mountains[self[i].key].CH1903()[1]
-		# Sort all rows by entries in first column: All points sorted from left to right
-		order = result[:,0].argsort()
-		result = np.take(result, order, 0)
-		return (result[:,0], result[:,1:3])
+# Returns the HorizonEngine or None if there is no elevation model
+def GetHorizonEngine():
+	global horizonEngine
+	if horizonEngine is None and elevationModelFilename:
+		horizonEngine = HorizonEngine(ElevationModel.Load(elevationModelFilename), GetPlaces())
+	return horizonEngine
 
 
 
@@ -118,9 +88,14 @@ class MarkerPropertyDialog(QDialog):
 		gb.setLayout(coordLayout)
 		mainLayout.addWidget(gb)
 
-		cboxLayout = QVBoxLayout()
+		cboxLayout = QHBoxLayout()
 		self.cbox = QComboBox(self)
+		self.cbox.setMinimumContentsLength(30)
 		cboxLayout.addWidget(self.cbox)
+		self.allButton = QPushButton('All Places', self)
+		self.allButton.setToolTip('Show all places of the catalog instead of the nearest ones')
+		self.allButton.clicked.connect(self.showAllPlaces)
+		cboxLayout.addWidget(self.allButton)
 		gb = QGroupBox('Marker key')
 		gb.setLayout(cboxLayout)
 		mainLayout.addWidget(gb)
@@ -136,78 +111,319 @@ class MarkerPropertyDialog(QDialog):
 		buttonLayout.addWidget(okButton)
 		mainLayout.addLayout(buttonLayout)
 
-	@staticmethod
-	def GetMarkerSelection(marker, places, parent=None):
-		dialog = MarkerPropertyDialog(parent)
+		# Function returning the keys of all places, called when they are shown
+		self.allPlaces = lambda: []
+
+	# Fill combo box with a list of (key, text) tuples in a single call
+	def setPlaces(self, items, currentKey):
+		self.cbox.clear()
+		self.cbox.addItems([ text for (key, text) in items ])
 		index = 0
-		for i in range(len(places)):
-			dialog.cbox.addItem(places[i])
-			if places[i] == marker.key:
+		for i in range(len(items)):
+			self.cbox.setItemData(i, items[i][0])
+			if items[i][0] == currentKey:
 				index = i
-		dialog.cbox.setCurrentIndex(index)
+		self.cbox.setCurrentIndex(index)
+
+	def showAllPlaces(self):
+		currentKey = self.cbox.currentData()
+		self.setPlaces([ (key, key) for key in self.allPlaces() ], currentKey)
+		self.allButton.setEnabled(False)
+
+	# Shows the suggested places; allPlaces is a function returning the keys
+	# of all places, it is only called if the user requests the list of all
+	# places (or if there are no suggestions)
+	@staticmethod
+	def GetMarkerSelection(marker, suggestions, allPlaces, parent=None):
+		dialog = MarkerPropertyDialog(parent)
+		dialog.allPlaces = allPlaces
+		items = list(suggestions)
+		if marker.key and marker.key not in [ key for (key, text) in items ]:
+			items.insert(0, (marker.key, marker.key))
+		if len(suggestions) == 0:
+			dialog.setPlaces([ (key, key) for key in allPlaces() ], marker.key)
+			dialog.allButton.setEnabled(False)
+		else:
+			dialog.setPlaces(items, marker.key)
 		dialog.xedit.setText(str(marker.x))
 		dialog.yedit.setText(str(marker.y))
 		result = dialog.exec_()
-		return (result == QDialog.Accepted, dialog.cbox.currentText())
+		key = dialog.cbox.currentData()
+		if key is None:
+			key = dialog.cbox.currentText()
+		return (result == QDialog.Accepted, key)
 
 
 
 class MyLabel(QLabel):
+
+	# Emitted with the filename and the number of markers after every change
+	markerCountChanged = pyqtSignal(str, int)
+
 	def __init__(self, parent=None):
 		super(MyLabel, self).__init__(parent)
 		self.setBackgroundRole(QPalette.Base)
 		self.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
-		self.setScaledContents(True)
+		self.pyramid = None
+		# Full resolution pyramid while a preview is shown, swapped in when
+		# the scale factor exceeds the resolution of the preview
+		self.fullPyramid = None
+		self.fitToWindow = False
 		self.filename = None
 		self.jsonFilename = None
+		self.markerStore = SidecarStore()
+		self.autoSaver = None
+		self.outlierKeys = set()
 		self.markerList = MarkerList()
+		# Last estimation of the image, markers suggested from the elevation
+		# model and the predicted horizon (image columns, rows)
+		self.estimation = None
+		self.suggestedMarkers = MarkerList()
+		self.horizonLine = None
 		self.showMarkers = True
 		self.scaleFactor = 1.0
 		self.radius = 10
 		self.grabIndex = None
+		self.grabPos = None
+		self.dragging = False
 		self.clickTimer = QTime()
+		# Spatial index of markers in image coordinates and label widths
+		self.markerGrid = MarkerGrid()
+		self.labelWidths = {}
+		self.maxLabelWidth = 0
+		# Reference position for suggesting places and the list of
+		# suggestions, both in CH1903 coordinates
+		self.referencePosition = None
+		self.suggestions = None
+		self.numSuggestions = 40
+		self.suggestionRadius = 100000.0
+		self.resectionEngine = 'lm'
 	
-	def open(self, filename):
-		# Load image data
-		image = QImage(filename)
-		if image.isNull():
-			QMessageBox.information(self, 'Image Viewer', 'Cannot load %s.' % filename)
-			return		
-		self.setPixmap(QPixmap.fromImage(image))
-		self.filename = filename
-		self.jsonFilename = os.path.splitext(filename)[0] + '.json'
-		self.markerList.Load(self.jsonFilename)
+	# Show an image loaded by LoadedImage.Load
+	def setImage(self, item):
+		if self.pyramid is not None and self.pyramid is not item.pyramid:
+			self.pyramid.releaseTiles()
+		self.pyramid = item.pyramid
+		self.fullPyramid = None
+		self.grabIndex = None
+		self.updateFitScale()
+		self.update()
+		self.filename = item.filename
+		self.jsonFilename = item.jsonFilename
+		self.markerStore = item.store
+		self.markerList = item.markerList
+		self.outlierKeys = set()
+		self.estimation = None
+		self.suggestedMarkers = MarkerList()
+		self.horizonLine = None
+		self.markerGrid.Build(self.markerList)
+		for marker in self.markerList:
+			self.getLabelWidth(marker.key)
+		# Use GPS tag of image as reference position for place suggestions
+		self.referencePosition = None
+		self.suggestions = None
+		if item.gpsPlace is not None:
+			self.setReferencePosition(item.gpsPlace.CH1903())
+
+	def setReferencePosition(self, position):
+		self.referencePosition = np.asarray(position, dtype=float)
+		self.suggestions = None
+		self.getSuggestions()
+
+	# List of (key, text) of places nearest to the reference position; if there
+	# is no reference position, the places of the markers already set are used.
+	# With an estimated pose, places in view are listed before the others
+	def getSuggestions(self):
+		if self.suggestions is not None:
+			return self.suggestions
+		places = GetPlaces()
+		if len(places) == 0:
+			return []
+		position = self.referencePosition
+		if position is None:
+			keys = [ marker.key for marker in self.markerList if marker.key in places ]
+			if len(keys) == 0:
+				return []
+			position = np.mean(places.ch1903[places.Indices(keys)], 0)
+		indices = places.WithinRadius(position, self.suggestionRadius)
+		if len(indices) == 0:
+			(distances, indices) = places.Nearest(position, self.numSuggestions)
+		# Places in the field of view of the estimated pose come first; both
+		# groups stay sorted by distance
+		if self.estimation is not None:
+			pose = CameraPose.FromEstimation(self.estimation, self.pyramid.height())
+			delta = places.ch1903[indices] - pose.position[0:2]
+			outside = np.isnan(pose.Columns(np.arctan2(delta[:,1], delta[:,0])))
+			indices = indices[np.argsort(outside, kind='stable')]
+		indices = indices[:self.numSuggestions]
+		distances = places.Distances(position, indices)
+		bearings = places.Bearings(position, indices)
+		suggestions = [ (places.Key(i), '{0} ({1:.1f} km, {2:.0f}\u00b0)'.format( \
+			places.Key(i), d / 1000.0, b)) for (i, d, b) in zip(indices, distances, bearings) ]
+		# Cache suggestions only if they do not depend on the markers
+		if self.referencePosition is not None:
+			self.suggestions = suggestions
+		return suggestions
 
 	def save(self):
-		if self.jsonFilename is not None:
-			self.markerList.Save(self.jsonFilename)
+		if self.filename is None:
+			return
+		if self.autoSaver is not None:
+			self.autoSaver.Schedule(self.markerStore, self.filename, self.markerList, delay=0.0)
+		else:
+			self.markerStore.SaveMarkers(self.filename, self.markerList)
+
+	# Keys of markers not consistent with the others, probably tagged with
+	# the wrong place (from a robust check of the markers)
+	def setOutlierKeys(self, keys):
+		self.outlierKeys = set(keys)
+		self.update()
+
+	# Suggest markers for the places predicted to be visible by engine (a
+	# HorizonEngine) from the estimated pose; returns their number
+	def suggestMarkers(self, engine):
+		if self.estimation is None:
+			self.setSuggestedMarkers(MarkerList(), None)
+		else:
+			pose = CameraPose.FromEstimation(self.estimation, self.pyramid.height())
+			self.setSuggestedMarkers(engine.SuggestMarkers(pose, self.pyramid.width(),
+				self.markerList), engine.HorizonLine(pose))
+		return len(self.suggestedMarkers)
+
+	# Suggest markers for the peaks of the skyline of the image, seen from
+	# the estimated position or the GPS position; engine (a HorizonEngine or
+	# None) restricts the candidates to visible places; returns their number
+	def detectSkylineMarkers(self, engine):
+		position = self.referencePosition
+		heading = None
+		if self.estimation is not None:
+			pose = CameraPose.FromEstimation(self.estimation, self.pyramid.height())
+			(position, heading) = (pose.position, pose.heading)
+		if position is None:
+			raise ValueError('No position, estimate it or use an image with GPS tag')
+		proposal = SkylineProposal.Run(self.filename, GetPlaces(), position[0:2], heading, engine)
+		existing = set(self.markerList.Keys())
+		self.setSuggestedMarkers(MarkerList(marker for marker in proposal.markerList \
+			if marker.key not in existing), (proposal.skylineX, proposal.skylineY))
+		return len(self.suggestedMarkers)
+
+	# Show suggested markers and a line (image columns, rows) or None
+	def setSuggestedMarkers(self, markerList, line):
+		self.suggestedMarkers = markerList
+		self.horizonLine = line
+		for marker in self.suggestedMarkers:
+			self.getLabelWidth(marker.key)
+		self.update()
+
+	# Add all suggested markers to the markers of the image
+	def acceptSuggestedMarkers(self):
+		if len(self.suggestedMarkers) == 0:
+			return
+		for marker in self.suggestedMarkers:
+			self.markerList.append(marker)
+		self.suggestedMarkers = MarkerList()
+		self.markerGrid.Build(self.markerList)
+		self.update()
+		self.markersChanged()
+
+	# Called after every change of the markers
+	def markersChanged(self):
+		if self.autoSaver is not None and self.filename is not None:
+			self.autoSaver.Schedule(self.markerStore, self.filename, self.markerList)
+		if self.filename is not None:
+			self.markerCountChanged.emit(self.filename, len(self.markerList))
 
 	def getScaleFactor(self):
 		return self.scaleFactor
 
+	def sizeHint(self):
+		if self.pyramid is None:
+			return super(MyLabel, self).sizeHint()
+		return self.scaleFactor * self.pyramid.size()
+
 	def normalSize(self):
 		self.scaleFactor = 1.0
+		self.updateResolution()
 		self.adjustSize()
 
 	def scale(self, factor):
 		self.scaleFactor *= factor
-		self.resize(self.scaleFactor * self.pixmap().size())
+		self.updateResolution()
+		self.resize(self.scaleFactor * self.pyramid.size())
+
+	# Full resolution pyramid of the preview shown, same size in image
+	# coordinates as the preview
+	def refineImage(self, pyramid):
+		if self.pyramid is not None and self.pyramid.isPreview() and \
+			pyramid.size() == self.pyramid.size():
+			self.fullPyramid = pyramid
+			self.updateResolution()
+
+	# Swap in the full resolution as soon as the preview is not sufficient
+	def updateResolution(self):
+		if self.fullPyramid is not None and self.scaleFactor > self.pyramid.maxScale():
+			self.pyramid.releaseTiles()
+			self.pyramid = self.fullPyramid
+			self.fullPyramid = None
+			self.update()
+
+	# In fit to window mode the label is resized by the scroll area and the
+	# image is scaled to fit into the label keeping its aspect ratio
+	def setFitToWindow(self, fitToWindow):
+		self.fitToWindow = fitToWindow
+		self.updateFitScale()
+
+	def updateFitScale(self):
+		if self.fitToWindow and self.pyramid is not None:
+			self.scaleFactor = min(self.width() / float(self.pyramid.width()),
+				self.height() / float(self.pyramid.height()))
+			self.updateResolution()
+			self.update()
+
+	def resizeEvent(self, event):
+		super(MyLabel, self).resizeEvent(event)
+		self.updateFitScale()
 	
 	def deleteAllMarkers(self):
-		self.markerList = []
+		self.markerList = MarkerList()
+		self.markerGrid.Clear()
+		self.update()
+		self.markersChanged()
 	
 	def toggleShowMarkers(self):
 		self.showMarkers = not self.showMarkers
 		self.update()
+
+	# Width of the text of a marker label in pixels, cached per key
+	def getLabelWidth(self, key):
+		width = self.labelWidths.get(key)
+		if width is None:
+			width = self.fontMetrics().horizontalAdvance(key)
+			self.labelWidths[key] = width
+			self.maxLabelWidth = max(self.maxLabelWidth, width)
+		return width
+
+	# Rectangle in widget coordinates covered by a marker and its label
+	def getMarkerRect(self, marker):
+		x = marker.x * self.scaleFactor
+		y = marker.y * self.scaleFactor
+		pad = 3
+		metrics = self.fontMetrics()
+		circle = QRect(int(x - self.radius - pad), int(y - self.radius - pad),
+			2 * (self.radius + pad) + 1, 2 * (self.radius + pad) + 1)
+		label = QRect(int(x + 1.5 * self.radius) - pad, int(y) - metrics.ascent() - pad,
+			self.getLabelWidth(marker.key) + 2 * pad, metrics.height() + 2 * pad)
+		return circle.united(label)
+
+	# Repaint only the area of the marker with index
+	def updateMarker(self, index):
+		self.update(self.getMarkerRect(self.markerList[index]))
 	
+	@Timed('label.hit_test')
 	def getIndexOfMarker(self, event):
 		pos = event.pos() / self.scaleFactor
-		for i in range(len(self.markerList)):
-			dx = self.markerList[i].x - pos.x()
-			dy = self.markerList[i].y - pos.y()
-			if self.scaleFactor * np.sqrt(dx * dx + dy * dy) <= self.radius:
-				return (pos, i)
-		return (pos, None)
+		index = self.markerGrid.Nearest(pos.x(), pos.y(), self.radius / self.scaleFactor)
+		return (pos, index)
 
 	def mousePressEvent(self, event):
 		if not event.button() == Qt.LeftButton:
@@ -215,10 +431,31 @@ class MyLabel(QLabel):
 		if not self.showMarkers:
 			return
 		self.clickTimer.start()
+		self.grabPos = event.pos()
+		self.dragging = False
 		(pos, index) = self.getIndexOfMarker(event)
 		if index is not None:
 			self.grabIndex = index;
 
+	# Move grabbed marker while dragging, only the old and the new area of
+	# the marker are repainted
+	def moveGrabbedMarker(self, pos):
+		marker = self.markerList[self.grabIndex]
+		dirty = self.getMarkerRect(marker)
+		marker.SetPos(pos)
+		self.markerGrid.Move(self.grabIndex, marker.x, marker.y)
+		self.update(dirty.united(self.getMarkerRect(marker)))
+
+	def mouseMoveEvent(self, event):
+		if self.grabIndex is None or not (event.buttons() & Qt.LeftButton):
+			return
+		if not self.dragging:
+			# Do not move markers by the jitter of clicks and double clicks
+			if (event.pos() - self.grabPos).manhattanLength() < QApplication.startDragDistance():
+				return
+			self.dragging = True
+		self.moveGrabbedMarker(event.pos() / self.scaleFactor)
+
 	def mouseReleaseEvent(self, event):
 		if not event.button() == Qt.LeftButton:
 			return
@@ -226,12 +463,13 @@ class MyLabel(QLabel):
 			return
 		if self.grabIndex is None:
 			return
-		if self.clickTimer.elapsed() < 100:
+		if self.clickTimer.elapsed() < 100 and not self.dragging:
 			return # Filter released events caused by double clicks
 		(pos, index) = self.getIndexOfMarker(event)
-		self.markerList[self.grabIndex].SetPos(pos)
+		self.moveGrabbedMarker(pos)
 		self.grabIndex = None
-		self.update()
+		self.dragging = False
+		self.markersChanged()
 
 	def mouseDoubleClickEvent(self, event):
 		if not event.button() == Qt.LeftButton:
@@ -239,92 +477,82 @@ class MyLabel(QLabel):
 		if not self.showMarkers:
 			return
 		self.grabIndex = None
+		self.dragging = False
 		(pos, index) = self.getIndexOfMarker(event)
 		if index is None:
 			self.markerList.append(Marker(pos.x(), pos.y()))
 			index = len(self.markerList) - 1
+			self.markerGrid.Insert(index, pos.x(), pos.y())
 		(accepted, markerKey) = MarkerPropertyDialog.GetMarkerSelection(self.markerList[index],
-			sorted(mountains.keys()), self)
+			self.getSuggestions(), GetPlaces().SortedKeys, self)
+		dirty = self.getMarkerRect(self.markerList[index])
 		if accepted:
 			self.markerList[index].key = markerKey
+			dirty = dirty.united(self.getMarkerRect(self.markerList[index]))
 		else:
 			del self.markerList[index]
-		self.update()
+			# Indices of all following markers change
+			self.markerGrid.Build(self.markerList)
+		self.update(dirty)
+		self.markersChanged()
 
+	@Timed('label.paint')
 	def paintEvent(self, event):
 		super(MyLabel, self).paintEvent(event)
-		if self.showMarkers and self.pixmap() is not None:
-			painter = QPainter(self)
+		if self.pyramid is None:
+			return
+		painter = QPainter(self)
+		exposed = event.rect()
+		self.pyramid.paint(painter, self.scaleFactor, exposed)
+		if self.showMarkers:
 			painter.setRenderHint(QPainter.Antialiasing, True)
-			painter.setPen(QPen(QColor(255, 0, 0, 255), 3))
-			for marker in self.markerList:
+			markerPen = QPen(QColor(255, 0, 0, 255), 3)
+			outlierPen = QPen(QColor(255, 160, 0, 255), 3)
+			# Only markers which may reach into the exposed rectangle are painted
+			margin = 3 + 2.5 * self.radius + self.fontMetrics().height() + self.maxLabelWidth
+			s = self.scaleFactor
+			indices = self.markerGrid.QueryRect((exposed.left() - margin) / s,
+				(exposed.top() - margin) / s, (exposed.right() + margin) / s,
+				(exposed.bottom() + margin) / s)
+			Count('paint.markers', len(indices))
+			for index in indices:
+				marker = self.markerList[index]
+				painter.setPen(outlierPen if marker.key in self.outlierKeys else markerPen)
 				x = marker.x * self.scaleFactor - self.radius
 				y = marker.y * self.scaleFactor - self.radius
-				painter.drawEllipse(QRect(x, y, 2*self.radius, 2*self.radius))
+				painter.drawEllipse(QRect(int(x), int(y), 2*self.radius, 2*self.radius))
 				x = marker.x * self.scaleFactor + 1.5 * self.radius
 				y = marker.y * self.scaleFactor
-				painter.drawText(QPoint(x, y), marker.key)
+				painter.drawText(QPoint(int(x), int(y)), marker.key)
+			self.paintSuggestions(painter)
+
+	# Predicted horizon and suggested markers (dashed, not editable)
+	def paintSuggestions(self, painter):
+		s = self.scaleFactor
+		if self.horizonLine is not None and len(self.horizonLine[0]) > 1:
+			painter.setPen(QPen(QColor(0, 200, 255, 160), 1))
+			painter.drawPolyline(QPolygonF([ QPointF(x * s, y * s) \
+				for (x, y) in zip(*self.horizonLine) ]))
+		suggestionPen = QPen(QColor(0, 200, 255, 255), 2, Qt.DashLine)
+		painter.setPen(suggestionPen)
+		for marker in self.suggestedMarkers:
+			x = marker.x * s - self.radius
+			y = marker.y * s - self.radius
+			painter.drawEllipse(QRect(int(x), int(y), 2*self.radius, 2*self.radius))
+			painter.drawText(QPoint(int(marker.x * s + 1.5 * self.radius), int(marker.y * s)),
+				marker.key)
 	
-	def estimatePosition(self):
-		# Decode EXIF data
-		image = Image.open(self.filename)
-		exifInfo = {}
-		for tag, value in image._getexif().items():
-			decoded = TAGS.get(tag, tag)
-			exifInfo[decoded] = value
-		focalLengthMillimeters = (1.0 * exifInfo['FocalLength'][0]) / exifInfo['FocalLength'][1]
-		print('Focal length {0} mm'.format(focalLengthMillimeters))
-		sensorWidthMillimeters = 35.9 # TODO: Read from EXIF
-		print('Sensor width {0} mm'.format(sensorWidthMillimeters))
-		sensorWidthPixels = 7360 # TODO: Read from EXIF
-		print('Sensor width {0} pixels'.format(sensorWidthPixels))
-
-		gpsPlace = None
-		if 'GPSInfo' in exifInfo:
-			gpsInfo = exifInfo['GPSInfo']
-			p = gpsInfo[2]
-			lat = (p[0][0] / p[0][1]) + (p[1][0] / (60.0 * p[1][1])) + (p[2][0] / (3600.0 * p[2][1]))
-			p = gpsInfo[4]
-			lon = (p[0][0] / p[0][1]) + (p[1][0] / (60.0 * p[1][1])) + (p[2][0] / (3600.0 * p[2][1]))
-			gpsPlace = Place(wgs84=np.array([lat, lon]))
-		
-		(pixelDiffs, Pn) = self.markerList.GetPositions()
-		mmDiffs = (sensorWidthMillimeters * pixelDiffs) / sensorWidthPixels
-		angles = 2.0 * np.arctan2(mmDiffs / 2.0, focalLengthMillimeters)
-		angles = np.abs(angles - angles[0]) # All angles relative to azimut to leftmost point
-		P0_start = np.mean(Pn,0) # Starting point is center of gravity of all points involved
-
-		# Calculates angles between P0 and all points in Pn
-		def ForwardTransform(P0, Pn):
-			delta = Pn-P0
-			angles = np.arctan2(delta[:,1],delta[:,0])
-			return np.abs(angles - angles[0]) # All angles relative to azimut to leftmost point
-		# Helper/Objective function of BackwardTransform
-		def	ObjFunc(P0, Pn, angles):
-			return np.sum(np.square(ForwardTransform(P0, Pn) - angles))
-		# Estimates P0 from the points Pn and angles between P0 and Pn
-		def BackwardTransform(P0_start, Pn, angles)	:
-			res = minimize(ObjFunc, P0_start, args=(Pn,angles), method='nelder-mead', \
-				options={'maxfev': 1000000, 'maxiter':1000000, 'xtol': 1e-8, 'disp': True})
-			return res.x
-
-		P0_estim = Place(ch1903=BackwardTransform(P0_start, Pn, angles))
-		#P0_estim.ShowOnMap()
-
-		if gpsPlace is not None:
-			print('Error of estimation compared to GPS tag in image is {0}m'.format(gpsPlace.Distance(P0_estim)))
-
-		print('Residuals')
-		residuals = (180*(ForwardTransform(P0_estim.CH1903(), Pn) - angles)) / np.pi
-		print(residuals)
-		plt.close("all")
-		plt.plot(residuals, '-ob')
-		plt.ylabel('Residuals (degrees)')
-		plt.grid()
-		plt.show()
+	# Use the result of a position estimation of the current image
+	def estimationFinished(self, estimation):
+		if estimation.filename == self.filename:
+			self.estimation = estimation
+			self.setReferencePosition(estimation.position.CH1903())
 
 
 class ImageViewer(QMainWindow):
+
+	autoSaveFailed = pyqtSignal(str, str)
+
 	def __init__(self):
 		super(ImageViewer, self).__init__()
 
@@ -334,6 +562,49 @@ class ImageViewer(QMainWindow):
 		self.scrollArea.setBackgroundRole(QPalette.Dark)
 		self.scrollArea.setWidget(self.imageLabel)
 		self.setCentralWidget(self.scrollArea)
+
+		self.loader = ImageLoader(parent=self)
+		self.loader.loaded.connect(self.imageLoaded)
+		self.loader.failed.connect(self.imageFailed)
+		self.loader.refined.connect(self.imageRefined)
+		self.requestedFile = None
+		self.directory = None
+		self.directoryFiles = []
+		self.markerStore = SidecarStore()
+		self.autoSaver = AutoSaver(errorCallback=lambda fileName, e: \
+			self.autoSaveFailed.emit(fileName, str(e)))
+		self.autoSaveFailed.connect(self.showAutoSaveError)
+		self.imageLabel.autoSaver = self.autoSaver
+
+		self.estimationRunner = EstimationRunner(parent=self)
+		self.estimationRunner.progress.connect(self.estimationProgress)
+		self.estimationRunner.finished.connect(self.estimationFinished)
+		self.estimationRunner.failed.connect(self.estimationFailed)
+		self.estimationRunner.cancelled.connect(self.estimationCancelled)
+		self.estimationJob = None
+		# Job id and filename of the running check of the markers
+		self.checkJob = None
+		self.estimationDock = EstimationDock(self)
+		self.estimationDock.cancelRequested.connect(self.cancelEstimation)
+		self.addDockWidget(Qt.RightDockWidgetArea, self.estimationDock)
+		self.estimationDock.hide()
+
+		# Thumbnails of the images in the current directory
+		self.thumbnailDock = ThumbnailDock(parent=self)
+		self.thumbnailDock.imageActivated.connect(self.thumbnailActivated)
+		self.imageLabel.markerCountChanged.connect(self.thumbnailDock.setMarkerCount)
+		self.addDockWidget(Qt.LeftDockWidgetArea, self.thumbnailDock)
+		self.thumbnailDock.hide()
+
+		# Live timings, only if instrumentation is enabled
+		self.profileDock = None
+		if instrumentation.IsEnabled():
+			self.profileDock = ProfileDock(self)
+			self.addDockWidget(Qt.BottomDockWidgetArea, self.profileDock)
+			self.profileDock.hide()
+			self.profileLabel = QLabel('')
+			self.statusBar().addPermanentWidget(self.profileLabel)
+			self.profileDock.refreshed.connect(self.profileLabel.setText)
 		
 		self.createActions()
 		self.createMenus()
@@ -345,22 +616,272 @@ class ImageViewer(QMainWindow):
 		fileName, _ = QFileDialog.getOpenFileName(self, 'Open File',
 			QDir.currentPath(), filter='JPEG (*.jpeg *.jpg)')
 		if fileName:
-			self.imageLabel.open(fileName)
-			
-			self.fitToWindowAct.setEnabled(True)
-			self.updateActions()
-			
-			if not self.fitToWindowAct.isChecked():
-			    self.imageLabel.adjustSize()
-	
+			self.showImage(fileName)
+
+	# Browse the images of a directory in the thumbnail dock
+	def openFolder(self):
+		directory = QFileDialog.getExistingDirectory(self, 'Open Folder',
+			QDir.currentPath() if self.directory is None else self.directory)
+		if directory:
+			self.setDirectory(os.path.abspath(directory))
+			self.thumbnailDock.show()
+
+	# Make directory the current one: its JPEGs are the images stepped
+	# through and shown in the thumbnail dock
+	def setDirectory(self, directory):
+		self.directory = directory
+		self.directoryFiles = sorted(os.path.join(directory, f) for f in os.listdir(directory) \
+			if os.path.splitext(f)[1].lower() in ('.jpg', '.jpeg'))
+		self.thumbnailDock.showFiles(self.directoryFiles)
+
+	# Load an image in the background; the image is shown as soon as it is
+	# loaded and its neighbours in the same directory are prefetched
+	def showImage(self, fileName):
+		fileName = os.path.abspath(fileName)
+		directory = os.path.dirname(fileName)
+		if directory != self.directory or fileName not in self.directoryFiles:
+			self.setDirectory(directory)
+		self.thumbnailDock.setCurrent(fileName)
+		self.loader.cancelRequests()
+		self.requestedFile = fileName
+		self.statusBar().showMessage('Loading {0} ...'.format(os.path.basename(fileName)))
+		# Fitted to the window, a reduced resolution decode is shown first
+		viewportSize = None
+		if self.fitToWindowAct.isChecked():
+			viewportSize = self.scrollArea.viewport().size() * self.devicePixelRatioF()
+		self.loader.request(fileName, viewportSize)
+
+	def imageLoaded(self, fileName, item):
+		if fileName != self.requestedFile:
+			return
+		self.imageLabel.setImage(item)
+		self.setWindowTitle('Image Viewer - {0}'.format(os.path.basename(fileName)))
+		self.statusBar().clearMessage()
+
+		self.fitToWindowAct.setEnabled(True)
+		self.updateActions()
+
+		if not self.fitToWindowAct.isChecked():
+		    self.imageLabel.adjustSize()
+
+		# Prefetch neighbours, the next image first
+		if fileName in self.directoryFiles:
+			index = self.directoryFiles.index(fileName)
+			for i in (index + 1, index - 1):
+				if 0 <= i < len(self.directoryFiles):
+					self.loader.prefetch(self.directoryFiles[i])
+
+	def imageRefined(self, fileName, pyramid):
+		if fileName == self.imageLabel.filename:
+			self.imageLabel.refineImage(pyramid)
+
+	def thumbnailActivated(self, fileName):
+		if fileName != self.requestedFile:
+			self.showImage(fileName)
+
+	def imageFailed(self, fileName, error):
+		self.statusBar().clearMessage()
+		QMessageBox.information(self, 'Image Viewer', error)
+
+	def nextImage(self):
+		self.stepImage(1)
+
+	def previousImage(self):
+		self.stepImage(-1)
+
+	def stepImage(self, step):
+		if self.requestedFile is None or self.requestedFile not in self.directoryFiles:
+			return
+		index = self.directoryFiles.index(self.requestedFile) + step
+		if 0 <= index < len(self.directoryFiles):
+			self.showImage(self.directoryFiles[index])
+
+	def toggleAutoSave(self):
+		if self.autoSaveAct.isChecked():
+			self.imageLabel.autoSaver = self.autoSaver
+			self.imageLabel.markersChanged()
+		else:
+			self.imageLabel.autoSaver = None
+
+	def showAutoSaveError(self, fileName, error):
+		self.statusBar().showMessage('Saving markers of {0} failed: {1}'.format( \
+			os.path.basename(fileName), error))
+
+	def closeEvent(self, event):
+		self.autoSaver.Stop()
+		self.loader.shutdown()
+		self.thumbnailDock.shutdown()
+		self.estimationRunner.shutdown()
+		if isinstance(self.markerStore, ProjectStore):
+			self.markerStore.Close()
+		super(ImageViewer, self).closeEvent(event)
+
 	def save(self):
 		self.imageLabel.save()
+		self.checkMarkers()
+
+	# Robust check of the markers in the background; markers probably tagged
+	# with the wrong place are shown when it is finished
+	def checkMarkers(self):
+		if self.checkJob is not None:
+			self.estimationRunner.cancel(self.checkJob[0])
+			self.checkJob = None
+		self.imageLabel.setOutlierKeys([])
+		self.statusBar().clearMessage()
+		if self.imageLabel.filename is None or len(self.imageLabel.markerList) < 4:
+			return
+		self.checkJob = (self.estimationRunner.submit(self.imageLabel.filename,
+			self.imageLabel.markerList, GetPlaces, 'ransac'), self.imageLabel.filename)
+
+	def checkFinished(self, estimation):
+		filename = self.checkJob[1]
+		self.checkJob = None
+		if filename != self.imageLabel.filename:
+			return
+		outliers = sorted(estimation.Outliers())
+		self.imageLabel.setOutlierKeys(outliers)
+		if len(outliers) > 0:
+			self.statusBar().showMessage('Markers probably tagged with wrong place: {0}'.format( \
+				', '.join(outliers)))
+
+	# Use a project database instead of sidecars for markers and results
+	def openProject(self):
+		fileName, _ = QFileDialog.getSaveFileName(self, 'Open or Create Project',
+			QDir.currentPath(), filter='Project (*.sqlite)',
+			options=QFileDialog.DontConfirmOverwrite)
+		if fileName:
+			self.setMarkerStore(ProjectStore(fileName))
+
+	def closeProject(self):
+		self.setMarkerStore(SidecarStore())
+
+	def setMarkerStore(self, store):
+		self.autoSaver.Flush()
+		if isinstance(self.markerStore, ProjectStore):
+			self.markerStore.Close()
+		self.markerStore = store
+		self.loader.setStore(store)
+		self.thumbnailDock.setStore(store)
+		isProject = isinstance(store, ProjectStore)
+		self.closeProjectAct.setEnabled(isProject)
+		self.importSidecarsAct.setEnabled(isProject)
+		self.exportSidecarsAct.setEnabled(isProject)
+		if isProject:
+			self.statusBar().showMessage('Project {0}'.format(store.filename))
+		else:
+			self.statusBar().clearMessage()
+		# Reload current image with markers from the new store
+		if self.requestedFile is not None:
+			self.showImage(self.requestedFile)
+
+	def importSidecars(self):
+		directory = QFileDialog.getExistingDirectory(self, 'Import Sidecars From',
+			QDir.currentPath())
+		if directory:
+			count = self.markerStore.ImportSidecars(directory)
+			QMessageBox.information(self, 'Image Viewer',
+				'Imported markers of {0} images.'.format(count))
+			if self.requestedFile is not None:
+				self.showImage(self.requestedFile)
+
+	def exportSidecars(self):
+		count = self.markerStore.ExportSidecars()
+		QMessageBox.information(self, 'Image Viewer',
+			'Exported markers of {0} images to sidecars.'.format(count))
 	
 	def viewMarkers(self):
 		self.imageLabel.toggleShowMarkers()
 
+	# Start estimation of the position of the current image in the background;
+	# the markers can still be edited while it is running
 	def estimatePosition(self):
-		self.imageLabel.estimatePosition()
+		if self.imageLabel.filename is None:
+			return
+		self.cancelEstimation()
+		engine = self.imageLabel.resectionEngine
+		self.estimationJob = (self.estimationRunner.submit(self.imageLabel.filename,
+			self.imageLabel.markerList, GetPlaces(), engine), engine)
+		self.estimationDock.started(self.imageLabel.filename, engine)
+		self.estimationDock.show()
+
+	# Cancel the running estimation, a running check of the markers goes on
+	def cancelEstimation(self):
+		if self.estimationJob is not None:
+			self.estimationRunner.cancel(self.estimationJob[0])
+
+	# Suggest markers for the places visible from the estimated position
+	# according to the elevation model
+	def suggestMarkers(self):
+		if self.imageLabel.estimation is None:
+			self.statusBar().showMessage('Estimate the position of the image first', 5000)
+			return
+		QApplication.setOverrideCursor(Qt.WaitCursor)
+		try:
+			engine = GetHorizonEngine()
+			if engine is None:
+				message = 'No elevation model, start with --dem FILE'
+			else:
+				count = self.imageLabel.suggestMarkers(engine)
+				message = '{0} markers suggested'.format(count)
+		except (IOError, ValueError) as e:
+			message = 'Cannot suggest markers: {0}'.format(e)
+		finally:
+			QApplication.restoreOverrideCursor()
+		self.statusBar().showMessage(message, 5000)
+
+	# Suggest markers for the peaks of the skyline of the image
+	def detectSkylineMarkers(self):
+		if self.imageLabel.filename is None:
+			return
+		QApplication.setOverrideCursor(Qt.WaitCursor)
+		try:
+			engine = GetHorizonEngine()
+			count = self.imageLabel.detectSkylineMarkers(engine)
+			message = '{0} markers found on the skyline'.format(count)
+		except (IOError, KeyError, ValueError) as e:
+			message = 'Cannot detect skyline markers: {0}'.format(e)
+		finally:
+			QApplication.restoreOverrideCursor()
+		self.statusBar().showMessage(message, 5000)
+
+	def acceptSuggestedMarkers(self):
+		self.imageLabel.acceptSuggestedMarkers()
+
+	def estimationProgress(self, jobId, iteration, position, cost):
+		if self.estimationJob is not None and jobId == self.estimationJob[0]:
+			self.estimationDock.showProgress(iteration, position, cost)
+
+	def estimationFinished(self, jobId, estimation):
+		if self.checkJob is not None and jobId == self.checkJob[0]:
+			self.checkFinished(estimation)
+			return
+		if self.estimationJob is None or jobId != self.estimationJob[0]:
+			return
+		engine = self.estimationJob[1]
+		self.estimationJob = None
+		self.estimationDock.showResult(estimation, engine)
+		self.imageLabel.estimationFinished(estimation)
+		self.thumbnailDock.setEstimated(estimation.filename)
+		if isinstance(self.markerStore, ProjectStore):
+			gps = None if estimation.gpsPlace is None else estimation.gpsPlace.WGS84()
+			self.markerStore.SetImageMetadata(estimation.filename, estimation.exifInfo, gps)
+			self.markerStore.SaveEstimate(estimation.filename, estimation, engine)
+
+	def estimationFailed(self, jobId, error):
+		if self.checkJob is not None and jobId == self.checkJob[0]:
+			if self.checkJob[1] == self.imageLabel.filename:
+				self.statusBar().showMessage('Cannot check the markers: {0}'.format(error), 5000)
+			self.checkJob = None
+		if self.estimationJob is not None and jobId == self.estimationJob[0]:
+			self.estimationJob = None
+			self.estimationDock.stopped('Estimation failed: {0}'.format(error))
+
+	def estimationCancelled(self, jobId):
+		if self.checkJob is not None and jobId == self.checkJob[0]:
+			self.checkJob = None
+		if self.estimationJob is not None and jobId == self.estimationJob[0]:
+			self.estimationJob = None
+			self.estimationDock.stopped('Estimation cancelled')
 	
 	def zoomIn(self):
 		self.scaleImage(1.25)
@@ -374,6 +895,7 @@ class ImageViewer(QMainWindow):
 	def fitToWindow(self):
 		fitToWindow = self.fitToWindowAct.isChecked()
 		self.scrollArea.setWidgetResizable(fitToWindow)
+		self.imageLabel.setFitToWindow(fitToWindow)
 		if not fitToWindow:
 			self.normalSize()
 		self.updateActions()
@@ -397,8 +919,24 @@ class ImageViewer(QMainWindow):
 	def createActions(self):
 		self.openAct = QAction('&Open...', self, shortcut='Ctrl+O',
 			triggered=self.open)
+		self.openFolderAct = QAction('Open &Folder...', self, shortcut='Ctrl+Shift+O',
+			triggered=self.openFolder)
 		self.saveAct = QAction('&Save Markers...', self, shortcut='Ctrl+S',
 			triggered=self.save)
+		self.autoSaveAct = QAction('&Autosave Markers', self, checkable=True,
+			triggered=self.toggleAutoSave)
+		self.autoSaveAct.setChecked(True)
+		self.openProjectAct = QAction('Open &Project...', self, triggered=self.openProject)
+		self.closeProjectAct = QAction('&Close Project', self, enabled=False,
+			triggered=self.closeProject)
+		self.importSidecarsAct = QAction('&Import Sidecars...', self, enabled=False,
+			triggered=self.importSidecars)
+		self.exportSidecarsAct = QAction('&Export Sidecars', self, enabled=False,
+			triggered=self.exportSidecars)
+		self.nextImageAct = QAction('&Next Image', self, shortcut='Ctrl+Right',
+			triggered=self.nextImage)
+		self.previousImageAct = QAction('&Previous Image', self, shortcut='Ctrl+Left',
+			triggered=self.previousImage)
 		self.exitAct = QAction('E&xit', self, shortcut='Ctrl+Q',
 			triggered=self.close)
 		self.viewMarkersAct = QAction('View &Markers', self, enabled=True,
@@ -414,6 +952,12 @@ class ImageViewer(QMainWindow):
 			checkable=True, shortcut='Ctrl+F', triggered=self.fitToWindow)
 		self.estimatePlaceAct = QAction('Estimate &Position', self, shortcut='Ctrl+P', \
 			triggered=self.estimatePosition)
+		self.suggestMarkersAct = QAction('Suggest &Markers', self, shortcut='Ctrl+G', \
+			triggered=self.suggestMarkers)
+		self.detectSkylineMarkersAct = QAction('Detect S&kyline Markers', self, shortcut='Ctrl+K', \
+			triggered=self.detectSkylineMarkers)
+		self.acceptSuggestedMarkersAct = QAction('&Accept Suggested Markers', self, \
+			triggered=self.acceptSuggestedMarkers)
 		self.aboutAct = QAction('&About', self, triggered=self.about)
 		self.aboutQtAct = QAction('About &Qt', self,
 			triggered=QApplication.instance().aboutQt)
@@ -421,7 +965,17 @@ class ImageViewer(QMainWindow):
 	def createMenus(self):
 		self.fileMenu = QMenu('&File', self)
 		self.fileMenu.addAction(self.openAct)
+		self.fileMenu.addAction(self.openFolderAct)
 		self.fileMenu.addAction(self.saveAct)
+		self.fileMenu.addAction(self.autoSaveAct)
+		self.fileMenu.addSeparator()
+		self.fileMenu.addAction(self.openProjectAct)
+		self.fileMenu.addAction(self.closeProjectAct)
+		self.fileMenu.addAction(self.importSidecarsAct)
+		self.fileMenu.addAction(self.exportSidecarsAct)
+		self.fileMenu.addSeparator()
+		self.fileMenu.addAction(self.nextImageAct)
+		self.fileMenu.addAction(self.previousImageAct)
 		self.fileMenu.addSeparator()
 		self.fileMenu.addAction(self.exitAct)
 		
@@ -433,9 +987,18 @@ class ImageViewer(QMainWindow):
 		self.viewMenu.addAction(self.normalSizeAct)
 		self.viewMenu.addSeparator()
 		self.viewMenu.addAction(self.fitToWindowAct)
+		self.viewMenu.addSeparator()
+		self.viewMenu.addAction(self.estimationDock.toggleViewAction())
+		self.viewMenu.addAction(self.thumbnailDock.toggleViewAction())
+		if self.profileDock is not None:
+			self.viewMenu.addAction(self.profileDock.toggleViewAction())
 		
 		self.infoMenu = QMenu('&Info', self)
 		self.infoMenu.addAction(self.estimatePlaceAct)
+		self.infoMenu.addSeparator()
+		self.infoMenu.addAction(self.suggestMarkersAct)
+		self.infoMenu.addAction(self.detectSkylineMarkersAct)
+		self.infoMenu.addAction(self.acceptSuggestedMarkersAct)
 
 		self.helpMenu = QMenu('&Help', self)
 		self.helpMenu.addAction(self.aboutAct)
@@ -467,7 +1030,25 @@ class ImageViewer(QMainWindow):
 
 
 if __name__ == '__main__':
-	app = QApplication(sys.argv)
+	# Options of our own, the remaining arguments are passed to Qt
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('--catalog', metavar='FILE', default=None,
+		help='catalog of places (default: $IMAGETAGGER_CATALOG or mountains.json next to this program)')
+	parser.add_argument('--profile', metavar='FILE',
+		help='record timings, written to FILE on exit (Chrome trace for *.trace.json)')
+	parser.add_argument('--dem', metavar='FILE', default=None,
+		help='elevation model for suggesting markers, .npy with .json sidecar or GeoTIFF')
+	(args, qtArgs) = parser.parse_known_args()
+	if args.dem:
+		elevationModelFilename = args.dem
+	if args.profile:
+		instrumentation.Enable(args.profile)
+	app = QApplication(sys.argv[:1] + qtArgs)
 	imageViewer = ImageViewer()
 	imageViewer.show()
+	# Runs as soon as the event loop has shown the window
+	def FirstWindowShown():
+		instrumentation.Record('startup.first_window', startTime)
+		LoadPlaces(args.catalog)
+	QTimer.singleShot(0, FirstWindowShown)
 	sys.exit(app.exec_())
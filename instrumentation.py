@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Opt-in timing instrumentation: spans (timed sections of code) and counters,
+# aggregated per name and recorded as single events for a Chrome trace
+# (chrome://tracing or https://ui.perfetto.dev). Enabled by
+#
+#   IMAGETAGGER_PROFILE=profile.json         aggregates as JSON on exit
+#   IMAGETAGGER_PROFILE=profile.trace.json   Chrome trace on exit
+#
+# or by calling Enable(); while disabled, Span() returns a shared no-op
+# context manager and Count() returns immediately
+
+
+
+import os
+import json
+import time
+import atexit
+import threading
+import functools
+
+
+
+# Aggregated durations of a span name in seconds
+class SpanStatistics:
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.min = float('inf')
+		self.max = 0.0
+		self.last = 0.0
+
+	def Add(self, duration):
+		self.count += 1
+		self.total += duration
+		self.min = min(self.min, duration)
+		self.max = max(self.max, duration)
+		self.last = duration
+
+	def ToDict(self):
+		return { 'count': self.count, 'total': self.total,
+			'mean': self.total / self.count if self.count > 0 else 0.0,
+			'min': self.min if self.count > 0 else 0.0, 'max': self.max, 'last': self.last }
+
+
+
+class Profiler:
+
+	# Single events for a trace are recorded up to maxEvents
+	def __init__(self, filename=None, traceEvents=True, maxEvents=200000):
+		self.filename = filename
+		self.traceEvents = traceEvents
+		self.maxEvents = maxEvents
+		self.lock = threading.Lock()
+		self.spans = {}
+		self.counters = {}
+		self.events = []
+		self.start = time.perf_counter()
+
+	def AddSpan(self, name, start, duration, args):
+		with self.lock:
+			statistics = self.spans.get(name)
+			if statistics is None:
+				statistics = self.spans[name] = SpanStatistics()
+			statistics.Add(duration)
+			if self.traceEvents and len(self.events) < self.maxEvents:
+				event = { 'name': name, 'ph': 'X', 'ts': (start - self.start) * 1e6,
+					'dur': duration * 1e6, 'pid': os.getpid(), 'tid': threading.get_ident() }
+				if args:
+					event['args'] = args
+				self.events.append(event)
+
+	def AddCount(self, name, value):
+		with self.lock:
+			total = self.counters.get(name, 0) + value
+			self.counters[name] = total
+			if self.traceEvents and len(self.events) < self.maxEvents:
+				self.events.append({ 'name': name, 'ph': 'C',
+					'ts': (time.perf_counter() - self.start) * 1e6, 'pid': os.getpid(),
+					'args': { name: total } })
+
+	# Snapshot of the aggregates: (dict of span statistics, dict of counters)
+	def Aggregates(self):
+		with self.lock:
+			spans = { name: statistics.ToDict() for (name, statistics) in self.spans.items() }
+			return (spans, dict(self.counters))
+
+	def Reset(self):
+		with self.lock:
+			self.spans = {}
+			self.counters = {}
+			self.events = []
+
+	# Write aggregates (or a Chrome trace if the filename ends with .trace.json)
+	def Dump(self, filename=None):
+		if filename is None:
+			filename = self.filename
+		if filename is None:
+			return
+		(spans, counters) = self.Aggregates()
+		if filename.endswith('.trace.json'):
+			with self.lock:
+				events = list(self.events)
+			data = { 'traceEvents': events, 'displayTimeUnit': 'ms',
+				'otherData': { 'spans': spans, 'counters': counters } }
+		else:
+			data = { 'spans': spans, 'counters': counters }
+		with open(filename, 'w') as f:
+			json.dump(data, f, indent=1)
+
+
+
+class ActiveSpan:
+
+	def __init__(self, name, args):
+		self.name = name
+		self.args = args
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		end = time.perf_counter()
+		if profiler is not None:
+			profiler.AddSpan(self.name, self.start, end - self.start, self.args)
+		return False
+
+class NullSpan:
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		return False
+
+nullSpan = NullSpan()
+
+
+
+# The active profiler or None if instrumentation is disabled
+profiler = None
+
+def Enable(filename=None, traceEvents=True):
+	global profiler
+	if profiler is None:
+		profiler = Profiler(filename, traceEvents)
+		atexit.register(Dump)
+	elif filename is not None:
+		profiler.filename = filename
+	return profiler
+
+def Disable():
+	global profiler
+	profiler = None
+
+def IsEnabled():
+	return profiler is not None
+
+def Dump(filename=None):
+	if profiler is not None:
+		profiler.Dump(filename)
+
+# Context manager timing a section of code: with Span('name'): ...
+def Span(name, **args):
+	if profiler is None:
+		return nullSpan
+	return ActiveSpan(name, args)
+
+# Record a span that started at start (a time.perf_counter() value) and ends now
+def Record(name, start, **args):
+	if profiler is not None:
+		profiler.AddSpan(name, start, time.perf_counter() - start, args)
+
+def Count(name, value=1):
+	if profiler is not None:
+		profiler.AddCount(name, value)
+
+# Decorator timing all calls of a function
+def Timed(name):
+	def decorator(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if profiler is None:
+				return function(*args, **kwargs)
+			with ActiveSpan(name, None):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorator
+
+
+
+if os.environ.get('IMAGETAGGER_PROFILE'):
+	Enable(os.environ['IMAGETAGGER_PROFILE'])
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Joint resection of a session of images taken with the same camera: shared
+# intrinsics (focal length and principal point in pixels) and per image
+# position, camera height, heading and pitch are estimated together from
+# both image coordinates of all markers in one sparse least squares problem
+
+
+
+import numpy as np
+from resection import Resection, WrapAngle
+from instrumentation import Span, Count
+
+
+
+# Earth radius and refraction coefficient for the curvature correction,
+# as in the horizon prediction
+earthRadius = 6371000.0
+refraction = 0.13
+
+# Parameters of a pose: y (east), x (north), height, heading (azimuth of the
+# optical axis, counter-clockwise from the CH1903 y axis) and pitch
+numPoseParameters = 5
+numSharedParameters = 3
+
+
+
+# Image and CH1903 coordinates (y, x, height) of the markers of markerList
+# with places in places (dict of Place or PlaceCatalog)
+def MarkerPoints(markerList, places):
+	keys = markerList.Keys()
+	if hasattr(places, 'Indices'):
+		indices = places.Indices(keys)
+		points = np.column_stack((places.ch1903[indices], places.heights[indices]))
+	else:
+		points = np.array([ list(places[key].CH1903()[0:2]) + [ places[key].height ] \
+			for key in keys ], dtype=float).reshape(-1, 3)
+	return (np.array(markerList.X()), np.array(markerList.Y()), points)
+
+
+
+# Result of a joint resection; poses of images which could not be solved
+# (fewer than 3 markers) are NaN
+class JointResult:
+
+	def __init__(self, focalLengthPixels, principalPoint, poses, residuals, \
+		evaluations=0, converged=True, message=''):
+		self.focalLengthPixels = focalLengthPixels
+		self.principalPoint = principalPoint
+		# Array of numImages x 5: y, x, height, heading, pitch
+		self.poses = poses
+		# Per image array of marker residuals (x, y) in pixels, None if not solved
+		self.residuals = residuals
+		self.evaluations = evaluations
+		self.converged = converged
+		self.message = message
+
+	def Position(self, index):
+		return self.poses[index, 0:2]
+
+	def Solved(self):
+		return np.all(np.isfinite(self.poses), axis=1)
+
+	# Root mean square of all marker residuals in pixels
+	def RmsResidual(self):
+		residuals = [ r for r in self.residuals if r is not None ]
+		if len(residuals) == 0:
+			return np.nan
+		return float(np.sqrt(np.mean(np.square(np.concatenate(residuals)))))
+
+
+
+# Levenberg-Marquardt on the normal equations, which have the block
+# structure of bundle adjustment: the 5x5 pose blocks of the images only
+# couple through the 3 shared parameters and are eliminated by the Schur
+# complement, so an iteration is linear in the number of images
+class JointResection:
+
+	# Markers are weighted by sigmaPixels and down-weighted beyond it by a
+	# soft L1 loss; the initial focal length, principal point and heights act
+	# as weak priors (relative sigma of focal length, sigma of principal point
+	# relative to the image width, sigma of heights in m) so images with few
+	# markers stay well posed
+	def __init__(self, sigmaPixels=2.0, focalLengthSigma=0.2, principalPointSigma=0.1, \
+		heightSigma=500.0, robust=True, maxIterations=100, tolerance=1e-10, lambdaStart=1e-3):
+		self.sigmaPixels = sigmaPixels
+		self.focalLengthSigma = focalLengthSigma
+		self.principalPointSigma = principalPointSigma
+		self.heightSigma = heightSigma
+		self.robust = robust
+		self.maxIterations = maxIterations
+		self.tolerance = tolerance
+		self.lambdaStart = lambdaStart
+
+	# Image coordinates of points (m x 3) seen from poses (m x 5, one row per
+	# point) with the pinhole camera (focalLengthPixels, cx, cy)
+	@staticmethod
+	def Project(focalLengthPixels, cx, cy, poses, points):
+		dy = points[:,0] - poses[:,0]
+		dx = points[:,1] - poses[:,1]
+		distances = np.maximum(np.hypot(dy, dx), 1.0)
+		# Horizontal angle right of the optical axis, tangent of the elevation
+		alpha = poses[:,3] - np.arctan2(dx, dy)
+		tanElevation = (points[:,2] - poses[:,2] - \
+			(1.0 - refraction) * np.square(distances) / (2.0 * earthRadius)) / distances
+		# Rotate by the pitch about the horizontal image axis
+		(cosPitch, sinPitch) = (np.cos(poses[:,4]), np.sin(poses[:,4]))
+		forward = cosPitch * np.cos(alpha) + sinPitch * tanElevation
+		up = cosPitch * tanElevation - sinPitch * np.cos(alpha)
+		# Points behind the camera are projected far outside
+		forward = np.maximum(forward, 1e-3)
+		return (cx + focalLengthPixels * np.sin(alpha) / forward,
+			cy - focalLengthPixels * up / forward)
+
+	# Initial pose of a single image: position and heading from the 2D
+	# resection of the horizontal angles, height and pitch by linear least
+	# squares of the small angle approximation of the vertical angles; the
+	# next engine is tried if the resection diverges or fits worse than
+	# maxAngleResidual (rms, radians)
+	def InitialPose(self, x, y, points, focalLengthPixels, cx, cy, \
+		engines=('lm', 'nelder-mead'), maxAngleResidual=np.radians(1.0)):
+		order = np.argsort(x, kind='stable')
+		(x, y, points) = (x[order], y[order], points[order])
+		horizontal = np.arctan((x - cx) / focalLengthPixels)
+		for engine in engines:
+			result = Resection.Create(engine).Solve(points[:,0:2], horizontal - horizontal[0])
+			position = result.position
+			if np.all(np.isfinite(position)) and \
+				np.sqrt(np.mean(np.square(result.residuals))) <= maxAngleResidual:
+				break
+		else:
+			raise ValueError('Resection did not converge')
+		delta = points[:,0:2] - position
+		azimuths = np.arctan2(delta[:,1], delta[:,0])
+		heading = azimuths[0] + horizontal[0]
+		heading += np.mean(WrapAngle(azimuths + horizontal - heading))
+		# (cy - y) / f = (H - h) / D - pitch with the curvature in H
+		distances = np.maximum(np.hypot(delta[:,0], delta[:,1]), 1.0)
+		heights = points[:,2] - (1.0 - refraction) * np.square(distances) / (2.0 * earthRadius)
+		vertical = np.arctan((cy - y) / focalLengthPixels)
+		# Weak prior: camera 500m below the mean of the places, level
+		A = np.vstack((np.column_stack((-1.0 / distances, -np.ones(x.size))),
+			[ [ 1.0 / self.heightSigma, 0.0 ], [ 0.0, 1.0 ] ]))
+		b = np.concatenate((vertical - heights / distances,
+			[ (np.mean(points[:,2]) - 500.0) / self.heightSigma, 0.0 ]))
+		(height, pitch) = np.linalg.lstsq(A, b, rcond=None)[0]
+		return np.array([ position[0], position[1], height, heading, pitch ])
+
+	# Marker residuals (m x 2) in units of sigmaPixels
+	def MarkerResiduals(self, shared, poses):
+		(px, py) = JointResection.Project(shared[0], shared[1], shared[2],
+			poses[self.imageIndices], self.points)
+		return np.column_stack((px - self.observed[:,0], py - self.observed[:,1])) / self.sigmaPixels
+
+	# Robust cost of marker residuals r and the priors
+	def Cost(self, r, shared, poses):
+		z = np.square(r)
+		markerCost = np.sum(2.0 * (np.sqrt(1.0 + z) - 1.0)) if self.robust else np.sum(z)
+		return markerCost + np.sum(np.square((shared - self.prior) / self.priorSigma)) + \
+			np.sum(np.square((poses[:,2] - self.priorHeights) / self.heightSigma))
+
+	# Jacobians of the marker residuals by forward differences: one
+	# evaluation per parameter for all markers at once; returns
+	# (m x 2 x 3 shared, m x 2 x 5 pose)
+	def Jacobians(self, r, shared, poses):
+		numMarkers = r.shape[0]
+		Js = np.empty((numMarkers, 2, numSharedParameters))
+		Jp = np.empty((numMarkers, 2, numPoseParameters))
+		for j in range(numSharedParameters):
+			changed = shared.copy()
+			changed[j] += self.sharedSteps[j]
+			Js[:,:,j] = (self.MarkerResiduals(changed, poses) - r) / self.sharedSteps[j]
+		for j in range(numPoseParameters):
+			changed = poses.copy()
+			changed[:,j] += self.poseSteps[j]
+			Jp[:,:,j] = (self.MarkerResiduals(shared, changed) - r) / self.poseSteps[j]
+		return (Js, Jp)
+
+	# Solve for the markers of all images: data is a list of (x, y, points)
+	# per image as returned by MarkerPoints; the focal length and principal
+	# point are the initial intrinsics and width the image width in pixels
+	def Solve(self, data, focalLengthPixels, cx, cy, width):
+		with Span('joint.solve', images=len(data)):
+			numImages = len(data)
+			poses = np.full((numImages, numPoseParameters), np.nan)
+			with Span('joint.initial'):
+				for (i, (x, y, points)) in enumerate(data):
+					if x.size >= 3:
+						try:
+							poses[i] = self.InitialPose(x, y, points, focalLengthPixels, cx, cy)
+						except (ValueError, np.linalg.LinAlgError):
+							pass
+			solved = np.nonzero(np.all(np.isfinite(poses), axis=1))[0]
+			if solved.size == 0:
+				raise ValueError('No image with at least 3 markers')
+			# Markers of all solved images in flat arrays, grouped by image
+			self.imageIndices = np.concatenate([ np.full(data[i][0].size, k) \
+				for (k, i) in enumerate(solved) ])
+			self.observed = np.concatenate([ np.column_stack(data[i][0:2]) for i in solved ])
+			self.points = np.concatenate([ data[i][2] for i in solved ])
+			starts = np.concatenate(([ 0 ], np.cumsum([ data[i][0].size for i in solved ])[:-1]))
+			self.prior = np.array([ focalLengthPixels, cx, cy ])
+			self.priorSigma = np.array([ self.focalLengthSigma * focalLengthPixels,
+				self.principalPointSigma * width, self.principalPointSigma * width ])
+			self.priorHeights = poses[solved, 2].copy()
+			self.sharedSteps = np.array([ 1e-3, 1e-3, 1e-3 ])
+			self.poseSteps = np.array([ 1e-3, 1e-3, 1e-3, 1e-7, 1e-7 ])
+
+			shared = self.prior.copy()
+			P = poses[solved].copy()
+			r = self.MarkerResiduals(shared, P)
+			cost = self.Cost(r, shared, P)
+			lam = self.lambdaStart
+			evaluations = 1
+			converged = False
+			iteration = 0
+			while iteration < self.maxIterations:
+				iteration += 1
+				(Js, Jp) = self.Jacobians(r, shared, P)
+				evaluations += numSharedParameters + numPoseParameters
+				# Soft L1 as iteratively reweighted least squares
+				w = 1.0 / np.sqrt(1.0 + np.square(r)) if self.robust else np.ones(r.shape)
+				# Normal equations: U shared block, V pose blocks, W coupling
+				U = np.einsum('mki,mk,mkj->ij', Js, w, Js) + np.diag(1.0 / np.square(self.priorSigma))
+				gs = np.einsum('mki,mk->i', Js, w * r) + (shared - self.prior) / np.square(self.priorSigma)
+				V = np.add.reduceat(np.einsum('mki,mk,mkj->mij', Jp, w, Jp), starts)
+				V[:,2,2] += 1.0 / self.heightSigma**2
+				W = np.add.reduceat(np.einsum('mki,mk,mkj->mij', Js, w, Jp), starts)
+				gp = np.add.reduceat(np.einsum('mki,mk->mi', Jp, w * r), starts)
+				gp[:,2] += (P[:,2] - self.priorHeights) / self.heightSigma**2
+				(diagU, diagV) = (np.diag(U).copy(), np.diagonal(V, axis1=1, axis2=2).copy())
+				# Damping loop: increase lambda until the step decreases the cost
+				while True:
+					try:
+						Vd = V + lam * diagV[:,:,np.newaxis] * np.eye(numPoseParameters)
+						# Schur complement of the pose blocks
+						VinvWt = np.linalg.solve(Vd, np.transpose(W, (0, 2, 1)))
+						Vinvg = np.linalg.solve(Vd, gp[:,:,np.newaxis])[:,:,0]
+						S = U + lam * np.diag(diagU) - np.einsum('nij,njk->ik', W, VinvWt)
+						stepShared = -np.linalg.solve(S, gs - np.einsum('nij,nj->i', W, Vinvg))
+						stepPoses = -Vinvg - np.einsum('nij,j->ni', VinvWt, stepShared)
+					except np.linalg.LinAlgError:
+						stepShared = None
+					if stepShared is not None:
+						(shared1, P1) = (shared + stepShared, P + stepPoses)
+						r1 = self.MarkerResiduals(shared1, P1)
+						cost1 = self.Cost(r1, shared1, P1)
+						evaluations += 1
+						if cost1 <= cost:
+							break
+					lam *= 10.0
+					if lam > 1e12:
+						break
+				if lam > 1e12:
+					# No further decrease possible: we are at the minimum
+					converged = True
+					break
+				decrease = cost - cost1
+				(shared, P, r, cost) = (shared1, P1, r1, cost1)
+				lam = max(lam / 10.0, 1e-12)
+				if decrease <= self.tolerance * max(cost, 1.0):
+					converged = True
+					break
+			Count('joint.iterations', iteration)
+			Count('joint.evaluations', evaluations)
+
+			poses[solved] = P
+			poses[solved, 3] = np.mod(poses[solved, 3], 2.0 * np.pi)
+			markerResiduals = r * self.sigmaPixels
+			residuals = [ None ] * numImages
+			for (k, i) in enumerate(solved):
+				residuals[i] = markerResiduals[self.imageIndices == k]
+			return JointResult(shared[0], shared[1:3], poses, residuals, evaluations,
+				converged, '{0} iterations'.format(iteration))
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import os
+import json
+from collections.abc import MutableSequence
+import numpy as np
+from instrumentation import Timed
+
+
+
+class Marker:
+	__slots__ = ('key', 'x', 'y')
+
+	def __init__(self, x=None, y=None, key=''):
+		self.key = key
+		self.x = x
+		self.y = y
+
+	def SetPos(self, pos):
+		self.x = pos.x()
+		self.y = pos.y()
+
+	def Load(self, node):
+		self.key = node['Key']
+		self.x = float(node['X'])
+		self.y = float(node['Y'])
+
+# View of the marker at index of a MarkerList: its attributes are read from
+# and written to the arrays of the list; a view is only valid until markers
+# before it are inserted or deleted
+class MarkerView:
+	__slots__ = ('markerList', 'index')
+
+	def __init__(self, markerList, index):
+		self.markerList = markerList
+		self.index = index
+
+	@property
+	def key(self):
+		return self.markerList.markerKeys[self.index]
+
+	@key.setter
+	def key(self, key):
+		self.markerList.SetKey(self.index, key)
+
+	@property
+	def x(self):
+		return float(self.markerList.xs[self.index])
+
+	@x.setter
+	def x(self, x):
+		self.markerList.SetPos(self.index, x, self.y)
+
+	@property
+	def y(self):
+		return float(self.markerList.ys[self.index])
+
+	@y.setter
+	def y(self, y):
+		self.markerList.SetPos(self.index, self.x, y)
+
+	def SetPos(self, pos):
+		self.markerList.SetPos(self.index, pos.x(), pos.y())
+
+	def __repr__(self):
+		return 'Marker({0!r}, {1!r}, {2!r})'.format(self.x, self.y, self.key)
+
+class MarkerEncoder(json.JSONEncoder):
+	def default(self, obj):
+		if isinstance(obj, (Marker, MarkerView)):
+			return { 'Key': obj.key, 'X': obj.x, 'Y': obj.y }
+		if isinstance(obj, MarkerList):
+			return [ self.default(marker) for marker in obj ]
+		# Let the base class default method raise the TypeError
+		return json.JSONEncoder.default(self, obj)
+
+# List of markers stored in parallel arrays of image coordinates and a list
+# of keys; behaves like a list of markers (items are MarkerView objects).
+# The positions for the solver are cached until the markers change
+class MarkerList(MutableSequence):
+
+	def __init__(self, markers=()):
+		self.count = 0
+		self.xs = np.empty(8)
+		self.ys = np.empty(8)
+		self.markerKeys = []
+		self.order = None
+		self.catalogIndices = None
+		self.positions = None
+		for marker in markers:
+			self.append(marker)
+
+	# Forget cached results depending on positions (and keys)
+	def Invalidate(self, keysChanged=True):
+		self.order = None
+		self.positions = None
+		if keysChanged:
+			self.catalogIndices = None
+
+	def Reserve(self, capacity):
+		if capacity > self.xs.size:
+			capacity = max(capacity, 2 * self.xs.size)
+			for name in ('xs', 'ys'):
+				array = np.empty(capacity)
+				array[:self.count] = getattr(self, name)[:self.count]
+				setattr(self, name, array)
+
+	# List interface
+
+	def __len__(self):
+		return self.count
+
+	def Index(self, index):
+		if index < 0:
+			index += self.count
+		if not 0 <= index < self.count:
+			raise IndexError('marker index out of range')
+		return index
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return MarkerList(Marker(self.xs[i], self.ys[i], self.markerKeys[i]) \
+				for i in range(*index.indices(self.count)))
+		return MarkerView(self, self.Index(index))
+
+	def __setitem__(self, index, marker):
+		if isinstance(index, slice):
+			markers = self.ToMarkers()
+			markers[index] = [ Marker(m.x, m.y, m.key) for m in marker ]
+			self.SetMarkers(markers)
+			return
+		index = self.Index(index)
+		(x, y, key) = (marker.x, marker.y, marker.key)
+		self.xs[index] = x
+		self.ys[index] = y
+		self.markerKeys[index] = key
+		self.Invalidate()
+
+	def __delitem__(self, index):
+		if isinstance(index, slice):
+			if index == slice(None):
+				self.count = 0
+				self.markerKeys = []
+			else:
+				markers = self.ToMarkers()
+				del markers[index]
+				self.SetMarkers(markers)
+			self.Invalidate()
+			return
+		index = self.Index(index)
+		self.xs[index:self.count-1] = self.xs[index+1:self.count]
+		self.ys[index:self.count-1] = self.ys[index+1:self.count]
+		del self.markerKeys[index]
+		self.count -= 1
+		self.Invalidate()
+
+	def insert(self, index, marker):
+		index = max(0, min(self.count, index + self.count if index < 0 else index))
+		self.Reserve(self.count + 1)
+		self.xs[index+1:self.count+1] = self.xs[index:self.count]
+		self.ys[index+1:self.count+1] = self.ys[index:self.count]
+		self.xs[index] = marker.x
+		self.ys[index] = marker.y
+		self.markerKeys.insert(index, marker.key)
+		self.count += 1
+		self.Invalidate()
+
+	def append(self, marker):
+		self.insert(self.count, marker)
+
+	# Returns an independent Marker, a view would refer to the removed marker
+	def pop(self, index=-1):
+		index = self.Index(index)
+		marker = Marker(float(self.xs[index]), float(self.ys[index]), self.markerKeys[index])
+		del self[index]
+		return marker
+
+	def __repr__(self):
+		return 'MarkerList([{0}])'.format(', '.join(repr(marker) for marker in self))
+
+	# Independent Marker objects of all markers
+	def ToMarkers(self):
+		return [ Marker(float(self.xs[i]), float(self.ys[i]), self.markerKeys[i]) \
+			for i in range(self.count) ]
+
+	def SetMarkers(self, markers):
+		self.SetArrays([ m.x for m in markers ], [ m.y for m in markers ],
+			[ m.key for m in markers ])
+
+	def SetArrays(self, xs, ys, keys):
+		self.count = len(keys)
+		self.xs = np.array(xs, dtype=float).reshape(-1)
+		self.ys = np.array(ys, dtype=float).reshape(-1)
+		self.markerKeys = list(keys)
+		self.Reserve(8)
+		self.Invalidate()
+
+	# Changes of single markers
+
+	def SetPos(self, index, x, y):
+		self.xs[index] = x
+		self.ys[index] = y
+		self.Invalidate(keysChanged=False)
+
+	def SetKey(self, index, key):
+		self.markerKeys[index] = key
+		self.Invalidate()
+
+	# Image coordinates of all markers (read-only views)
+	def X(self):
+		return self.ReadOnly(self.xs[:self.count])
+
+	def Y(self):
+		return self.ReadOnly(self.ys[:self.count])
+
+	def Keys(self):
+		return self.markerKeys
+
+	@staticmethod
+	def ReadOnly(array):
+		array = array.view()
+		array.flags.writeable = False
+		return array
+
+	@Timed('markers.load')
+	def Load(self, filename):
+		if (os.path.exists(filename)):
+			with open(filename, 'r') as f:
+				nodes = json.load(f)
+			self.SetArrays([ float(node['X']) for node in nodes ],
+				[ float(node['Y']) for node in nodes ], [ node['Key'] for node in nodes ])
+		else:
+			del self[:]
+
+	# Writes to a temporary file that replaces the sidecar when complete,
+	# so a crash never leaves a truncated sidecar
+	@Timed('markers.save')
+	def Save(self, filename):
+		if len(self) > 0:
+			nodes = [ { 'Key': key, 'X': float(x), 'Y': float(y) } for (key, x, y) in \
+				zip(self.markerKeys, self.xs[:self.count], self.ys[:self.count]) ]
+			tempFilename = filename + '.tmp'
+			with open(tempFilename, 'w') as f:
+				f.write(json.dumps(nodes, indent=4, separators=(',', ': '), sort_keys=True))
+				f.flush()
+				os.fsync(f.fileno())
+			os.replace(tempFilename, filename)
+		else:
+			if os.path.exists(filename):
+				os.remove(filename)
+
+	# Independent copy of the list and its markers
+	def Copy(self):
+		result = MarkerList()
+		result.SetArrays(self.xs[:self.count], self.ys[:self.count], self.markerKeys)
+		return result
+
+	# Indices of the markers sorted from left to right
+	def SortedOrder(self):
+		if self.order is None:
+			self.order = self.ReadOnly(np.argsort(self.xs[:self.count], kind='stable'))
+		return self.order
+
+	# Keys of the markers sorted from left to right
+	def SortedKeys(self):
+		return [ self.markerKeys[i] for i in self.SortedOrder() ]
+
+	# Indices of the places of all markers in a PlaceCatalog
+	def CatalogIndices(self, catalog):
+		if self.catalogIndices is None or self.catalogIndices[0] is not catalog:
+			self.catalogIndices = (catalog, self.ReadOnly(catalog.Indices(self.markerKeys)))
+		return self.catalogIndices[1]
+
+	# Image X coordinates and CH1903 coordinates of the markers from the
+	# places in places (dict or PlaceCatalog), sorted from left to right;
+	# for a PlaceCatalog the (read-only) result is cached until the markers change
+	def GetPositions(self, places):
+		if self.positions is not None and self.positions[0] is places:
+			return self.positions[1]
+		order = self.SortedOrder()
+		pixelX = self.ReadOnly(self.xs[:self.count][order])
+		if hasattr(places, 'Indices'):
+			Pn = self.ReadOnly(places.ch1903[self.CatalogIndices(places)[order]])
+			self.positions = (places, (pixelX, Pn))
+		else:
+			Pn = np.array([ places[self.markerKeys[i]].CH1903()[0:2] for i in order ],
+				dtype=float).reshape(-1, 2)
+		return (pixelX, Pn)
+
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import math
+
+
+
+# Uniform grid over image coordinates for fast spatial lookup of markers;
+# markers are identified by their index in the marker list
+class MarkerGrid:
+
+	def __init__(self, cellSize=64.0):
+		self.cellSize = float(cellSize)
+		self.cells = {}
+		self.positions = {}
+
+	def Cell(self, x, y):
+		return (int(math.floor(x / self.cellSize)), int(math.floor(y / self.cellSize)))
+
+	def Clear(self):
+		self.cells = {}
+		self.positions = {}
+
+	# Rebuild grid from all markers of a marker list
+	def Build(self, markerList):
+		self.Clear()
+		for i in range(len(markerList)):
+			self.Insert(i, markerList[i].x, markerList[i].y)
+
+	def Insert(self, index, x, y):
+		self.positions[index] = (x, y)
+		self.cells.setdefault(self.Cell(x, y), set()).add(index)
+
+	def Remove(self, index):
+		(x, y) = self.positions.pop(index)
+		cell = self.Cell(x, y)
+		self.cells[cell].discard(index)
+		if len(self.cells[cell]) == 0:
+			del self.cells[cell]
+
+	def Move(self, index, x, y):
+		self.Remove(index)
+		self.Insert(index, x, y)
+
+	# Indices of all markers inside the rectangle [x0, x1] x [y0, y1]
+	def QueryRect(self, x0, y0, x1, y1):
+		(i0, j0) = self.Cell(x0, y0)
+		(i1, j1) = self.Cell(x1, y1)
+		result = []
+		# Walk over the smaller of cells in the rectangle and occupied cells
+		if (i1 - i0 + 1) * (j1 - j0 + 1) <= len(self.cells):
+			cells = ( self.cells.get((i, j)) for i in range(i0, i1 + 1) \
+				for j in range(j0, j1 + 1) )
+		else:
+			cells = ( indices for (cell, indices) in self.cells.items() \
+				if i0 <= cell[0] <= i1 and j0 <= cell[1] <= j1 )
+		for indices in cells:
+			if indices is None:
+				continue
+			for index in indices:
+				(x, y) = self.positions[index]
+				if x0 <= x <= x1 and y0 <= y <= y1:
+					result.append(index)
+		return result
+
+	# Index of the marker nearest to (x, y) within radius or None
+	def Nearest(self, x, y, radius):
+		best = None
+		bestDistance = radius * radius
+		for index in self.QueryRect(x - radius, y - radius, x + radius, y + radius):
+			(mx, my) = self.positions[index]
+			distance = (mx - x) * (mx - x) + (my - y) * (my - y)
+			if distance <= bestDistance:
+				(best, bestDistance) = (index, distance)
+		return best
+
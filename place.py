@@ -3,7 +3,6 @@
 
 
 
-import json
 import numpy as np
 import webbrowser
 from wgs84_ch1903 import ApproxSwissProj
@@ -25,8 +24,7 @@ class Place:
 		elif wgs84 is not None:
 			self.name = 'Unknown'
 			self.height = 0
-			self.ch1903 = np.array([ ApproxSwissProj.WGStoCHy(wgs84[0], wgs84[1]), \
-				ApproxSwissProj.WGStoCHx(wgs84[0], wgs84[1]) ])
+			self.ch1903 = ApproxSwissProj.WGStoCH(wgs84[0:2])
 
 	def __str__(self):
 		return self.name + ' ' + str(self.height) + \
@@ -50,18 +48,11 @@ class Place:
 		return self.ch1903
 
 	def WGS84(self):
-		return np.array([ ApproxSwissProj.CHtoWGSlat(y, x), \
-			ApproxSwissProj.CHtoWGSlon(y, x) ])
+		return ApproxSwissProj.CHtoWGS(self.ch1903)
 	
+	# Returns a PlaceCatalog, which maps '<Name> <Height>m' keys to places
 	@staticmethod
 	def LoadListFromFile(filename):
-		places = {}
-		f = open(filename)
-		if f is not None:
-			placesRoot = json.load(f)
-			f.close()
-			for node in placesRoot:
-				p = Place(node=node)
-				places[p.name + ' ' + str(p.height) + 'm'] = p
-		return places
+		from placecatalog import PlaceCatalog
+		return PlaceCatalog.LoadFromFile(filename)
 
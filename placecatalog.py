@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import os
+import sys
+import json
+import struct
+import threading
+from collections.abc import Mapping, Sequence
+import numpy as np
+from place import Place
+
+
+
+# Catalog of places stored in contiguous arrays; behaves like a read-only
+# dict mapping place keys ('<Name> <Height>m') to Place objects
+class PlaceCatalog(Mapping):
+
+	def __init__(self, names=(), heights=(), ch1903=None):
+		self.names = list(names)
+		self.heights = np.asarray(heights, dtype=float).reshape(-1)
+		if ch1903 is None:
+			ch1903 = np.zeros((0, 2))
+		self.ch1903 = np.ascontiguousarray(ch1903, dtype=float).reshape(-1, 2)
+		if not (len(self.names) == self.heights.size == self.ch1903.shape[0]):
+			raise ValueError('Names, heights and coordinates differ in length')
+		self.keyList = [ PlaceCatalog.MakeKey(name, height) \
+			for name, height in zip(self.names, self.heights) ]
+		self.keyIndices = { key: i for i, key in enumerate(self.keyList) }
+		self.tree = None
+		self.sortedKeys = None
+
+	@staticmethod
+	def MakeKey(name, height):
+		return name + ' ' + str(float(height)) + 'm'
+
+	# Mapping interface: lookup by key creates a Place from the arrays
+
+	def __getitem__(self, key):
+		return self.GetPlace(self.Index(key))
+
+	def __iter__(self):
+		return iter(self.keyIndices)
+
+	def __len__(self):
+		return len(self.keyIndices)
+
+	def __contains__(self, key):
+		return key in self.keyIndices
+
+	# Array access
+
+	def Index(self, key):
+		return self.keyIndices[key]
+
+	def Indices(self, keys):
+		return np.array([ self.Index(key) for key in keys ], dtype=int)
+
+	def Key(self, index):
+		return self.keyList[index]
+
+	# All keys sorted alphabetically, calculated once
+	def SortedKeys(self):
+		if self.sortedKeys is None:
+			self.sortedKeys = sorted(self.keyIndices.keys())
+		return self.sortedKeys
+
+	def GetPlace(self, index):
+		return Place(node={ 'Name': self.names[index], 'Height': self.heights[index],
+			'CH1903': self.ch1903[index] })
+
+	# Spatial queries, all points in CH1903 coordinates
+
+	# KD-tree of all places, built on first use (scipy is imported then)
+	def GetTree(self):
+		if self.tree is None:
+			from scipy.spatial import cKDTree
+			self.tree = cKDTree(self.ch1903)
+		return self.tree
+
+	# Returns (distances, indices) of the k places nearest to point,
+	# sorted by distance
+	def Nearest(self, point, k=1):
+		k = min(k, len(self))
+		if k == 0:
+			return (np.zeros(0), np.zeros(0, dtype=int))
+		(distances, indices) = self.GetTree().query(np.asarray(point, dtype=float), k=k)
+		return (np.atleast_1d(distances), np.atleast_1d(indices))
+
+	# Returns indices of all places within radius of point, sorted by distance
+	def WithinRadius(self, point, radius):
+		if len(self) == 0:
+			return np.zeros(0, dtype=int)
+		indices = np.array(self.GetTree().query_ball_point( \
+			np.asarray(point, dtype=float), radius), dtype=int)
+		return indices[np.argsort(self.Distances(point, indices))]
+
+	# Returns indices of all places inside the axis aligned box spanned by
+	# the corners minCorner and maxCorner
+	def WithinBox(self, minCorner, maxCorner):
+		if len(self) == 0:
+			return np.zeros(0, dtype=int)
+		minCorner = np.asarray(minCorner, dtype=float)
+		maxCorner = np.asarray(maxCorner, dtype=float)
+		center = (minCorner + maxCorner) / 2.0
+		halfSize = np.max(maxCorner - minCorner) / 2.0
+		# Square box query in maximum norm, then clip to the requested box
+		indices = np.array(self.GetTree().query_ball_point(center, halfSize, p=np.inf),
+			dtype=int)
+		points = self.ch1903[indices]
+		inside = np.all((points >= minCorner) & (points <= maxCorner), axis=1)
+		return np.sort(indices[inside])
+
+	# Distances from point to all places (or the places given by indices)
+	def Distances(self, point, indices=None):
+		points = self.ch1903 if indices is None else self.ch1903[indices]
+		delta = np.asarray(point, dtype=float) - points
+		return np.hypot(delta[:, 0], delta[:, 1])
+
+	# Azimuts from point to all places (or the places given by indices),
+	# same convention as Place.Azimut
+	def Azimuts(self, point, indices=None):
+		points = self.ch1903 if indices is None else self.ch1903[indices]
+		delta = np.asarray(point, dtype=float) - points
+		magneticDeclination = 1.56 # Place and time dependent ...
+		return magneticDeclination + \
+			(180.0 * np.arctan2(delta[:, 1], delta[:, 0])) / np.pi
+
+	# Compass bearings in degrees (clockwise from north, 0..360) from point
+	# to all places (or the places given by indices)
+	def Bearings(self, point, indices=None):
+		points = self.ch1903 if indices is None else self.ch1903[indices]
+		delta = points - np.asarray(point, dtype=float)
+		return np.mod(np.degrees(np.arctan2(delta[:, 0], delta[:, 1])), 360.0)
+
+	# Loads a catalog in the format of mountains.json or a binary catalog
+	# written by MappedPlaceCatalog.Save (recognized by its magic)
+	@staticmethod
+	def LoadFromFile(filename):
+		with open(filename, 'rb') as f:
+			isMapped = f.read(len(MappedPlaceCatalog.magic)) == MappedPlaceCatalog.magic
+		if isMapped:
+			return MappedPlaceCatalog(filename)
+		with open(filename) as f:
+			placesRoot = json.load(f)
+		names = [ node['Name'] for node in placesRoot ]
+		heights = np.array([ float(node['Height']) for node in placesRoot ])
+		ch1903 = np.array([ [ float(node['CH1903'][0]), float(node['CH1903'][1]) ] \
+			for node in placesRoot ]).reshape(-1, 2)
+		return PlaceCatalog(names, heights, ch1903)
+
+
+
+# Names of places stored as UTF-8 in one buffer, name i from offsets[i] to
+# offsets[i + 1]; names are decoded on access
+class StringTable(Sequence):
+
+	def __init__(self, data, offsets):
+		self.data = data
+		self.offsets = offsets
+
+	def __len__(self):
+		return self.offsets.size - 1
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [ self[i] for i in range(*index.indices(len(self))) ]
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError('String table index out of range')
+		return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+
+
+# Catalog of places in a binary file which is memory mapped instead of
+# parsed: opening takes the same time for any number of places, pages are
+# only read when used and processes opening the same file share them
+# through the OS cache. Keys are looked up by binary search in the place
+# indices sorted by key, no dict of all keys is built. File layout, little
+# endian, all sections aligned to 8 bytes:
+#   header: magic, version, reserved, number of places n, string table size
+#   n x 2 float64 CH1903 coordinates
+#   n float64 heights
+#   n + 1 uint64 offsets of the names in the string table
+#   n uint32 place indices sorted by key
+#   string table: UTF-8 names
+class MappedPlaceCatalog(PlaceCatalog):
+
+	magic = b'ITPLACES'
+	version = 1
+	headerFormat = '<8sIIQQ'
+
+	def __init__(self, filename):
+		self.filename = filename
+		data = np.memmap(filename, dtype=np.uint8, mode='r')
+		headerSize = struct.calcsize(MappedPlaceCatalog.headerFormat)
+		if data.size < headerSize:
+			raise ValueError('{0} is not a binary catalog of places'.format(filename))
+		(magic, version, _, n, stringSize) = struct.unpack_from(MappedPlaceCatalog.headerFormat, data)
+		if magic != MappedPlaceCatalog.magic:
+			raise ValueError('{0} is not a binary catalog of places'.format(filename))
+		if version != MappedPlaceCatalog.version:
+			raise ValueError('Unsupported version {0} of binary catalog {1}'.format(version, filename))
+		sections = MappedPlaceCatalog.Sections(n, stringSize)
+		if data.size < sections['end']:
+			raise ValueError('Binary catalog {0} is truncated'.format(filename))
+		def Section(name, shape, dtype):
+			return np.ndarray(shape, dtype=dtype, buffer=data, offset=sections[name])
+		self.ch1903 = Section('ch1903', (n, 2), '<f8')
+		self.heights = Section('heights', (n,), '<f8')
+		self.keyOrder = Section('keyOrder', (n,), '<u4')
+		self.names = StringTable(data[sections['strings']:sections['end']],
+			Section('offsets', (n + 1,), '<u8'))
+		self.tree = None
+		self.sortedKeys = None
+
+	# Byte offsets of the sections of a file with n places and stringSize
+	# bytes of names
+	@staticmethod
+	def Sections(n, stringSize):
+		sections = {}
+		offset = struct.calcsize(MappedPlaceCatalog.headerFormat)
+		for (name, size) in (('ch1903', 16 * n), ('heights', 8 * n), ('offsets', 8 * (n + 1)),
+			('keyOrder', 4 * n), ('strings', stringSize)):
+			sections[name] = offset
+			offset += (size + 7) // 8 * 8
+		sections['end'] = sections['strings'] + stringSize
+		return sections
+
+	# Mapping interface on the arrays
+
+	def __iter__(self):
+		return (self.Key(i) for i in range(len(self)))
+
+	def __len__(self):
+		return self.heights.size
+
+	def __contains__(self, key):
+		try:
+			self.Index(key)
+		except KeyError:
+			return False
+		return True
+
+	def Key(self, index):
+		return PlaceCatalog.MakeKey(self.names[index], self.heights[index])
+
+	def Index(self, key):
+		(lo, hi) = (0, len(self))
+		while lo < hi:
+			middle = (lo + hi) // 2
+			if self.Key(self.keyOrder[middle]) < key:
+				lo = middle + 1
+			else:
+				hi = middle
+		if lo < len(self) and self.Key(self.keyOrder[lo]) == key:
+			return int(self.keyOrder[lo])
+		raise KeyError(key)
+
+	def SortedKeys(self):
+		if self.sortedKeys is None:
+			self.sortedKeys = [ self.Key(i) for i in self.keyOrder ]
+		return self.sortedKeys
+
+	# Writes catalog (any PlaceCatalog) as binary catalog; of places with
+	# the same key only the one found by a lookup is kept. The file is
+	# replaced atomically, so catalogs mapping the old file stay valid
+	@staticmethod
+	def Save(catalog, filename):
+		indices = np.sort(catalog.Indices(list(catalog)))
+		names = [ catalog.names[i].encode('utf-8') for i in indices ]
+		keys = [ catalog.Key(i) for i in indices ]
+		offsets = np.zeros(indices.size + 1, dtype='<u8')
+		offsets[1:] = np.cumsum([ len(name) for name in names ])
+		keyOrder = np.array(sorted(range(indices.size), key=keys.__getitem__), dtype='<u4')
+		sections = MappedPlaceCatalog.Sections(indices.size, int(offsets[-1]))
+		tempFilename = filename + '.tmp'
+		with open(tempFilename, 'wb') as f:
+			f.write(struct.pack(MappedPlaceCatalog.headerFormat, MappedPlaceCatalog.magic,
+				MappedPlaceCatalog.version, 0, indices.size, int(offsets[-1])))
+			for (name, data) in (('ch1903', catalog.ch1903[indices].astype('<f8')),
+				('heights', catalog.heights[indices].astype('<f8')), ('offsets', offsets),
+				('keyOrder', keyOrder), ('strings', b''.join(names))):
+				f.write(b'\0' * (sections[name] - f.tell()))
+				f.write(data if isinstance(data, bytes) else data.tobytes())
+		os.replace(tempFilename, filename)
+
+
+
+# Catalog used if none is given: IMAGETAGGER_CATALOG or mountains.json next
+# to the program, converted mountains.places instead if it is up to date
+def DefaultCatalogFilename():
+	filename = os.environ.get('IMAGETAGGER_CATALOG')
+	if filename:
+		return filename
+	directory = os.path.dirname(os.path.abspath(__file__))
+	filename = os.path.join(directory, 'mountains.json')
+	mappedFilename = os.path.join(directory, 'mountains.places')
+	if os.path.exists(mappedFilename) and (not os.path.exists(filename) or \
+		os.path.getmtime(mappedFilename) >= os.path.getmtime(filename)):
+		return mappedFilename
+	return filename
+
+
+
+# Catalog loaded in a background thread, including its KD-tree; Get() waits
+# until loading is finished; if the file cannot be loaded, the catalog is empty
+class BackgroundCatalog:
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.catalog = None
+		self.error = None
+		self.loaded = threading.Event()
+		self.thread = threading.Thread(target=self.run, name='CatalogLoader', daemon=True)
+		self.thread.start()
+
+	def run(self):
+		try:
+			catalog = PlaceCatalog.LoadFromFile(self.filename)
+			if len(catalog) > 0:
+				catalog.GetTree()
+		except Exception as e:
+			self.error = e
+			catalog = PlaceCatalog()
+			print('Cannot load catalog of places {0}: {1}'.format(self.filename, e), file=sys.stderr)
+		self.catalog = catalog
+		self.loaded.set()
+
+	def IsLoaded(self):
+		return self.loaded.is_set()
+
+	def Get(self):
+		self.loaded.wait()
+		return self.catalog
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
+from PyQt5.QtWidgets import (QDockWidget, QWidget, QVBoxLayout, QHBoxLayout, QPushButton,
+	QTableWidget, QTableWidgetItem, QHeaderView, QFileDialog)
+import instrumentation
+
+
+
+# Spans shown in the status bar: (span name, short label)
+statusSpans = [ ('label.paint', 'paint'), ('label.hit_test', 'hit'),
+	('image.load', 'load'), ('resection.solve', 'solve') ]
+
+def FormatDuration(seconds):
+	if seconds >= 1.0:
+		return '{0:.2f}s'.format(seconds)
+	if seconds >= 1e-3:
+		return '{0:.1f}ms'.format(seconds * 1e3)
+	return '{0:.0f}us'.format(seconds * 1e6)
+
+# One line summary of the last durations of the most interesting spans
+def StatusSummary(spans):
+	parts = [ '{0} {1}'.format(label, FormatDuration(spans[name]['last'])) \
+		for (name, label) in statusSpans if name in spans ]
+	return ' | '.join(parts)
+
+
+
+# Dock with live aggregates of all spans and counters of the profiler
+class ProfileDock(QDockWidget):
+
+	# Emitted with the status bar summary after every refresh
+	refreshed = pyqtSignal(str)
+
+	def __init__(self, parent=None, interval=1000):
+		super(ProfileDock, self).__init__('Profile', parent)
+		self.setObjectName('ProfileDock')
+		widget = QWidget(self)
+		layout = QVBoxLayout(widget)
+		self.table = QTableWidget(0, 6)
+		self.table.setHorizontalHeaderLabels([ 'Name', 'Count', 'Mean', 'Min', 'Max', 'Total' ])
+		self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+		self.table.verticalHeader().setVisible(False)
+		self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+		layout.addWidget(self.table)
+		buttonLayout = QHBoxLayout()
+		resetButton = QPushButton('Reset')
+		resetButton.clicked.connect(self.reset)
+		buttonLayout.addWidget(resetButton)
+		dumpButton = QPushButton('Save...')
+		dumpButton.clicked.connect(self.dump)
+		buttonLayout.addWidget(dumpButton)
+		layout.addLayout(buttonLayout)
+		self.setWidget(widget)
+		self.timer = QTimer(self)
+		self.timer.timeout.connect(self.refresh)
+		self.timer.start(interval)
+
+	def refresh(self):
+		if instrumentation.profiler is None:
+			return
+		(spans, counters) = instrumentation.profiler.Aggregates()
+		self.refreshed.emit(StatusSummary(spans))
+		if not self.isVisible():
+			return
+		rows = [ (name, str(s['count']), FormatDuration(s['mean']), FormatDuration(s['min']),
+			FormatDuration(s['max']), FormatDuration(s['total'])) \
+			for (name, s) in sorted(spans.items(), key=lambda item: -item[1]['total']) ]
+		rows += [ (name, str(value), '', '', '', '') for (name, value) in sorted(counters.items()) ]
+		self.table.setRowCount(len(rows))
+		for (row, values) in enumerate(rows):
+			for (column, value) in enumerate(values):
+				item = QTableWidgetItem(value)
+				if column > 0:
+					item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+				self.table.setItem(row, column, item)
+
+	def reset(self):
+		if instrumentation.profiler is not None:
+			instrumentation.profiler.Reset()
+		self.refresh()
+
+	def dump(self):
+		filename, _ = QFileDialog.getSaveFileName(self, 'Save Profile', 'profile.json',
+			filter='Aggregates (*.json);;Chrome Trace (*.trace.json)')
+		if filename:
+			instrumentation.Dump(filename)
+
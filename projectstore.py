@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from marker import Marker, MarkerList
+
+
+
+# Markers stored in a JSON sidecar next to each image (the default)
+class SidecarStore:
+
+	@staticmethod
+	def SidecarFilename(imageFilename):
+		return os.path.splitext(imageFilename)[0] + '.json'
+
+	def LoadMarkers(self, imageFilename, markerList):
+		markerList.Load(SidecarStore.SidecarFilename(imageFilename))
+
+	def SaveMarkers(self, imageFilename, markerList):
+		markerList.Save(SidecarStore.SidecarFilename(imageFilename))
+
+	# Changes whenever the markers of the image change
+	def GetMarkerVersion(self, imageFilename):
+		try:
+			return os.stat(SidecarStore.SidecarFilename(imageFilename)).st_mtime_ns
+		except OSError:
+			return None
+
+
+
+# Project database: markers, EXIF derived metadata and estimation results of
+# a collection of images in a single SQLite file; image paths are stored
+# relative to the directory of the database
+class ProjectStore:
+
+	schema = [
+		'CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, ' \
+			'make TEXT, model TEXT, focal_length REAL, gps_lat REAL, gps_lon REAL, ' \
+			'version INTEGER NOT NULL DEFAULT 0)',
+		'CREATE TABLE IF NOT EXISTS markers (image_id INTEGER NOT NULL ' \
+			'REFERENCES images(id) ON DELETE CASCADE, idx INTEGER NOT NULL, ' \
+			'key TEXT NOT NULL, x REAL NOT NULL, y REAL NOT NULL, PRIMARY KEY (image_id, idx))',
+		'CREATE INDEX IF NOT EXISTS markers_key ON markers (key)',
+		'CREATE TABLE IF NOT EXISTS estimates (image_id INTEGER PRIMARY KEY ' \
+			'REFERENCES images(id) ON DELETE CASCADE, y REAL, x REAL, stddev_y REAL, ' \
+			'stddev_x REAL, gps_error REAL, residuals TEXT, engine TEXT, created REAL)',
+	]
+
+	def __init__(self, filename):
+		self.filename = os.path.abspath(filename)
+		self.directory = os.path.dirname(self.filename)
+		self.lock = threading.RLock()
+		self.connection = sqlite3.connect(self.filename, timeout=30.0,
+			check_same_thread=False, isolation_level=None)
+		self.connection.execute('PRAGMA journal_mode=WAL')
+		self.connection.execute('PRAGMA synchronous=NORMAL')
+		self.connection.execute('PRAGMA foreign_keys=ON')
+		for statement in ProjectStore.schema:
+			self.connection.execute(statement)
+
+	def Close(self):
+		with self.lock:
+			self.connection.close()
+
+	def RelativePath(self, imageFilename):
+		return os.path.relpath(os.path.abspath(imageFilename), self.directory).replace(os.sep, '/')
+
+	def AbsolutePath(self, path):
+		return os.path.normpath(os.path.join(self.directory, path))
+
+	def GetImageId(self, imageFilename, create=False):
+		path = self.RelativePath(imageFilename)
+		row = self.connection.execute('SELECT id FROM images WHERE path=?', (path,)).fetchone()
+		if row is not None:
+			return row[0]
+		if not create:
+			return None
+		return self.connection.execute('INSERT INTO images (path) VALUES (?)', (path,)).lastrowid
+
+	# Markers
+
+	def LoadMarkers(self, imageFilename, markerList):
+		del markerList[:]
+		with self.lock:
+			imageId = self.GetImageId(imageFilename)
+			if imageId is None:
+				return
+			rows = self.connection.execute('SELECT key, x, y FROM markers WHERE image_id=? ' \
+				'ORDER BY idx', (imageId,)).fetchall()
+		for (key, x, y) in rows:
+			markerList.append(Marker(x, y, key))
+
+	# Writes only markers that differ from the stored ones; all changes of
+	# a call are done in one transaction
+	def SaveMarkers(self, imageFilename, markerList):
+		rows = [ (i, markerList[i].key, float(markerList[i].x), float(markerList[i].y)) \
+			for i in range(len(markerList)) ]
+		with self.lock:
+			with self.Transaction():
+				imageId = self.GetImageId(imageFilename, create=True)
+				cursor = self.connection.executemany('INSERT INTO markers ' \
+					'(image_id, idx, key, x, y) VALUES (?, ?, ?, ?, ?) ' \
+					'ON CONFLICT (image_id, idx) DO UPDATE SET ' \
+					'key=excluded.key, x=excluded.x, y=excluded.y ' \
+					'WHERE key IS NOT excluded.key OR x IS NOT excluded.x OR y IS NOT excluded.y',
+					[ (imageId,) + row for row in rows ])
+				changed = cursor.rowcount
+				changed += self.connection.execute('DELETE FROM markers WHERE image_id=? AND idx>=?',
+					(imageId, len(rows))).rowcount
+				if changed != 0:
+					self.connection.execute('UPDATE images SET version=version+1 WHERE id=?',
+						(imageId,))
+
+	# Insert or update a single marker
+	def UpsertMarker(self, imageFilename, index, marker):
+		with self.lock:
+			with self.Transaction():
+				imageId = self.GetImageId(imageFilename, create=True)
+				self.connection.execute('INSERT INTO markers (image_id, idx, key, x, y) ' \
+					'VALUES (?, ?, ?, ?, ?) ON CONFLICT (image_id, idx) DO UPDATE SET ' \
+					'key=excluded.key, x=excluded.x, y=excluded.y',
+					(imageId, index, marker.key, float(marker.x), float(marker.y)))
+				self.connection.execute('UPDATE images SET version=version+1 WHERE id=?',
+					(imageId,))
+
+	def GetMarkerVersion(self, imageFilename):
+		with self.lock:
+			path = self.RelativePath(imageFilename)
+			row = self.connection.execute('SELECT version FROM images WHERE path=?',
+				(path,)).fetchone()
+		return None if row is None else row[0]
+
+	# Metadata and results
+
+	def SetImageMetadata(self, imageFilename, exifInfo, gpsWgs84=None):
+		lat = None if gpsWgs84 is None else float(gpsWgs84[0])
+		lon = None if gpsWgs84 is None else float(gpsWgs84[1])
+		with self.lock:
+			with self.Transaction():
+				imageId = self.GetImageId(imageFilename, create=True)
+				self.connection.execute('UPDATE images SET make=?, model=?, focal_length=?, ' \
+					'gps_lat=?, gps_lon=? WHERE id=?', (exifInfo.get('Make'), exifInfo.get('Model'),
+					exifInfo.get('FocalLength'), lat, lon, imageId))
+
+	# Store result of a PositionEstimation
+	def SaveEstimate(self, imageFilename, estimation, engine=''):
+		position = estimation.position.CH1903()
+		stddev = estimation.result.StdDev()
+		residuals = json.dumps([ float(r) for r in estimation.Residuals() ])
+		gpsError = estimation.GpsError()
+		with self.lock:
+			with self.Transaction():
+				imageId = self.GetImageId(imageFilename, create=True)
+				self.connection.execute('INSERT OR REPLACE INTO estimates VALUES ' \
+					'(?, ?, ?, ?, ?, ?, ?, ?, ?)', (imageId, float(position[0]), float(position[1]),
+					float(stddev[0]), float(stddev[1]), None if gpsError is None else float(gpsError),
+					residuals, engine, time.time()))
+
+	# Returns dict with the stored estimation result or None
+	def GetEstimate(self, imageFilename):
+		with self.lock:
+			imageId = self.GetImageId(imageFilename)
+			if imageId is None:
+				return None
+			cursor = self.connection.execute('SELECT y, x, stddev_y, stddev_x, gps_error, ' \
+				'residuals, engine, created FROM estimates WHERE image_id=?', (imageId,))
+			row = cursor.fetchone()
+			if row is None:
+				return None
+			result = dict(zip([ d[0] for d in cursor.description ], row))
+		result['residuals'] = json.loads(result['residuals'])
+		return result
+
+	# Queries over the whole collection
+
+	# Returns list of (image filename, x, y) of all markers with key
+	def FindMarkers(self, key):
+		with self.lock:
+			rows = self.connection.execute('SELECT images.path, markers.x, markers.y FROM markers ' \
+				'JOIN images ON images.id=markers.image_id WHERE markers.key=? ' \
+				'ORDER BY images.path, markers.idx', (key,)).fetchall()
+		return [ (self.AbsolutePath(path), x, y) for (path, x, y) in rows ]
+
+	def GetImages(self):
+		with self.lock:
+			rows = self.connection.execute('SELECT path FROM images ORDER BY path').fetchall()
+		return [ self.AbsolutePath(path) for (path,) in rows ]
+
+	# Import/export of sidecars
+
+	# Import all sidecars of JPEGs below directory root, returns number of images
+	def ImportSidecars(self, root):
+		sidecars = SidecarStore()
+		count = 0
+		for (dirpath, dirnames, filenames) in os.walk(root):
+			for filename in filenames:
+				if os.path.splitext(filename)[1].lower() not in ('.jpg', '.jpeg'):
+					continue
+				imageFilename = os.path.join(dirpath, filename)
+				if not os.path.exists(SidecarStore.SidecarFilename(imageFilename)):
+					continue
+				markerList = MarkerList()
+				sidecars.LoadMarkers(imageFilename, markerList)
+				self.SaveMarkers(imageFilename, markerList)
+				count += 1
+		return count
+
+	# Write sidecars for all images of the project, returns number of images
+	def ExportSidecars(self):
+		sidecars = SidecarStore()
+		count = 0
+		for imageFilename in self.GetImages():
+			markerList = MarkerList()
+			self.LoadMarkers(imageFilename, markerList)
+			if len(markerList) > 0:
+				sidecars.SaveMarkers(imageFilename, markerList)
+				count += 1
+		return count
+
+	# Context manager for a transaction, nested calls join the outer one
+	def Transaction(self):
+		store = self
+		class TransactionContext:
+			def __enter__(self):
+				self.outer = store.connection.in_transaction
+				if not self.outer:
+					store.connection.execute('BEGIN IMMEDIATE')
+			def __exit__(self, excType, excValue, tb):
+				if self.outer:
+					return False
+				if excType is None:
+					store.connection.execute('COMMIT')
+				else:
+					store.connection.execute('ROLLBACK')
+				return False
+		return TransactionContext()
+
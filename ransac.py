@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import itertools
+import numpy as np
+from resection import Resection, WrapAngle
+
+
+
+# Draw numHypotheses minimal subsets (three distinct points, sorted) out of
+# n points; all subsets are used if there are not more than numHypotheses
+def DrawTriples(n, numHypotheses, rng):
+	numCombinations = n * (n - 1) * (n - 2) // 6
+	if numCombinations <= numHypotheses:
+		return np.array(list(itertools.combinations(range(n), 3)), dtype=int).reshape(-1, 3)
+	triples = np.sort(rng.integers(0, n, size=(2 * numHypotheses, 3)), 1)
+	valid = (triples[:,0] != triples[:,1]) & (triples[:,1] != triples[:,2])
+	triples = triples[valid]
+	while triples.shape[0] < numHypotheses:
+		triples = np.vstack((triples, DrawTriples(n, numHypotheses, rng)))
+	return triples[:numHypotheses]
+
+# Solve all hypotheses given by triples at once and score them against all
+# points; returns positions (H x 2), residuals (H x n) and MSAC costs (H)
+def EvaluateHypotheses(Pn, angles, triples, threshold):
+	(i, j, k) = (triples[:,0], triples[:,1], triples[:,2])
+	P0 = Resection.ThreePoint(Pn[i], Pn[j], Pn[k], angles[j] - angles[i], angles[k] - angles[j])
+	delta = Pn[np.newaxis,:,:] - P0[:,np.newaxis,:]
+	# For a correct P0, azimut plus image angle is the same for all points
+	offsets = np.arctan2(delta[:,:,1], delta[:,:,0]) + angles[np.newaxis,:]
+	rows = np.arange(triples.shape[0])[:,np.newaxis]
+	reference = np.angle(np.mean(np.exp(1j * offsets[rows, triples]), 1))
+	residuals = WrapAngle(offsets - reference[:,np.newaxis])
+	costs = np.sum(np.minimum(np.square(residuals), threshold * threshold), 1)
+	costs[~np.all(np.isfinite(P0), 1)] = np.inf
+	return (P0, residuals, costs)
+
+# Evaluate hypotheses in chunks, returns (cost, triple) of the best one
+def BestHypothesis(Pn, angles, triples, threshold, chunkSize=4096):
+	best = (np.inf, None)
+	for start in range(0, triples.shape[0], chunkSize):
+		chunk = triples[start:start+chunkSize]
+		(P0, residuals, costs) = EvaluateHypotheses(Pn, angles, chunk, threshold)
+		index = np.argmin(costs)
+		if costs[index] < best[0]:
+			best = (costs[index], chunk[index])
+	return best
+
+
+
+# Robust resection: random sample consensus over closed-form three point
+# solutions, followed by a least squares solve on the inliers; the
+# result reports inliers (and thus outliers) of all points
+@Resection.Register('ransac')
+class RansacResection(Resection):
+
+	def __init__(self, numHypotheses=2000, threshold=np.radians(0.5), \
+		processes=None, seed=None, refineEngine='lm', chunkSize=4096):
+		self.numHypotheses = numHypotheses
+		self.threshold = threshold # in radians
+		self.processes = processes
+		self.seed = seed
+		self.refineEngine = refineEngine
+		self.chunkSize = chunkSize
+
+	def Solve(self, Pn, angles, P0_start=None):
+		Pn = np.asarray(Pn, dtype=float)
+		angles = np.asarray(angles, dtype=float)
+		n = Pn.shape[0]
+		if n < 3:
+			raise ValueError('Resection needs at least three points')
+		rng = np.random.default_rng(self.seed)
+		triples = DrawTriples(n, self.numHypotheses, rng)
+		if self.processes is not None and self.processes > 1 and triples.shape[0] > self.chunkSize:
+			from concurrent.futures import ProcessPoolExecutor
+			chunks = np.array_split(triples, self.processes)
+			with ProcessPoolExecutor(max_workers=self.processes) as executor:
+				results = list(executor.map(BestHypothesis, [ Pn ] * len(chunks),
+					[ angles ] * len(chunks), chunks, [ self.threshold ] * len(chunks)))
+			(cost, triple) = min(results, key=lambda result: result[0])
+		else:
+			(cost, triple) = (np.inf, None)
+			for start in range(0, triples.shape[0], self.chunkSize):
+				(chunkCost, chunkTriple) = BestHypothesis(Pn, angles, \
+					triples[start:start+self.chunkSize], self.threshold, self.chunkSize)
+				if chunkCost < cost:
+					(cost, triple) = (chunkCost, chunkTriple)
+				if self.callback is not None and triple is not None:
+					P0 = Resection.ThreePoint(Pn[triple[0]], Pn[triple[1]], Pn[triple[2]], \
+						angles[triple[1]] - angles[triple[0]], angles[triple[2]] - angles[triple[1]])
+					self.Report(start // self.chunkSize, P0, cost)
+		if triple is None:
+			raise ValueError('No valid hypothesis found')
+		(P0, residuals, costs) = EvaluateHypotheses(Pn, angles, triple[np.newaxis,:],
+			self.threshold)
+		inliers = np.abs(residuals[0]) < self.threshold
+		# Refine on inliers, then update inliers with the refined position
+		result = None
+		for iteration in range(2):
+			indices = np.nonzero(inliers)[0]
+			if len(indices) < 3:
+				break
+			refine = Resection.Create(self.refineEngine)
+			refine.callback = self.callback
+			result = refine.Solve(Pn[indices], angles[indices] - angles[indices[0]], P0[0])
+			delta = Pn - result.position
+			offsets = np.arctan2(delta[:,1], delta[:,0]) + angles
+			reference = np.angle(np.mean(np.exp(1j * offsets[indices])))
+			allResiduals = WrapAngle(offsets - reference)
+			newInliers = np.abs(allResiduals) < self.threshold
+			if np.array_equal(newInliers, inliers):
+				break
+			inliers = newInliers
+		if result is None:
+			result = Resection.MakeResult(P0[0], Pn, angles, 0, triples.shape[0], False)
+			allResiduals = result.residuals
+		else:
+			result.direction = reference
+		result.residuals = allResiduals
+		result.inliers = inliers
+		result.evaluations += triples.shape[0]
+		return result
+
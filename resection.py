@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+from abc import ABC, abstractmethod
+import numpy as np
+from instrumentation import Span
+
+
+
+# Wrap angles to [-pi, pi)
+def WrapAngle(angle):
+	return np.mod(angle + np.pi, 2.0 * np.pi) - np.pi
+
+
+
+# Raised by a progress callback to stop a running resection
+class ResectionCancelled(Exception):
+	pass
+
+
+
+# Result of a resection: estimated position P0 (CH1903) and its covariance
+class ResectionResult:
+
+	def __init__(self, position, covariance=None, residuals=None, \
+		iterations=0, evaluations=0, converged=True, direction=None):
+		self.position = np.asarray(position, dtype=float)
+		# 2x2 covariance of position in m^2, NaN if not determined
+		if covariance is None:
+			covariance = np.full((2, 2), np.nan)
+		self.covariance = covariance
+		# Residuals of all angles in radians
+		self.residuals = residuals
+		self.iterations = iterations
+		self.evaluations = evaluations
+		self.converged = converged
+		# Direction from P0 to the first (leftmost) point in radians,
+		# counter-clockwise from the CH1903 y axis (east)
+		self.direction = direction
+		# Boolean mask of points consistent with the position, None if the
+		# solver does not detect outliers
+		self.inliers = None
+
+	# Standard deviations of the position in m
+	def StdDev(self):
+		return np.sqrt(np.diag(self.covariance))
+
+
+
+# Resection: estimates the position P0 of a camera from the known positions Pn
+# of points and the horizontal angles between these points as seen from P0;
+# all angles are relative to the first point and increase clockwise (from
+# left to right in the image)
+class Resection(ABC):
+
+	engines = {}
+
+	# Called as callback(iteration, P0, cost) with intermediate iterates;
+	# may raise ResectionCancelled to stop the solver
+	callback = None
+
+	# Register a resection engine under a name
+	@staticmethod
+	def Register(name):
+		def decorator(cls):
+			Resection.engines[name] = cls
+			return cls
+		return decorator
+
+	@staticmethod
+	def Create(name='lm', **kwargs):
+		if name not in Resection.engines:
+			raise ValueError('Unknown resection engine "{0}", choose one of {1}'.format( \
+				name, ', '.join(sorted(Resection.engines.keys()))))
+		return Resection.engines[name](**kwargs)
+
+	# Horizontal angles of image columns (in pixels from the left border)
+	@staticmethod
+	def ImageAngles(pixelX, focalLengthMillimeters, sensorWidthMillimeters, sensorWidthPixels):
+		mmDiffs = (sensorWidthMillimeters * np.asarray(pixelX, dtype=float)) / sensorWidthPixels
+		return 2.0 * np.arctan2(mmDiffs / 2.0, focalLengthMillimeters)
+
+	# Inverse of ImageAngles: image columns (in pixels from the left border)
+	# of horizontal angles
+	@staticmethod
+	def ImageColumns(angles, focalLengthMillimeters, sensorWidthMillimeters, sensorWidthPixels):
+		mm = 2.0 * focalLengthMillimeters * np.tan(np.asarray(angles, dtype=float) / 2.0)
+		return (mm * sensorWidthPixels) / sensorWidthMillimeters
+
+	# Calculates angles between P0 and all points in Pn
+	@staticmethod
+	def ForwardTransform(P0, Pn):
+		delta = Pn - P0
+		angles = np.arctan2(delta[:,1], delta[:,0])
+		# All angles relative to azimut to leftmost point
+		return np.mod(angles[0] - angles, 2.0 * np.pi)
+
+	# Angle residuals of P0, the first angle is zero by definition and omitted
+	@staticmethod
+	def Residuals(P0, Pn, angles):
+		return WrapAngle(Resection.ForwardTransform(P0, Pn)[1:] - angles[1:])
+
+	# Objective function: sum of squared angle residuals
+	@staticmethod
+	def ObjFunc(P0, Pn, angles):
+		return np.sum(np.square(Resection.Residuals(P0, Pn, angles)))
+
+	# Objective function for many positions at once: X and Y are arrays of
+	# any (equal) shape; evaluated in cache sized blocks of about blockSize
+	# elements, working in place in units of full turns
+	@staticmethod
+	def ObjFuncGrid(X, Y, Pn, angles, blockSize=1<<16):
+		(X, Y) = np.broadcast_arrays(np.asarray(X, dtype=float), np.asarray(Y, dtype=float))
+		shape = X.shape
+		(X, Y) = (X.ravel(), Y.ravel())
+		cost = np.empty(X.size)
+		step = max(1, blockSize // Pn.shape[0])
+		for start in range(0, X.size, step):
+			dx = Pn[np.newaxis,:,0] - X[start:start+step,np.newaxis]
+			dy = Pn[np.newaxis,:,1] - Y[start:start+step,np.newaxis]
+			# Negated residuals: theta - theta0 + angle, wrapped to [-0.5, 0.5] turns
+			r = np.arctan2(dy, dx, out=dx)
+			r -= r[:,:1]
+			r += angles[np.newaxis,:]
+			r *= 0.5 / np.pi
+			r -= np.rint(r, out=dy)
+			np.square(r, out=r)
+			cost[start:start+step] = np.sum(r[:,1:], 1)
+		cost *= 4.0 * np.pi * np.pi
+		return cost.reshape(shape)
+
+	# Analytic Jacobian of the residuals with respect to P0
+	@staticmethod
+	def Jacobian(P0, Pn):
+		delta = Pn - P0
+		d2 = np.sum(np.square(delta), 1)
+		# Derivatives of the azimut to each point with respect to P0
+		dTheta = np.column_stack((delta[:,1] / d2, -delta[:,0] / d2))
+		return dTheta[0] - dTheta[1:]
+
+	# Closed-form resection from three points A, B, C and the angles alpha
+	# (from A to B) and beta (from B to C); P0 is the second intersection of
+	# the circle through A, B, P0 with the circle through B, C, P0;
+	# works on arrays of point triples (leading dimensions are broadcast)
+	@staticmethod
+	def ThreePoint(A, B, C, alpha, beta):
+		def Center(P, Q, angle):
+			# Signed inscribed angle is counter-clockwise, our angles are clockwise
+			cot = -1.0 / np.tan(angle)
+			delta = Q - P
+			normal = np.stack((-delta[...,1], delta[...,0]), -1)
+			return (P + Q) / 2.0 + 0.5 * cot[...,np.newaxis] * normal
+		with np.errstate(divide='ignore', invalid='ignore'):
+			O1 = Center(A, B, alpha)
+			O2 = Center(B, C, beta)
+			# Reflect B at the line through both circle centers
+			d = O2 - O1
+			t = np.sum((B - O1) * d, -1) / np.sum(d * d, -1)
+			foot = O1 + t[...,np.newaxis] * d
+			return 2.0 * foot - B
+
+	# Closed-form initial guess from the leftmost, middle and rightmost
+	# point; falls back to the center of gravity of all points
+	@staticmethod
+	def InitialGuess(Pn, angles):
+		n = Pn.shape[0]
+		if n >= 3:
+			i, j, k = 0, n // 2, n - 1
+			P0 = Resection.ThreePoint(Pn[i], Pn[j], Pn[k], \
+				angles[j] - angles[i], angles[k] - angles[j])
+			if np.all(np.isfinite(P0)):
+				return P0
+		return np.mean(Pn, 0)
+
+	# Create result for the final P0
+	@staticmethod
+	def MakeResult(P0, Pn, angles, iterations, evaluations, converged):
+		residuals = WrapAngle(Resection.ForwardTransform(P0, Pn) - angles)
+		J = Resection.Jacobian(P0, Pn)
+		dof = J.shape[0] - 2
+		covariance = np.full((2, 2), np.nan)
+		if dof > 0:
+			sigma2 = np.sum(np.square(residuals)) / dof
+			try:
+				covariance = sigma2 * np.linalg.inv(J.T.dot(J))
+			except np.linalg.LinAlgError:
+				pass
+		delta = Pn - P0
+		direction = np.angle(np.mean(np.exp(1j * \
+			(np.arctan2(delta[:,1], delta[:,0]) + angles))))
+		return ResectionResult(P0, covariance, residuals, iterations, evaluations, \
+			converged, direction)
+
+	# Report an intermediate iterate to the progress callback (if any)
+	def Report(self, iteration, P0, cost):
+		if self.callback is not None:
+			self.callback(iteration, P0, cost)
+
+	# Implemented by every engine; returns a ResectionResult
+	@abstractmethod
+	def Solve(self, Pn, angles, P0_start=None):
+		pass
+
+
+
+# Levenberg-Marquardt solver using the analytic Jacobian
+@Resection.Register('lm')
+class LevenbergMarquardtResection(Resection):
+
+	def __init__(self, maxIterations=100, xtol=1e-6, lambdaStart=1e-3):
+		self.maxIterations = maxIterations
+		self.xtol = xtol # in m
+		self.lambdaStart = lambdaStart
+
+	def Solve(self, Pn, angles, P0_start=None):
+		Pn = np.asarray(Pn, dtype=float)
+		angles = np.asarray(angles, dtype=float)
+		if Pn.shape[0] < 3:
+			raise ValueError('Resection needs at least three points')
+		P0 = Resection.InitialGuess(Pn, angles) if P0_start is None \
+			else np.asarray(P0_start, dtype=float)
+		r = Resection.Residuals(P0, Pn, angles)
+		cost = np.sum(np.square(r))
+		lam = self.lambdaStart
+		evaluations = 1
+		converged = False
+		iteration = 0
+		while iteration < self.maxIterations:
+			iteration += 1
+			J = Resection.Jacobian(P0, Pn)
+			JtJ = J.T.dot(J)
+			Jtr = J.T.dot(r)
+			# Damping loop: increase lambda until the step decreases the cost
+			while True:
+				A = JtJ + lam * np.diag(np.diag(JtJ))
+				try:
+					step = -np.linalg.solve(A, Jtr)
+				except np.linalg.LinAlgError:
+					step = None
+				if step is not None:
+					P1 = P0 + step
+					r1 = Resection.Residuals(P1, Pn, angles)
+					cost1 = np.sum(np.square(r1))
+					evaluations += 1
+					if cost1 <= cost:
+						break
+				lam *= 10.0
+				if lam > 1e12:
+					break
+			if lam > 1e12:
+				# No further decrease possible: we are at the minimum
+				converged = True
+				break
+			P0, r, cost = P1, r1, cost1
+			self.Report(iteration, P0, cost)
+			lam = max(lam / 10.0, 1e-12)
+			if np.linalg.norm(step) < self.xtol:
+				converged = True
+				break
+		return Resection.MakeResult(P0, Pn, angles, iteration, evaluations, converged)
+
+
+
+# Nelder-Mead simplex search on the sum of squared residuals (derivative free)
+@Resection.Register('nelder-mead')
+class NelderMeadResection(Resection):
+
+	def __init__(self, maxIterations=1000000, xtol=1e-8):
+		self.maxIterations = maxIterations
+		self.xtol = xtol
+
+	def Solve(self, Pn, angles, P0_start=None):
+		from scipy.optimize import minimize
+		Pn = np.asarray(Pn, dtype=float)
+		angles = np.asarray(angles, dtype=float)
+		if P0_start is None:
+			P0_start = Resection.InitialGuess(Pn, angles)
+		iterations = [ 0 ]
+		def Callback(P0):
+			iterations[0] += 1
+			self.Report(iterations[0], P0, Resection.ObjFunc(P0, Pn, angles))
+		with Span('resection.minimize'):
+			res = minimize(Resection.ObjFunc, P0_start, args=(Pn,angles), method='nelder-mead', \
+				callback=None if self.callback is None else Callback, \
+				options={'maxfev': self.maxIterations, 'maxiter': self.maxIterations, \
+				'xatol': self.xtol})
+		return Resection.MakeResult(res.x, Pn, angles, res.nit, res.nfev, res.success)
+
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Skyline extraction and automatic tagging: the boundary between sky and
+# terrain is found in every column of a reduced resolution decode of the
+# image, its local maxima are matched against the bearings of the places
+# around the camera and proposed as markers. Needs no GUI.
+
+
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from marker import Marker, MarkerList
+from resection import Resection, WrapAngle
+from exif import ReadExifInfo, GetFocalLength, GetGpsPlace, GetCameraDatabase
+from instrumentation import Span
+
+
+
+# Decodes an image as grayscale (0..1) reduced by a power of two to at most
+# about maxWidth columns, for JPEGs already in the DCT domain; returns
+# (image, (x scale, y scale)) with the scales in full resolution pixels per
+# decoded pixel
+def DecodeReduced(filename, maxWidth=1024):
+	# Pillow is only needed here
+	from PIL import Image
+	with Span('skyline.decode'):
+		with Image.open(filename) as image:
+			(width, height) = image.size
+			reduction = 1
+			while reduction < 8 and width > reduction * maxWidth:
+				reduction *= 2
+			image.draft('L', ((width + reduction - 1) // reduction, (height + reduction - 1) // reduction))
+			image = image.convert('L')
+			# Formats without DCT scaling are reduced after decoding
+			if image.width > maxWidth:
+				image = image.reduce(int(np.ceil(image.width / maxWidth)))
+			gray = np.asarray(image, dtype=np.float32) / 255.0
+	return (gray, (width / gray.shape[1], height / gray.shape[0]))
+
+# Mean over (2 * radius + 1)^2 pixels by cumulative sums, edges replicated
+def BoxFilter(image, radius):
+	size = 2 * radius + 1
+	padded = np.pad(image, radius + 1, mode='edge')
+	s = np.cumsum(padded, axis=0, dtype=np.float32)
+	s = s[size:] - s[:-size]
+	s = np.cumsum(s, axis=1, dtype=np.float32)
+	s = s[:, size:] - s[:, :-size]
+	return s / float(size * size)
+
+# Skyline of a grayscale image: for every column the row of the strongest
+# bright (above) to dark (below) edge, penalized by the texture above it,
+# so the first strong edge below the smooth sky wins over edges inside the
+# terrain; returns (rows, edge strengths) per column
+def ExtractSkyline(gray, radius=2, texturePenalty=0.5, medianWidth=5):
+	with Span('skyline.extract'):
+		smooth = BoxFilter(gray, radius)
+		k = radius + 1
+		score = np.full(smooth.shape, -np.inf, dtype=np.float32)
+		edge = smooth[:-2*k] - smooth[2*k:]
+		# Cumulative absolute vertical gradient from the top to the upper end of the edge
+		texture = np.cumsum(np.abs(np.diff(smooth, axis=0)), axis=0, dtype=np.float32)
+		score[k:-k] = edge
+		score[k+1:-k] -= texturePenalty * texture[:edge.shape[0]-1]
+		rows = np.argmax(score, axis=0)
+		columns = np.arange(rows.size)
+		strength = np.zeros(rows.size, dtype=np.float32)
+		inside = (rows >= k) & (rows < smooth.shape[0] - k)
+		strength[inside] = edge[rows[inside] - k, columns[inside]]
+		# Median across columns removes single column outliers
+		if medianWidth > 1 and rows.size >= medianWidth:
+			half = medianWidth // 2
+			rows = np.median(sliding_window_view(np.pad(rows, half, mode='edge'), medianWidth), axis=1)
+	return (rows.astype(float), strength)
+
+# Columns of local maxima (minimum rows) of a skyline standing out by at
+# least minProminence rows within window columns to both sides; plateaus
+# yield their center
+def SkylinePeaks(rows, strength, window=15, minProminence=3.0, minStrength=0.05):
+	if rows.size == 0:
+		return np.zeros(0, dtype=int)
+	windows = sliding_window_view(np.pad(rows, window, mode='edge'), 2 * window + 1)
+	isPeak = (rows <= np.min(windows, axis=1)) & \
+		(np.max(windows, axis=1) - rows >= minProminence) & (strength >= minStrength)
+	candidates = np.nonzero(isPeak)[0]
+	if candidates.size == 0:
+		return candidates
+	breaks = np.nonzero((np.diff(candidates) > 1) | (np.diff(rows[candidates]) != 0))[0] + 1
+	return np.array([ group[group.size // 2] for group in np.split(candidates, breaks) ], dtype=int)
+
+# Assigns peaks seen at clockwise angles from the left image border to
+# places at azimuths (counter-clockwise, like Resection directions); if the
+# heading (azimuth of the left image border) is unknown, it is voted for by
+# all pairs of peaks and places first. Returns (list of (peak index, place
+# index), heading)
+def MatchPeaks(angles, azimuths, heading=None, tolerance=np.radians(0.5), \
+	binWidth=np.radians(0.25)):
+	angles = np.asarray(angles, dtype=float)
+	azimuths = np.asarray(azimuths, dtype=float)
+	if angles.size == 0 or azimuths.size == 0:
+		return ([], heading)
+	with Span('skyline.match', peaks=int(angles.size), places=int(azimuths.size)):
+		if heading is None:
+			votes = np.mod(azimuths[np.newaxis,:] + angles[:,np.newaxis], 2.0 * np.pi).ravel()
+			numBins = int(np.ceil(2.0 * np.pi / binWidth))
+			histogram = np.bincount((votes / binWidth).astype(int) % numBins, minlength=numBins)
+			# Votes near bin borders count for both neighbours
+			histogram = histogram + np.roll(histogram, 1) + np.roll(histogram, -1)
+			center = (np.argmax(histogram) + 0.5) * binWidth
+			near = np.abs(WrapAngle(votes - center)) <= 1.5 * binWidth
+			heading = center + np.mean(WrapAngle(votes[near] - center))
+		cost = np.abs(WrapAngle(heading - angles[:,np.newaxis] - azimuths[np.newaxis,:]))
+		from scipy.optimize import linear_sum_assignment
+		gated = np.where(cost <= tolerance, cost, 1e6)
+		(peakIndices, placeIndices) = linear_sum_assignment(gated)
+		pairs = [ (int(i), int(j)) for (i, j) in zip(peakIndices, placeIndices) if cost[i, j] <= tolerance ]
+	return (pairs, heading)
+
+
+
+# Markers proposed for an image from its skyline
+class SkylineProposal:
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.position = None
+		self.heading = None
+		# Skyline and its peaks in full resolution image coordinates
+		self.skylineX = None
+		self.skylineY = None
+		self.peakX = None
+		self.peakY = None
+		self.markerList = MarkerList()
+
+	# Propose markers for image filename seen from position (CH1903, by
+	# default the GPS tag of the image) with the azimuth of the left image
+	# border heading (voted for if None); candidate places are the places
+	# visible according to horizonEngine if given, otherwise the
+	# numCandidates places within maxDistance appearing highest above the
+	# camera
+	@staticmethod
+	def Run(filename, places, position=None, heading=None, horizonEngine=None, \
+		maxDistance=50000.0, numCandidates=60, maxWidth=1024, tolerance=np.radians(0.5)):
+		proposal = SkylineProposal(filename)
+		exifInfo = ReadExifInfo(filename)
+		focalLengthMillimeters = GetFocalLength(exifInfo)
+		if position is None:
+			gpsPlace = GetGpsPlace(exifInfo)
+			if gpsPlace is None:
+				raise ValueError('No position for {0}'.format(filename))
+			position = gpsPlace.CH1903()[0:2]
+		proposal.position = np.asarray(position, dtype=float)
+
+		(gray, scale) = DecodeReduced(filename, maxWidth)
+		# Peaks are in pixels of the file, which may be a resized export
+		(sensorWidthMillimeters, sensorWidthPixels) = GetCameraDatabase().GetSensorGeometry(exifInfo,
+			int(round(scale[0] * gray.shape[1])))
+		(rows, strength) = ExtractSkyline(gray)
+		proposal.skylineX = (np.arange(rows.size) + 0.5) * scale[0]
+		proposal.skylineY = (rows + 0.5) * scale[1]
+		peaks = SkylinePeaks(rows, strength)
+		proposal.peakX = proposal.skylineX[peaks]
+		proposal.peakY = proposal.skylineY[peaks]
+		angles = Resection.ImageAngles(proposal.peakX, focalLengthMillimeters, \
+			sensorWidthMillimeters, sensorWidthPixels)
+
+		if horizonEngine is not None:
+			visible = horizonEngine.VisiblePlaces(proposal.position)
+			(indices, azimuths) = (visible['indices'], visible['azimuths'])
+		else:
+			indices = places.WithinRadius(proposal.position, maxDistance)
+			distances = np.maximum(places.Distances(proposal.position, indices), 1.0)
+			indices = indices[np.argsort(-places.heights[indices] / distances)[:numCandidates]]
+			delta = places.ch1903[indices] - proposal.position
+			azimuths = np.arctan2(delta[:,1], delta[:,0])
+		(pairs, proposal.heading) = MatchPeaks(angles, azimuths, heading, tolerance)
+		for (i, j) in sorted(pairs):
+			proposal.markerList.append(Marker(float(proposal.peakX[i]), float(proposal.peakY[i]),
+				places.Key(indices[j])))
+		return proposal
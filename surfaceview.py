@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QDialog, QVBoxLayout
+
+
+
+# Quantiles of the chi-square distribution with two degrees of freedom
+# for the 1, 2 and 3 sigma confidence regions of a 2D position
+confidenceLevels = [ ('68%', 2.30), ('95%', 6.18), ('99.7%', 11.83) ]
+
+
+
+# Non-modal diagnostics of a position estimation: heatmap of the objective
+# function around the estimate with confidence contours and the bearings
+# to the markers, plus the residuals of the markers
+class ObjectiveSurfaceView(QDialog):
+
+	def __init__(self, estimation, size=1000, parent=None):
+		super(ObjectiveSurfaceView, self).__init__(parent)
+		self.setWindowTitle('Position Estimation')
+		self.setAttribute(Qt.WA_DeleteOnClose)
+		self.figure = Figure(figsize=(8, 9))
+		self.canvas = FigureCanvasQTAgg(self.figure)
+		layout = QVBoxLayout(self)
+		layout.addWidget(NavigationToolbar2QT(self.canvas, self))
+		layout.addWidget(self.canvas)
+		self.plot(estimation, size)
+
+	def plot(self, estimation, size):
+		(ys, xs, cost) = estimation.ObjectiveSurface(size)
+		result = estimation.result
+		Pn = estimation.Pn
+		(surfaceAxes, residualAxes) = self.figure.subplots(2, 1, \
+			gridspec_kw={ 'height_ratios': [ 4, 1 ] })
+		extent = (ys[0], ys[-1], xs[0], xs[-1])
+		image = surfaceAxes.imshow(np.log10(cost + 1e-12), origin='lower', extent=extent, \
+			cmap='viridis', interpolation='nearest')
+		self.figure.colorbar(image, ax=surfaceAxes, label='log10 objective (rad^2)')
+		# Confidence regions from the increase of the objective, with the
+		# angle variance estimated from the residuals at the minimum
+		minCost = np.min(cost)
+		numPoints = Pn.shape[0] if result.inliers is None else np.count_nonzero(result.inliers)
+		dof = numPoints - 3
+		if dof > 0:
+			sigma2 = max(minCost, 1e-16) / dof
+			contours = surfaceAxes.contour(ys, xs, cost, \
+				levels=[ minCost + sigma2 * q for (name, q) in confidenceLevels ], \
+				colors=[ 'white', 'orange', 'red' ], linewidths=1)
+			surfaceAxes.clabel(contours, fmt={ level: name for (level, (name, q)) in \
+				zip(contours.levels, confidenceLevels) }, fontsize=8)
+		# Observed bearings from the estimate to the markers
+		P0 = result.position
+		bearings = result.direction - estimation.angles
+		distances = np.sqrt(np.sum(np.square(Pn - P0), 1))
+		ends = P0 + distances[:,np.newaxis] * np.column_stack((np.cos(bearings), np.sin(bearings)))
+		for end in ends:
+			surfaceAxes.plot([ P0[0], end[0] ], [ P0[1], end[1] ], '-', color='white', \
+				linewidth=0.5, alpha=0.7)
+		surfaceAxes.plot(Pn[:,0], Pn[:,1], '^w')
+		surfaceAxes.plot(P0[0], P0[1], '+r', markersize=12)
+		if estimation.gpsPlace is not None:
+			gps = estimation.gpsPlace.CH1903()
+			surfaceAxes.plot(gps[0], gps[1], 'xm', markersize=10, label='GPS')
+			surfaceAxes.legend(loc='upper right')
+		surfaceAxes.set_xlim(extent[0], extent[1])
+		surfaceAxes.set_ylim(extent[2], extent[3])
+		surfaceAxes.set_xlabel('CH1903 y (m)')
+		surfaceAxes.set_ylabel('CH1903 x (m)')
+		surfaceAxes.ticklabel_format(useOffset=False, style='plain')
+		surfaceAxes.set_aspect('equal')
+		# Residuals of the markers from left to right
+		residuals = estimation.Residuals()
+		colors = [ 'tab:blue' ] * len(residuals)
+		if result.inliers is not None:
+			colors = [ 'tab:blue' if inlier else 'tab:orange' for inlier in result.inliers ]
+		residualAxes.bar(np.arange(len(residuals)), residuals, color=colors)
+		if estimation.keys is not None:
+			residualAxes.set_xticks(np.arange(len(residuals)))
+			residualAxes.set_xticklabels([ key.rsplit(' ', 1)[0] for key in estimation.keys ], \
+				rotation=60, ha='right', fontsize=7)
+		residualAxes.set_ylabel('Residuals (degrees)')
+		residualAxes.grid(axis='y')
+		self.figure.tight_layout()
+		self.canvas.draw_idle()
+
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Inverted index from place keys to the images tagged with them:
+#
+#   tagindex.py update ROOT           scan ROOT, re-read changed sidecars only
+#   tagindex.py query ROOT KEY...     list images (and marker coordinates) of keys
+#   tagindex.py query --name ROOT NAME...   same, matching place names
+#   tagindex.py keys ROOT             list all keys with their number of images
+
+
+
+import sys, os
+import argparse
+import sqlite3
+import time
+from marker import MarkerList
+
+
+
+class TagIndex:
+
+	defaultFilename = '.imagetagger-index.sqlite'
+
+	schema = [
+		'CREATE TABLE IF NOT EXISTS sidecars (path TEXT PRIMARY KEY, ' \
+			'size INTEGER NOT NULL, mtime INTEGER NOT NULL)',
+		'CREATE TABLE IF NOT EXISTS tags (key TEXT NOT NULL, path TEXT NOT NULL, ' \
+			'x REAL NOT NULL, y REAL NOT NULL)',
+		'CREATE INDEX IF NOT EXISTS tags_key ON tags (key)',
+		'CREATE INDEX IF NOT EXISTS tags_path ON tags (path)',
+	]
+
+	# Index of the photo tree below root, stored in root unless filename is given
+	def __init__(self, root, filename=None):
+		self.root = os.path.abspath(root)
+		if filename is None:
+			filename = os.path.join(self.root, TagIndex.defaultFilename)
+		self.connection = sqlite3.connect(filename, timeout=30.0)
+		self.connection.execute('PRAGMA journal_mode=WAL')
+		for statement in TagIndex.schema:
+			self.connection.execute(statement)
+		self.connection.commit()
+
+	def Close(self):
+		self.connection.close()
+
+	# Yields (relative path of sidecar, stat) of all sidecars of JPEGs
+	def ScanSidecars(self):
+		stack = [ self.root ]
+		while len(stack) > 0:
+			directory = stack.pop()
+			try:
+				entries = list(os.scandir(directory))
+			except OSError:
+				continue
+			names = set()
+			images = []
+			for entry in entries:
+				if entry.is_dir(follow_symlinks=False):
+					stack.append(entry.path)
+					continue
+				(base, ext) = os.path.splitext(entry.name)
+				if ext.lower() in ('.jpg', '.jpeg'):
+					images.append(base)
+				names.add(entry.name)
+			for base in images:
+				name = base + '.json'
+				if name in names:
+					path = os.path.join(directory, name)
+					yield (os.path.relpath(path, self.root).replace(os.sep, '/'), os.stat(path))
+
+	# Bring the index up to date; only sidecars whose size or modification
+	# time changed are read; returns (number updated, number removed)
+	def Update(self):
+		known = { path: (size, mtime) for (path, size, mtime) in \
+			self.connection.execute('SELECT path, size, mtime FROM sidecars') }
+		seen = set()
+		updated = 0
+		with self.connection:
+			for (path, stat) in self.ScanSidecars():
+				seen.add(path)
+				if known.get(path) == (stat.st_size, stat.st_mtime_ns):
+					continue
+				markerList = MarkerList()
+				try:
+					markerList.Load(os.path.join(self.root, path))
+				except ValueError:
+					continue # Invalid JSON, e.g. written right now
+				self.connection.execute('DELETE FROM tags WHERE path=?', (path,))
+				self.connection.executemany('INSERT INTO tags VALUES (?, ?, ?, ?)',
+					[ (marker.key, path, marker.x, marker.y) for marker in markerList ])
+				self.connection.execute('INSERT OR REPLACE INTO sidecars VALUES (?, ?, ?)',
+					(path, stat.st_size, stat.st_mtime_ns))
+				updated += 1
+			removed = [ (path,) for path in known if path not in seen ]
+			self.connection.executemany('DELETE FROM tags WHERE path=?', removed)
+			self.connection.executemany('DELETE FROM sidecars WHERE path=?', removed)
+		return (updated, len(removed))
+
+	# Images tagged with key, as list of (image filename, x, y)
+	def Find(self, key):
+		rows = self.connection.execute('SELECT path, x, y FROM tags WHERE key=? ' \
+			'ORDER BY path', (key,)).fetchall()
+		return [ (self.ImageFilename(path), x, y) for (path, x, y) in rows ]
+
+	# Images tagged with a place of name (any height), as list of (key, image filename, x, y)
+	def FindName(self, name):
+		prefix = name + ' '
+		rows = self.connection.execute('SELECT key, path, x, y FROM tags WHERE key>=? AND key<? ' \
+			'ORDER BY key, path', (prefix, prefix + '\U0010ffff')).fetchall()
+		return [ (key, self.ImageFilename(path), x, y) for (key, path, x, y) in rows ]
+
+	# All keys with the number of images tagged with them
+	def Keys(self):
+		return self.connection.execute('SELECT key, COUNT(DISTINCT path) FROM tags ' \
+			'GROUP BY key ORDER BY key').fetchall()
+
+	# Image belonging to a sidecar path of the index
+	def ImageFilename(self, path):
+		base = os.path.join(self.root, os.path.splitext(path)[0])
+		for ext in ('.jpg', '.JPG', '.jpeg', '.JPEG'):
+			if os.path.exists(base + ext):
+				return base + ext
+		return base + '.jpg'
+
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Index of tagged places of a photo tree')
+	subparsers = parser.add_subparsers(dest='command')
+	subparsers.required = True
+	updateParser = subparsers.add_parser('update', help='update index of photo tree')
+	updateParser.add_argument('root')
+	queryParser = subparsers.add_parser('query', help='list images showing places')
+	queryParser.add_argument('--name', action='store_true',
+		help='match place names instead of keys ("<Name> <Height>m")')
+	queryParser.add_argument('--no-update', action='store_true',
+		help='do not update the index before querying')
+	queryParser.add_argument('root')
+	queryParser.add_argument('places', nargs='+')
+	keysParser = subparsers.add_parser('keys', help='list all tagged keys')
+	keysParser.add_argument('root')
+	args = parser.parse_args(argv)
+
+	index = TagIndex(args.root)
+	try:
+		if args.command == 'update' or (args.command == 'query' and not args.no_update):
+			start = time.time()
+			(updated, removed) = index.Update()
+			print('Updated {0} and removed {1} sidecars in {2:.3f}s'.format(updated, removed,
+				time.time() - start), file=sys.stderr)
+		if args.command == 'query':
+			for place in args.places:
+				if args.name:
+					for (key, filename, x, y) in index.FindName(place):
+						print('{0}\t{1}\t{2}\t{3}'.format(key, filename, x, y))
+				else:
+					for (filename, x, y) in index.Find(place):
+						print('{0}\t{1}\t{2}\t{3}'.format(place, filename, x, y))
+		elif args.command == 'keys':
+			for (key, count) in index.Keys():
+				print('{0}\t{1}'.format(key, count))
+	finally:
+		index.Close()
+	return 0
+
+
+
+if __name__ == '__main__':
+	sys.exit(main())
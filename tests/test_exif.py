@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import os
+import sys
+import struct
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from exif import ParseExifSegment
+
+
+
+# TIFF structure (little endian) with Model in IFD0 and FocalLength in the
+# EXIF IFD; the strings and the rational are stored behind the IFDs
+def MakeExifSegment():
+	model = b'NIKON D800\x00'
+	ifd0Offset = 8
+	exifIfdOffset = ifd0Offset + 2 + 2 * 12 + 4
+	modelOffset = exifIfdOffset + 2 + 12 + 4
+	focalLengthOffset = modelOffset + len(model)
+	data = b'II*\x00' + struct.pack('<I', ifd0Offset)
+	data += struct.pack('<H', 2)
+	data += struct.pack('<HHII', 0x0110, 2, len(model), modelOffset)
+	data += struct.pack('<HHII', 0x8769, 4, 1, exifIfdOffset)
+	data += struct.pack('<I', 0)
+	data += struct.pack('<H', 1)
+	data += struct.pack('<HHII', 0x920A, 5, 1, focalLengthOffset)
+	data += struct.pack('<I', 0)
+	data += model + struct.pack('<II', 240, 10)
+	return data
+
+
+
+class ParseExifSegmentTest(unittest.TestCase):
+
+	def testValid(self):
+		exifInfo = ParseExifSegment(MakeExifSegment())
+		self.assertEqual(exifInfo['Model'], 'NIKON D800')
+		self.assertAlmostEqual(exifInfo['FocalLength'], 24.0)
+
+	# Every truncation either parses (tags behind the end are skipped) or
+	# raises ValueError, never struct.error
+	def testTruncated(self):
+		data = MakeExifSegment()
+		for length in range(len(data)):
+			try:
+				ParseExifSegment(data[:length])
+			except ValueError:
+				pass
+
+	def testTruncatedIfd(self):
+		with self.assertRaises(ValueError):
+			ParseExifSegment(b'II*\x00\xff\xff\x00\x00')
+		with self.assertRaises(ValueError):
+			ParseExifSegment(MakeExifSegment()[:20])
+
+	def testInvalidIfdOffset(self):
+		data = bytearray(MakeExifSegment())
+		# EXIF IFD pointer behind the end of the segment
+		struct.pack_into('<I', data, 8 + 2 + 12 + 8, len(data) + 100)
+		with self.assertRaises(ValueError):
+			ParseExifSegment(bytes(data))
+
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import os
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QRect, QSize, QTimer, pyqtSignal
+from PyQt5.QtGui import QColor, QFont, QPainter, QPixmap
+from PyQt5.QtWidgets import QDockWidget, QListView, QStyledItemDelegate, QAbstractItemView
+from thumbnails import ThumbnailLoader
+
+
+
+# Images of a directory with their thumbnails; thumbnails are requested
+# when the view asks for them, i.e. when they become visible
+class ThumbnailModel(QAbstractListModel):
+
+	ThumbnailRole = Qt.UserRole
+
+	def __init__(self, loader, parent=None):
+		super(ThumbnailModel, self).__init__(parent)
+		self.loader = loader
+		self.loader.loaded.connect(self.thumbnailLoaded)
+		self.filenames = []
+		self.rows = {}
+		self.thumbnails = {}
+		self.pixmaps = {}
+		self.requested = set()
+		self.placeholder = QPixmap(loader.size, loader.size * 2 // 3)
+		self.placeholder.fill(QColor(96, 96, 96))
+
+	def setFilenames(self, filenames):
+		self.beginResetModel()
+		self.loader.cancelRequests()
+		self.filenames = list(filenames)
+		self.rows = { filename: row for (row, filename) in enumerate(self.filenames) }
+		self.thumbnails = {}
+		self.pixmaps = {}
+		self.requested = set()
+		self.endResetModel()
+
+	# Load thumbnails and status again, e.g. after the marker store changed
+	def reload(self):
+		self.setFilenames(self.filenames)
+
+	def rowCount(self, parent=QModelIndex()):
+		return 0 if parent.isValid() else len(self.filenames)
+
+	def data(self, index, role=Qt.DisplayRole):
+		if not index.isValid():
+			return None
+		filename = self.filenames[index.row()]
+		if role == Qt.DisplayRole:
+			return os.path.basename(filename)
+		if role == Qt.ToolTipRole:
+			thumbnail = self.thumbnails.get(filename)
+			if thumbnail is None:
+				return filename
+			return '{0}\n{1} markers{2}'.format(filename, thumbnail.numMarkers,
+				', position estimated' if thumbnail.estimated else '')
+		if role == Qt.DecorationRole:
+			if filename not in self.requested:
+				self.requested.add(filename)
+				self.loader.request(filename)
+			return self.pixmaps.get(filename, self.placeholder)
+		if role == ThumbnailModel.ThumbnailRole:
+			return self.thumbnails.get(filename)
+		return None
+
+	# Pixmaps can only be created in the GUI thread, so here
+	def thumbnailLoaded(self, filename, thumbnail):
+		row = self.rows.get(filename)
+		if row is None:
+			return
+		self.thumbnails[filename] = thumbnail
+		if thumbnail.image is not None:
+			self.pixmaps[filename] = QPixmap.fromImage(thumbnail.image)
+		index = self.index(row)
+		self.dataChanged.emit(index, index)
+
+	# Only keep requests of rows in the range first..last (inclusive)
+	def keepRequests(self, first, last):
+		visible = set(self.filenames[max(first, 0):last + 1])
+		for filename in self.loader.cancelRequestsExcept(visible):
+			self.requested.discard(filename)
+
+	# Update the badge of an image after its markers changed or its position
+	# was estimated (None keeps the current value)
+	def setStatus(self, filename, numMarkers=None, estimated=None):
+		thumbnail = self.thumbnails.get(filename)
+		row = self.rows.get(filename)
+		if thumbnail is None or row is None:
+			return
+		if numMarkers is not None:
+			thumbnail.numMarkers = numMarkers
+		if estimated is not None:
+			thumbnail.estimated = estimated
+		index = self.index(row)
+		self.dataChanged.emit(index, index)
+
+
+
+# Paints the thumbnail with a badge in its upper right corner: the number
+# of markers, green if there are enough to estimate the position, orange
+# if there are too few, blue if the position has been estimated
+class ThumbnailDelegate(QStyledItemDelegate):
+
+	minMarkers = 3
+
+	def paint(self, painter, option, index):
+		super(ThumbnailDelegate, self).paint(painter, option, index)
+		thumbnail = index.data(ThumbnailModel.ThumbnailRole)
+		if thumbnail is None or thumbnail.numMarkers == 0:
+			return
+		if thumbnail.estimated:
+			color = QColor(40, 110, 220)
+		elif thumbnail.numMarkers >= ThumbnailDelegate.minMarkers:
+			color = QColor(40, 160, 60)
+		else:
+			color = QColor(230, 130, 0)
+		text = str(thumbnail.numMarkers)
+		painter.save()
+		painter.setRenderHint(QPainter.Antialiasing)
+		font = QFont(option.font)
+		font.setBold(True)
+		painter.setFont(font)
+		metrics = painter.fontMetrics()
+		height = metrics.height() + 2
+		width = max(height, metrics.horizontalAdvance(text) + 8)
+		rect = QRect(option.rect.right() - width - 2, option.rect.top() + 2, width, height)
+		painter.setPen(Qt.NoPen)
+		painter.setBrush(color)
+		painter.drawRoundedRect(rect, height / 2.0, height / 2.0)
+		painter.setPen(Qt.white)
+		painter.drawText(rect, Qt.AlignCenter, text)
+		painter.restore()
+
+
+
+# Dock with a grid of thumbnails of the images in the current directory;
+# activating a thumbnail opens its image
+class ThumbnailDock(QDockWidget):
+
+	imageActivated = pyqtSignal(str)
+
+	def __init__(self, size=128, parent=None):
+		super(ThumbnailDock, self).__init__('Thumbnails', parent)
+		self.setObjectName('ThumbnailDock')
+		self.loader = ThumbnailLoader(size, parent=self)
+		self.model = ThumbnailModel(self.loader, self)
+		self.view = QListView(self)
+		self.view.setViewMode(QListView.IconMode)
+		self.view.setResizeMode(QListView.Adjust)
+		self.view.setMovement(QListView.Static)
+		self.view.setUniformItemSizes(True)
+		# Lay out large directories in batches, the grid is shown immediately
+		self.view.setLayoutMode(QListView.Batched)
+		self.view.setBatchSize(200)
+		self.view.setIconSize(QSize(size, size))
+		self.view.setGridSize(QSize(size + 16, size + 2 * self.view.fontMetrics().height()))
+		self.view.setTextElideMode(Qt.ElideMiddle)
+		self.view.setSelectionMode(QAbstractItemView.SingleSelection)
+		self.view.setItemDelegate(ThumbnailDelegate(self.view))
+		self.view.setModel(self.model)
+		self.view.activated.connect(self.onActivated)
+		self.view.clicked.connect(self.onActivated)
+		# Requests scrolled out of view are dropped after scrolling stopped
+		self.scrollTimer = QTimer(self)
+		self.scrollTimer.setSingleShot(True)
+		self.scrollTimer.setInterval(150)
+		self.scrollTimer.timeout.connect(self.dropInvisibleRequests)
+		self.view.verticalScrollBar().valueChanged.connect(self.scrollTimer.start)
+		self.setWidget(self.view)
+
+	def showFiles(self, filenames):
+		if list(filenames) != self.model.filenames:
+			self.model.setFilenames(filenames)
+
+	def setStore(self, store):
+		self.loader.setStore(store)
+		self.model.reload()
+
+	def setCurrent(self, filename):
+		row = self.model.rows.get(filename)
+		if row is not None:
+			index = self.model.index(row)
+			self.view.setCurrentIndex(index)
+			self.view.scrollTo(index)
+
+	def setMarkerCount(self, filename, numMarkers):
+		self.model.setStatus(filename, numMarkers=numMarkers)
+
+	def setEstimated(self, filename):
+		self.model.setStatus(filename, estimated=True)
+
+	def onActivated(self, index):
+		self.imageActivated.emit(self.model.filenames[index.row()])
+
+	def dropInvisibleRequests(self):
+		first = self.view.indexAt(self.view.viewport().rect().topLeft())
+		last = self.view.indexAt(self.view.viewport().rect().bottomRight())
+		if first.isValid():
+			self.model.keepRequests(first.row(), last.row() if last.isValid() \
+				else self.model.rowCount() - 1)
+
+	def shutdown(self):
+		self.loader.shutdown()
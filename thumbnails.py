@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtCore import QObject, QSize, Qt, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader
+from marker import MarkerList
+from projectstore import SidecarStore
+from instrumentation import Span, Count
+
+
+
+# Thumbnail of an image with the marker count and estimation status of the
+# image; image is None if the file cannot be decoded
+class Thumbnail:
+
+	def __init__(self, filename, image=None, numMarkers=0, estimated=False):
+		self.filename = filename
+		self.image = image
+		self.numMarkers = numMarkers
+		self.estimated = estimated
+
+
+
+# Thumbnails stored as JPEGs on disk; entries are keyed by path, size and
+# modification time of the image and the thumbnail size, so changed images
+# get a new entry
+class ThumbnailCache:
+
+	def __init__(self, directory, size):
+		self.directory = directory
+		self.size = size
+		os.makedirs(directory, exist_ok=True)
+
+	@staticmethod
+	def DefaultDirectory():
+		directory = os.environ.get('IMAGETAGGER_CACHE_DIR',
+			os.path.join(os.path.expanduser('~'), '.cache', 'imagetagger'))
+		return os.path.join(directory, 'thumbnails')
+
+	def Filename(self, path, stat):
+		key = '{0}\0{1}\0{2}\0{3}'.format(path, stat.st_size, stat.st_mtime_ns, self.size)
+		digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+		return os.path.join(self.directory, digest[:2], digest + '.jpg')
+
+	def Get(self, path, stat):
+		filename = self.Filename(path, stat)
+		if not os.path.exists(filename):
+			return None
+		image = QImage(filename)
+		return None if image.isNull() else image
+
+	# Written to a temporary file first, readers never see partial files
+	def Put(self, path, stat, image):
+		filename = self.Filename(path, stat)
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		tempFilename = '{0}.{1}.tmp'.format(filename, os.getpid())
+		if image.save(tempFilename, 'JPEG', 85):
+			os.replace(tempFilename, filename)
+
+
+
+# Decodes image filename at reduced scale to fit into size x size pixels;
+# the JPEG decoder scales in the DCT domain, the full image is never
+# decoded. Uses the disk cache if given; may be called from a worker thread
+def LoadThumbnailImage(filename, size, cache=None):
+	path = os.path.abspath(filename)
+	stat = os.stat(path)
+	if cache is not None:
+		image = cache.Get(path, stat)
+		if image is not None:
+			Count('thumbnail.cache_hits')
+			return image
+	Count('thumbnail.cache_misses')
+	with Span('thumbnail.decode'):
+		reader = QImageReader(path)
+		reader.setAutoTransform(True)
+		imageSize = reader.size()
+		if imageSize.isValid():
+			reader.setScaledSize(imageSize.scaled(QSize(size, size), Qt.KeepAspectRatio))
+		image = reader.read()
+	if image.isNull():
+		return None
+	if image.width() > size or image.height() > size:
+		# Orientation applied after scaling, or no scaling by the reader
+		image = image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+	if cache is not None:
+		try:
+			cache.Put(path, stat, image)
+		except OSError:
+			pass
+	return image
+
+# Number of markers and whether an estimation result is stored, from the
+# marker store (sidecar or project database)
+def ReadImageStatus(filename, store):
+	markerList = MarkerList()
+	try:
+		store.LoadMarkers(filename, markerList)
+	except (OSError, ValueError):
+		pass
+	estimated = hasattr(store, 'GetEstimate') and store.GetEstimate(filename) is not None
+	return (len(markerList), estimated)
+
+# Thumbnail and status of an image; may be called from a worker thread
+def LoadThumbnail(filename, size, store, cache=None):
+	(numMarkers, estimated) = ReadImageStatus(filename, store)
+	return Thumbnail(filename, LoadThumbnailImage(filename, size, cache), numMarkers, estimated)
+
+
+
+# Loads thumbnails in a pool of worker threads; emits loaded in the GUI
+# thread for every requested thumbnail in the order they are finished
+class ThumbnailLoader(QObject):
+
+	loaded = pyqtSignal(str, object)
+	# Internal: delivers results of the workers to the GUI thread
+	finished = pyqtSignal(str, object, int)
+
+	def __init__(self, size=128, numThreads=None, cacheDirectory=None, parent=None):
+		super(ThumbnailLoader, self).__init__(parent)
+		self.size = size
+		if numThreads is None:
+			numThreads = min(8, os.cpu_count() or 1)
+		try:
+			self.cache = ThumbnailCache(ThumbnailCache.DefaultDirectory() \
+				if cacheDirectory is None else cacheDirectory, size)
+		except OSError:
+			self.cache = None
+		self.store = SidecarStore()
+		self.executor = ThreadPoolExecutor(max_workers=numThreads)
+		self.pending = {}
+		# Incremented when requests are cancelled, late results are dropped
+		self.generation = 0
+		self.finished.connect(self.onFinished)
+
+	# Request the thumbnail and status of an image
+	def request(self, filename):
+		if filename in self.pending:
+			return
+		generation = self.generation
+		future = self.executor.submit(LoadThumbnail, filename, self.size, self.store, self.cache)
+		self.pending[filename] = future
+		future.add_done_callback(lambda f: self.onDone(filename, f, generation))
+
+	# Change the store the status is read from
+	def setStore(self, store):
+		self.cancelRequests()
+		self.store = store
+
+	# Drop all requests which have not been finished yet
+	def cancelRequests(self):
+		for future in self.pending.values():
+			future.cancel()
+		self.pending = {}
+		self.generation += 1
+
+	# Drop requests for images other than filenames which have not been
+	# started yet; returns the filenames of the dropped requests
+	def cancelRequestsExcept(self, filenames):
+		cancelled = [ filename for (filename, future) in self.pending.items() \
+			if filename not in filenames and future.cancel() ]
+		for filename in cancelled:
+			del self.pending[filename]
+		return cancelled
+
+	# Called in the worker thread
+	def onDone(self, filename, future, generation):
+		if future.cancelled():
+			return
+		try:
+			thumbnail = future.result()
+		except Exception:
+			thumbnail = Thumbnail(filename)
+		self.finished.emit(filename, thumbnail, generation)
+
+	def onFinished(self, filename, thumbnail, generation):
+		if generation != self.generation:
+			return
+		self.pending.pop(filename, None)
+		self.loaded.emit(filename, thumbnail)
+
+	def shutdown(self):
+		self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+
+import math
+from collections import OrderedDict
+from PyQt5.QtCore import QRect, QRectF, QSize, Qt
+from PyQt5.QtGui import QImage, QPainter, QPixmap
+
+
+
+# Multi-resolution pyramid of an image: level 0 is the full resolution image,
+# each further level halves the resolution; every level is cut into square
+# tiles, which are converted to pixmaps when they are painted the first time.
+# A preview pyramid is built from an image decoded at reduced resolution:
+# image is level baseLevel of an image of fullSize, the levels above are
+# not available. Sizes and scales always refer to the full resolution
+class TilePyramid:
+
+	def __init__(self, image, tileSize=256, maxTiles=512, fullSize=None):
+		self.tileSize = tileSize
+		self.maxTiles = maxTiles
+		self.levels = [ image ]
+		self.tiles = OrderedDict()
+		self.fullSize = QSize(image.size() if fullSize is None else fullSize)
+		self.baseLevel = max(0, int(round(math.log2(max(self.fullSize.width(), 1) / \
+			float(max(image.width(), 1))))))
+		# Number of levels: the last level fits into a single tile
+		size = max(self.fullSize.width(), self.fullSize.height(), 1)
+		self.numLevels = max(self.baseLevel + 1,
+			1 + max(0, int(math.ceil(math.log2(size / float(tileSize))))))
+
+	def width(self):
+		return self.fullSize.width()
+
+	def height(self):
+		return self.fullSize.height()
+
+	def size(self):
+		return QSize(self.fullSize)
+
+	def isPreview(self):
+		return self.baseLevel > 0
+
+	# Largest scale factor painted without upsampling
+	def maxScale(self):
+		return 1.0 / (1 << self.baseLevel)
+
+	# Memory used by image data in bytes
+	def byteCount(self):
+		result = sum(level.sizeInBytes() for level in self.levels)
+		for pixmap in self.tiles.values():
+			result += pixmap.width() * pixmap.height() * pixmap.depth() // 8
+		return result
+
+	# Free the pixmaps of all tiles
+	def releaseTiles(self):
+		self.tiles.clear()
+
+	# Image of a level, calculated from the previous level if necessary; the
+	# base level for the unavailable levels of a preview
+	def getLevel(self, level):
+		level = max(level, self.baseLevel) - self.baseLevel
+		while len(self.levels) <= level:
+			previous = self.levels[-1]
+			self.levels.append(previous.scaled(max(1, previous.width() // 2),
+				max(1, previous.height() // 2), Qt.IgnoreAspectRatio, Qt.SmoothTransformation))
+		return self.levels[level]
+
+	# Calculate all levels in advance, may be called from a worker thread
+	def buildLevels(self):
+		self.getLevel(self.numLevels - 1)
+
+	# Level with the lowest resolution that is still at least as high as
+	# the resolution needed for painting with scale factor scale, or the
+	# highest resolution available
+	def levelForScale(self, scale):
+		if scale >= 1.0:
+			return self.baseLevel
+		level = int(math.floor(math.log2(1.0 / scale)))
+		return max(self.baseLevel, min(level, self.numLevels - 1))
+
+	def getTile(self, level, col, row):
+		key = (level, col, row)
+		pixmap = self.tiles.get(key)
+		if pixmap is not None:
+			self.tiles.move_to_end(key)
+			return pixmap
+		image = self.getLevel(level)
+		rect = QRect(col * self.tileSize, row * self.tileSize, self.tileSize, self.tileSize)
+		pixmap = QPixmap.fromImage(image.copy(rect.intersected(image.rect())))
+		self.tiles[key] = pixmap
+		while len(self.tiles) > self.maxTiles:
+			self.tiles.popitem(last=False)
+		return pixmap
+
+	# Paint the part exposedRect (widget coordinates) of the image scaled by
+	# scale; only the tiles intersecting exposedRect are painted
+	def paint(self, painter, scale, exposedRect):
+		level = self.levelForScale(scale)
+		image = self.getLevel(level)
+		# Widget pixels per pixel of the level
+		ratioX = (scale * self.width()) / image.width()
+		ratioY = (scale * self.height()) / image.height()
+		if level > 0 or scale != 1.0:
+			painter.setRenderHint(QPainter.SmoothPixmapTransform, True)
+		numCols = (image.width() + self.tileSize - 1) // self.tileSize
+		numRows = (image.height() + self.tileSize - 1) // self.tileSize
+		colStart = max(0, int(exposedRect.left() / (ratioX * self.tileSize)))
+		colEnd = min(numCols - 1, int((exposedRect.right() + 1) / (ratioX * self.tileSize)))
+		rowStart = max(0, int(exposedRect.top() / (ratioY * self.tileSize)))
+		rowEnd = min(numRows - 1, int((exposedRect.bottom() + 1) / (ratioY * self.tileSize)))
+		for row in range(rowStart, rowEnd + 1):
+			for col in range(colStart, colEnd + 1):
+				pixmap = self.getTile(level, col, row)
+				target = QRectF(col * self.tileSize * ratioX, row * self.tileSize * ratioY,
+					pixmap.width() * ratioX, pixmap.height() * ratioY)
+				painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
+
@@ -11,18 +11,93 @@ class ApproxSwissProj:
 
 	@staticmethod
 	def LV03toWGS84(east, north, height):
-		latitude = CHtoWGSlat(east, north)
-		longitude = CHtoWGSlng(east, north)
-		ellHeight = CHtoWGSheight(east, north, height)
+		(latitude, longitude, ellHeight) = \
+			ApproxSwissProj.CHtoWGS(np.array([east, north, height]))
 		return (latitude, longitude, ellHeight)
 
 	@staticmethod
 	def WGS84toLV03(latitude, longitude, ellHeight):
-		east = WGStoCHy(latitude, longitude)
-		north = WGStoCHx(latitude, longitude)
-		height = WGStoCHh(latitude, longitude, ellHeight)
+		(east, north, height) = \
+			ApproxSwissProj.WGStoCH(np.array([latitude, longitude, ellHeight]))
 		return (east, north, height)
 
+	# Convert an array of WGS points (° dec) to CH in a single pass:
+	# rows of lat/lng result in rows of y/x, rows of lat/lng/h in rows of y/x/h;
+	# a single point may be passed as a 1D array
+	@staticmethod
+	def WGStoCH(wgs):
+		wgs = np.asarray(wgs, dtype=float)
+		points = np.atleast_2d(wgs)
+		if points.shape[1] not in (2, 3):
+			raise ValueError('Expected Nx2 or Nx3 array, got shape {0}'.format(wgs.shape))
+		# Converts degrees dec to seconds (sex), same as DecToSexAngle
+		# followed by SexAngleToSeconds
+		lat = points[:, 0] * 3600.0
+		lng = points[:, 1] * 3600.0
+		# Axiliary values (% Bern), calculated once for all outputs
+		lat_aux = (lat - 169028.66) / 10000.0
+		lng_aux = (lng - 26782.5) / 10000.0
+		lat_aux2 = lat_aux * lat_aux
+		lng_aux2 = lng_aux * lng_aux
+		result = np.empty_like(points)
+		# Process Y
+		result[:, 0] = 600072.37 \
+			+ 211455.93 * lng_aux \
+			-  10938.51 * lng_aux * lat_aux \
+			-      0.36 * lng_aux * lat_aux2 \
+			-     44.54 * lng_aux2 * lng_aux
+		# Process X
+		result[:, 1] = 200147.07 \
+			+ 308807.95 * lat_aux  \
+			+   3745.25 * lng_aux2 \
+			+     76.63 * lat_aux2 \
+			-    194.56 * lng_aux2 * lat_aux \
+			+    119.79 * lat_aux2 * lat_aux
+		# Process h
+		if points.shape[1] == 3:
+			result[:, 2] = points[:, 2] - 49.55 \
+				+  2.73 * lng_aux \
+				+  6.94 * lat_aux
+		return result.reshape(wgs.shape)
+
+	# Convert an array of CH points to WGS (° dec) in a single pass:
+	# rows of y/x result in rows of lat/lng, rows of y/x/h in rows of lat/lng/h;
+	# a single point may be passed as a 1D array
+	@staticmethod
+	def CHtoWGS(ch):
+		ch = np.asarray(ch, dtype=float)
+		points = np.atleast_2d(ch)
+		if points.shape[1] not in (2, 3):
+			raise ValueError('Expected Nx2 or Nx3 array, got shape {0}'.format(ch.shape))
+		# Converts militar to civil and  to unit = 1000km
+		# Axiliary values (% Bern), calculated once for all outputs
+		y_aux = (points[:, 0] - 600000.0) / 1000000.0
+		x_aux = (points[:, 1] - 200000.0) / 1000000.0
+		y_aux2 = y_aux * y_aux
+		x_aux2 = x_aux * x_aux
+		result = np.empty_like(points)
+		# Process lat
+		result[:, 0] = 16.9023892 \
+			+  3.238272 * x_aux \
+			-  0.270978 * y_aux2 \
+			-  0.002528 * x_aux2 \
+			-  0.0447   * y_aux2 * x_aux \
+			-  0.0140   * x_aux2 * x_aux
+		# Process long
+		result[:, 1] = 2.6779094 \
+			+ 4.728982 * y_aux \
+			+ 0.791484 * y_aux * x_aux \
+			+ 0.1306   * y_aux * x_aux2 \
+			- 0.0436   * y_aux2 * y_aux
+		# Unit 10000" to 1 " and converts seconds to degrees (dec)
+		result[:, 0:2] *= 100.0 / 36.0
+		# Process height
+		if points.shape[1] == 3:
+			result[:, 2] = points[:, 2] + 49.55 \
+				- 12.60 * y_aux \
+				- 22.64 * x_aux
+		return result.reshape(ch.shape)
+
 	# Convert WGS lat/long (° dec) to CH y
 	@staticmethod
 	def WGStoCHy(lat, lng):